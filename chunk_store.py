@@ -0,0 +1,146 @@
+# chunk_store.py
+# Компактное хранилище метаданных чанков (замена chunk_map.json на сервере).
+# Один файл с колонками-массивами, который сервер открывает через mmap только для чтения:
+# все воркеры uvicorn делят одни и те же страницы в page cache, а "загрузка" занимает
+# микросекунды вместо разбора многомегабайтного JSON в каждом процессе.
+#
+#   python chunk_store.py                # сконвертировать существующий chunk_map.json
+#
+# Формат: MAGIC, длина заголовка (uint64), JSON-заголовок с описанием массивов,
+# затем массивы, выровненные по 64 байта.
+import os
+import json
+import struct
+import argparse
+import numpy as np
+
+MAGIC = b"CHSTORE1"
+ALIGN = 64
+CHUNK_TYPES = ("summary", "text")
+MAPPING_FILE = "chunk_map.json"
+STORE_FILE = "chunk_store.bin"
+
+
+def game_order(chunks):
+    """Порядок игр в хранилище: номер игры здесь - это id векторов индекса уровня игр."""
+    return sorted({chunk["game_id"] for chunk in chunks})
+
+def write_store(path, chunks):
+    """chunks - список словарей {game_id, type, text_snippet} в порядке id векторов Faiss."""
+    game_ids = game_order(chunks)
+    game_pos = {game_id: i for i, game_id in enumerate(game_ids)}
+    snippets = [chunk.get("text_snippet", "").encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in snippets], out=offsets[1:])
+
+    arrays = {
+        "game_index": np.array([game_pos[c["game_id"]] for c in chunks], dtype=np.int32),
+        "chunk_type": np.array([CHUNK_TYPES.index(c.get("type", "text")) for c in chunks], dtype=np.uint8),
+        "game_ids": np.array([g.encode("utf-8") for g in game_ids], dtype=f"S{max([len(g) for g in game_ids] or [1])}"),
+        "snippet_offsets": offsets,
+        "snippets": np.frombuffer(b"".join(snippets), dtype=np.uint8),
+    }
+
+    layout, position = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": position}
+        position += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"count": len(chunks), "arrays": layout}).encode("utf-8")
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + position)
+
+
+class ChunkStore:
+    """Доступ к метаданным чанка по id вектора; массивы отображены в память, файл не читается целиком."""
+    def __init__(self, path):
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self._mm[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path}: не файл хранилища чанков")
+        header_len = struct.unpack("<Q", bytes(self._mm[len(MAGIC):len(MAGIC) + 8]))[0]
+        header = json.loads(bytes(self._mm[len(MAGIC) + 8:len(MAGIC) + 8 + header_len]))
+        data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+        self.count = header["count"]
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            size = int(np.prod(spec["shape"])) if spec["shape"] else 1
+            array = np.frombuffer(self._mm, dtype=dtype, count=size, offset=data_start + spec["offset"])
+            setattr(self, "_" + name, array.reshape(spec["shape"]))
+        self._game_id_cache = [g.decode("utf-8") for g in self._game_ids]
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def game_id(self, idx):
+        return self._game_id_cache[self._game_index[idx]]
+
+    def chunk_type(self, idx):
+        return CHUNK_TYPES[self._chunk_type[idx]]
+
+    def snippet(self, idx):
+        start, end = self._snippet_offsets[idx], self._snippet_offsets[idx + 1]
+        return bytes(self._snippets[start:end]).decode("utf-8", errors="replace")
+
+    def get(self, idx, default=None):
+        """Совместимость с прежним chunk_map: словарь метаданных чанка."""
+        if not 0 <= idx < self.count:
+            return default
+        return {"game_id": self.game_id(idx), "type": self.chunk_type(idx), "text_snippet": self.snippet(idx)}
+
+    def game_index_array(self):
+        """Номер игры (в списке game_id_list) для каждого чанка - для векторных операций."""
+        return self._game_index
+
+    def chunk_type_array(self):
+        return self._chunk_type
+
+    def game_id_list(self):
+        return self._game_id_cache
+
+    def game_ranges(self):
+        """
+        (starts, ends): чанки игры с номером i - это векторы [starts[i], ends[i]) индекса.
+        None, если чанки игр идут не подряд (индекс собран старым индексатором).
+        """
+        game_index = self._game_index
+        if not len(game_index):
+            return None
+        boundaries = np.flatnonzero(np.diff(game_index)) + 1
+        run_starts = np.concatenate([[0], boundaries])
+        if len(run_starts) != len(self._game_id_cache):
+            return None
+        starts = np.zeros(len(self._game_id_cache), dtype=np.int64)
+        ends = np.zeros(len(self._game_id_cache), dtype=np.int64)
+        starts[game_index[run_starts]] = run_starts
+        ends[game_index[run_starts]] = np.concatenate([boundaries, [len(game_index)]])
+        return starts, ends
+
+
+def convert(mapping_file=MAPPING_FILE, store_file=STORE_FILE):
+    with open(mapping_file, "r", encoding="utf-8") as f:
+        mapping = json.load(f)
+    chunks = [mapping[str(i)] for i in range(len(mapping))]
+    # Воркеры сервера могут конвертировать одновременно - у каждого свой временный файл
+    tmp_path = f"{store_file}.{os.getpid()}.tmp"
+    write_store(tmp_path, chunks)
+    os.replace(tmp_path, store_file)
+    return len(chunks)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Конвертирует chunk_map.json в отображаемый в память chunk_store.bin.")
+    parser.add_argument('--mapping', default=MAPPING_FILE)
+    parser.add_argument('--out', default=STORE_FILE)
+    args = parser.parse_args()
+    count = convert(args.mapping, args.out)
+    size = os.path.getsize(args.out)
+    print(f"Записано {count} чанков в {args.out} ({size / 1024 / 1024:.1f} МБ, "
+          f"было {os.path.getsize(args.mapping) / 1024 / 1024:.1f} МБ JSON).")
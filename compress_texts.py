@@ -0,0 +1,164 @@
+# compress_texts.py
+# Разовая миграция: пересжимает тексты игр в game_texts выбранным кодеком
+# (по умолчанию zstd, без пакета zstandard - zlib) с общим обученным словарем.
+#
+#   python compress_texts.py --bench            # только сравнить кодеки на выборке, база не меняется
+#   python compress_texts.py --train            # обучить словарь и пересжать все тексты
+#   python compress_texts.py --codec zlib       # пересжать без нового словаря (используется последний обученный)
+import os
+import time
+import random
+import argparse
+import storage
+from create_database import ensure_schema
+
+DB_FILE = "games.db"
+BATCH_SIZE = 200
+DEFAULT_SAMPLES = 2000
+DEFAULT_DICT_SIZE = 112 * 1024  # Рекомендованный размер словаря zstd; для zlib обрезается до 32 КБ
+
+def get_chunker():
+    """Чанкинг индексатора, чтобы замер чтения совпадал с реальным проходом indexer.py."""
+    try:
+        from indexer import chunk_raw_text
+        return chunk_raw_text
+    except (ImportError, ValueError) as e:
+        # indexer требует GOOGLE_API_KEY уже при импорте
+        print(f"Чанкинг индексатора недоступен ({e}), замеряем только чтение и разбиение на слова.")
+        return str.split
+
+def db_size(db_file):
+    return sum(os.path.getsize(path) for path in (db_file, db_file + "-wal") if os.path.exists(path))
+
+def mb(n):
+    return n / (1024 * 1024)
+
+def load_samples(conn, limit):
+    ids = [row[0] for row in conn.execute("SELECT pocketbase_id FROM game_texts")]
+    random.seed(42)
+    ids = random.sample(ids, min(limit, len(ids)))
+    return [storage.load_full_text(conn, pb_id) for pb_id in ids]
+
+def measure_read_pass(conn, chunker):
+    """Время прохода чанкинга индексатора: чтение + распаковка + разбиение на чанки."""
+    start = time.perf_counter()
+    games = chars = chunks = 0
+    for _, _, _, text in storage.iter_full_texts(conn, "WHERE g.source_hash IS NOT NULL"):
+        if text:
+            games += 1
+            chars += len(text)
+            chunks += len(chunker(text))
+    elapsed = time.perf_counter() - start
+    print(f"Проход чанкинга: {games} игр, {mb(chars):.1f} M символов, {chunks} чанков "
+          f"за {elapsed:.2f} с ({mb(chars) / max(elapsed, 1e-9):.1f} M символов/с)")
+    return elapsed
+
+def bench(conn, samples, dict_size, chunker):
+    """Сравнивает кодеки на выборке. Словари обучаются на одной половине и проверяются на другой."""
+    random.shuffle(samples)
+    half = len(samples) // 2
+    train, test = samples[:half], samples[half:]
+    if not test:
+        print("Слишком мало текстов для замера.")
+        return
+    raw_total = sum(len(text.encode('utf-8')) for text in test)
+    print(f"Выборка: {len(test)} текстов, {mb(raw_total):.1f} МБ (словари обучены на {len(train)} других)")
+
+    variants = [("raw", None), ("zlib", None)]
+    codecs = ["zlib"] + (["zstd"] if storage.zstandard else [])
+    if storage.zstandard:
+        variants.append(("zstd", None))
+    for codec in codecs:
+        if len(train) < 10:
+            break
+        start = time.perf_counter()
+        zdict = storage.train_dictionary(codec, train, dict_size)
+        print(f"Словарь {codec}: {len(zdict) / 1024:.1f} КБ, обучен за {time.perf_counter() - start:.1f} с")
+        variants.append((codec, zdict))
+
+    print(f"{'кодек':<12}{'размер, МБ':>12}{'сжатие':>9}{'запись, МБ/с':>14}{'чтение+чанки, МБ/с':>20}")
+    for codec, zdict in variants:
+        start = time.perf_counter()
+        encoded = [storage.encode_text(text, codec, zdict)[1] for text in test]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in encoded:
+            chunker(storage.decode_text(codec, data, zdict))
+        decode_time = time.perf_counter() - start
+
+        size = sum(len(data) for data in encoded)
+        name = codec + ("+dict" if zdict else "")
+        print(f"{name:<12}{mb(size):>12.2f}{raw_total / max(size, 1):>8.1f}x"
+              f"{mb(raw_total) / max(encode_time, 1e-9):>14.1f}{mb(raw_total) / max(decode_time, 1e-9):>20.1f}")
+
+def recompress(conn, codec):
+    """Пересжимает все тексты, записанные не текущим кодеком/словарем, пачками по BATCH_SIZE."""
+    dict_id = storage.active_dictionary(conn, codec) if codec != "raw" else None
+    zdict = storage.get_dictionary(conn, dict_id) if dict_id else None
+    pending = [row[0] for row in conn.execute(
+        "SELECT pocketbase_id FROM game_texts WHERE codec != ? OR dict_id IS NOT ?", (codec, dict_id)
+    )]
+    print(f"Пересжатие {len(pending)} текстов: {codec}" + (f" со словарем {dict_id}" if dict_id else ""))
+
+    for i in range(0, len(pending), BATCH_SIZE):
+        batch = pending[i:i + BATCH_SIZE]
+        updates = []
+        for pb_id in batch:
+            text = storage.load_full_text(conn, pb_id)
+            new_codec, data = storage.encode_text(text, codec, zdict)
+            updates.append((new_codec, dict_id if new_codec != "raw" else None, data, pb_id))
+        with conn:
+            conn.executemany("UPDATE game_texts SET codec = ?, dict_id = ?, data = ? WHERE pocketbase_id = ?", updates)
+        print(f"  {min(i + BATCH_SIZE, len(pending))}/{len(pending)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Сжатие текстов игр в games.db общим словарем.")
+    parser.add_argument('--db', default=DB_FILE)
+    parser.add_argument('--codec', choices=["zstd", "zlib", "raw"], default=storage.default_codec())
+    parser.add_argument('--train', action='store_true', help="Обучить новый словарь на текстах базы перед пересжатием.")
+    parser.add_argument('--bench', action='store_true', help="Только замеры на выборке, без изменения базы.")
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES, help="Сколько текстов брать для обучения/замеров.")
+    parser.add_argument('--dict-size', type=int, default=DEFAULT_DICT_SIZE)
+    args = parser.parse_args()
+
+    if args.codec == "zstd" and storage.zstandard is None:
+        parser.error("для zstd нужен пакет zstandard (pip install zstandard)")
+
+    conn = storage.connect(args.db)
+    ensure_schema(conn)
+    chunker = get_chunker()
+
+    if args.bench:
+        bench(conn, load_samples(conn, args.samples), args.dict_size, chunker)
+        conn.close()
+        return
+
+    size_before = db_size(args.db)
+    print("До миграции:")
+    read_before = measure_read_pass(conn, chunker)
+
+    if args.train and args.codec != "raw":
+        samples = load_samples(conn, args.samples)
+        print(f"Обучение словаря {args.codec} на {len(samples)} текстах...")
+        dict_id = storage.save_dictionary(conn, args.codec, storage.train_dictionary(args.codec, samples, args.dict_size))
+        print(f"Словарь сохранен: {dict_id}")
+
+    recompress(conn, args.codec)
+
+    print("Сжатие файла базы (VACUUM)...")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    print("После миграции:")
+    read_after = measure_read_pass(conn, chunker)
+    size_after = db_size(args.db)
+    conn.close()
+
+    print("-" * 20)
+    print(f"Размер базы: {mb(size_before):.1f} МБ -> {mb(size_after):.1f} МБ")
+    print(f"Проход чанкинга: {read_before:.2f} с -> {read_after:.2f} с")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,267 @@
 # create_database.py
 import sqlite3
 import os
+import hashlib
 
 DB_FILE = "games.db"
 
+# Версия схемы хранится в PRAGMA user_version. ensure_schema() последовательно
+# применяет недостающие миграции, чтобы не пересоздавать games.db.
+#   1 - колонки pb_updated / needs_fetch и таблица sync_state (инкрементальный sync)
+#   2 - холодные тексты вынесены в game_texts, частичные индексы, счетчики, WAL
+#   3 - словари сжатия текстов (text_dictionaries, game_texts.dict_id)
+#   4 - счетчик поколения каталога и индекс для постраничной выдачи /games
+#   5 - векторы игр и готовые списки похожих игр (game_vectors, для /api/similar)
+#   6 - поколение каталога растет только при настоящем изменении значений (и атрибутов фильтров)
+SCHEMA_VERSION = 6
+
+# Колонки, добавленные после первой версии схемы.
+MIGRATION_COLUMNS = [
+    ("pb_updated", "TEXT"),                    # Поле 'updated' записи в PocketBase
+    ("needs_fetch", "BOOLEAN DEFAULT 0"),      # Источник (URL/страницы) изменился - текст нужно скачать заново
+]
+
+# Частичные индексы под предикаты, по которым каждый этап ищет работу.
+# Индексы маленькие: в них попадают только игры, ожидающие соответствующего этапа.
+STATUS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_games_no_text ON games (pocketbase_id) WHERE source_hash IS NULL",
+    "CREATE INDEX IF NOT EXISTS idx_games_needs_fetch ON games (pocketbase_id) WHERE needs_fetch = 1",
+    "CREATE INDEX IF NOT EXISTS idx_games_static_pending ON games (pocketbase_id) WHERE is_indexed = 0 AND image_urls IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_games_needs_summary ON games (pocketbase_id) WHERE summary IS NULL AND source_hash IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS idx_games_unindexed ON games (pocketbase_id) WHERE last_indexed_at IS NULL",
+]
+
+# Счетчики для /stats поддерживаются триггерами - сервер читает их за O(1)
+# вместо четырех полных проходов по таблице.
+COUNTER_TRIGGERS = [
+    """
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_games_counters_insert AFTER INSERT ON games BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'total' THEN 1
+            WHEN 'with_text' THEN NEW.source_hash IS NOT NULL
+            WHEN 'with_summary' THEN NEW.summary IS NOT NULL
+            WHEN 'indexed' THEN NEW.last_indexed_at IS NOT NULL
+            ELSE 0 END;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_games_counters_delete AFTER DELETE ON games BEGIN
+        UPDATE stats_counters SET value = value - CASE name
+            WHEN 'total' THEN 1
+            WHEN 'with_text' THEN OLD.source_hash IS NOT NULL
+            WHEN 'with_summary' THEN OLD.summary IS NOT NULL
+            WHEN 'indexed' THEN OLD.last_indexed_at IS NOT NULL
+            ELSE 0 END;
+        DELETE FROM game_texts WHERE pocketbase_id = OLD.pocketbase_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_games_counters_update
+    AFTER UPDATE OF source_hash, summary, last_indexed_at ON games BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'with_text' THEN (NEW.source_hash IS NOT NULL) - (OLD.source_hash IS NOT NULL)
+            WHEN 'with_summary' THEN (NEW.summary IS NOT NULL) - (OLD.summary IS NOT NULL)
+            WHEN 'indexed' THEN (NEW.last_indexed_at IS NOT NULL) - (OLD.last_indexed_at IS NOT NULL)
+            ELSE 0 END;
+    END
+    """,
+]
+
+def _migrate_v1(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(games)")}
+    for name, definition in MIGRATION_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE games ADD COLUMN {name} {definition}")
+
+    # Ключ-значение для служебного состояния (например, отметка последней синхронизации)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+def _migrate_v2(conn):
+    """
+    Переносит full_text (мегабайты на игру) из горячей таблицы games в game_texts.
+    Запросы по статусам и /stats больше не тащат тексты через кэш страниц.
+    Возвращает True, если колонка была удалена и базе нужен VACUUM.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS game_texts (
+            pocketbase_id TEXT PRIMARY KEY,
+            codec TEXT NOT NULL DEFAULT 'raw',  -- raw / zlib / zstd (см. storage.py)
+            data BLOB NOT NULL,
+            raw_length INTEGER                  -- длина исходного текста в символах
+        )
+    """)
+
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(games)")}
+    dropped = False
+    if "full_text" in columns:
+        print("Перенос текстов игр в таблицу game_texts...")
+        rows = conn.execute(
+            "SELECT pocketbase_id, full_text, source_hash FROM games WHERE full_text IS NOT NULL AND full_text != ''"
+        )
+        for pb_id, full_text, source_hash in rows.fetchall():
+            conn.execute(
+                "INSERT OR REPLACE INTO game_texts (pocketbase_id, codec, data, raw_length) VALUES (?, 'raw', ?, ?)",
+                (pb_id, full_text.encode('utf-8'), len(full_text))
+            )
+            if source_hash is None:
+                # Заполненный source_hash теперь и есть признак "у игры есть текст"
+                conn.execute(
+                    "UPDATE games SET source_hash = ? WHERE pocketbase_id = ?",
+                    (hashlib.sha1(full_text.encode('utf-8')).hexdigest(), pb_id)
+                )
+        # Отпечаток без текста (пустой full_text) - не текст
+        conn.execute("""
+            UPDATE games SET source_hash = NULL
+            WHERE source_hash IS NOT NULL AND pocketbase_id NOT IN (SELECT pocketbase_id FROM game_texts)
+        """)
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            conn.execute("ALTER TABLE games DROP COLUMN full_text")
+        else:
+            conn.execute("UPDATE games SET full_text = NULL")
+        dropped = True
+
+    # Пустая строка и NULL в summary означали одно и то же - оставляем только NULL
+    conn.execute("UPDATE games SET summary = NULL WHERE summary = ''")
+
+    for statement in STATUS_INDEXES:
+        conn.execute(statement)
+
+    # executescript() сам делает COMMIT, поэтому выполняем по одному выражению
+    for statement in COUNTER_TRIGGERS:
+        conn.execute(statement)
+    conn.execute("DELETE FROM stats_counters")
+    conn.execute("""
+        INSERT INTO stats_counters (name, value)
+        SELECT 'total', COUNT(*) FROM games
+        UNION ALL SELECT 'with_text', COUNT(*) FROM games WHERE source_hash IS NOT NULL
+        UNION ALL SELECT 'with_summary', COUNT(*) FROM games WHERE summary IS NOT NULL
+        UNION ALL SELECT 'indexed', COUNT(*) FROM games WHERE last_indexed_at IS NOT NULL
+    """)
+    return dropped
+
+def _migrate_v3(conn):
+    # Общие словари сжатия: тексты CYOA во многом состоят из одних и тех же фраз
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS text_dictionaries (
+            dict_id TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            created_at TIMESTAMP
+        )
+    """)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(game_texts)")}
+    if "dict_id" not in columns:
+        conn.execute("ALTER TABLE game_texts ADD COLUMN dict_id TEXT")
+
+# Поколение каталога: растет при любом изменении того, что показывает /games.
+# Сервер сравнивает его со своим и сбрасывает кэш готовых страниц.
+GENERATION_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_games_generation_insert AFTER INSERT ON games BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'generation';
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_games_generation_delete AFTER DELETE ON games BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'generation';
+    END
+    """,
+    # Повторный upsert тех же значений (sync, пачки описаний) поколение не меняет: иначе сервер
+    # зря сбрасывает кэш /games и пересобирает индекс названий и маски фильтров
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_games_generation_update
+    AFTER UPDATE OF title, summary, last_indexed_at, original_url, image_urls ON games
+    WHEN OLD.title IS NOT NEW.title
+      OR OLD.summary IS NOT NEW.summary
+      OR OLD.last_indexed_at IS NOT NEW.last_indexed_at
+      OR OLD.original_url IS NOT NEW.original_url
+      OR OLD.image_urls IS NOT NEW.image_urls
+    BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'generation';
+    END
+    """,
+]
+
+def _migrate_v4(conn):
+    # Постраничная выдача каталога идет по (title, pocketbase_id) - без сортировки всей таблицы
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_games_title ON games (title, pocketbase_id)")
+    for statement in GENERATION_TRIGGERS:
+        conn.execute(statement)
+    conn.execute("INSERT OR IGNORE INTO stats_counters (name, value) VALUES ('generation', 1)")
+
+def _migrate_v5(conn):
+    # Вектор игры (описание + тексты) и ее ближайшие соседи, посчитанные индексатором.
+    # id - явный INTEGER PRIMARY KEY: на него ссылаются списки соседей, и VACUUM его не меняет.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS game_vectors (
+            id INTEGER PRIMARY KEY,
+            game_id TEXT NOT NULL UNIQUE,
+            vector BLOB NOT NULL,
+            neighbors BLOB,
+            updated_at TIMESTAMP
+        )
+    """)
+
+def _migrate_v6(conn):
+    # Триггер обновления пересоздается с условием WHEN (см. GENERATION_TRIGGERS)
+    conn.execute("DROP TRIGGER IF EXISTS trg_games_generation_update")
+    for statement in GENERATION_TRIGGERS:
+        conn.execute(statement)
+
+def ensure_schema(conn):
+    """Применяет к базе все миграции, которых в ней еще нет."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    needs_vacuum = False
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Повторная проверка под блокировкой: миграцию мог уже выполнить другой процесс
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            _migrate_v1(conn)
+        if version < 2:
+            needs_vacuum = _migrate_v2(conn)
+        if version < 3:
+            _migrate_v3(conn)
+        if version < 4:
+            _migrate_v4(conn)
+        if version < 5:
+            _migrate_v5(conn)
+        if version < 6:
+            _migrate_v6(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    # WAL: сервер читает, пока конвейер пишет. Режим сохраняется в самом файле базы.
+    conn.execute("PRAGMA journal_mode = WAL")
+    if needs_vacuum:
+        print("Сжатие файла базы после переноса текстов (VACUUM)...")
+        conn.execute("VACUUM")
+
 def create_database():
     """Создает файл базы данных и таблицу 'games' с новой схемой."""
     if os.path.exists(DB_FILE):
         print(f"Файл базы данных '{DB_FILE}' уже существует.")
-        print("Если вы хотите пересоздать схему, удалите файл вручную.")
+        conn = sqlite3.connect(DB_FILE)
+        ensure_schema(conn)
+        conn.close()
+        print(f"Схема обновлена до версии {SCHEMA_VERSION}.")
         return
 
     try:
@@ -21,17 +274,19 @@ def create_database():
             title TEXT NOT NULL,
             original_url TEXT, -- Для интерактивных CYOA (iframe_url)
             image_urls TEXT,   -- НОВОЕ ПОЛЕ: для JSON-списка URL-ов статичных CYOA
-            full_text TEXT,
             summary TEXT,
-            source_hash TEXT,
+            source_hash TEXT,  -- Отпечаток текста игры (сам текст - в game_texts)
             last_indexed_at TIMESTAMP,
-            is_indexed BOOLEAN DEFAULT 0
+            is_indexed BOOLEAN DEFAULT 0,
+            pb_updated TEXT,
+            needs_fetch BOOLEAN DEFAULT 0
         )
         ''')
 
         conn.commit()
+        ensure_schema(conn)
         conn.close()
-        print(f"База данных '{DB_FILE}' успешно создана с колонкой 'image_urls'.")
+        print(f"База данных '{DB_FILE}' успешно создана (схема версии {SCHEMA_VERSION}).")
 
     except Exception as e:
         print(f"Произошла ошибка при создании базы данных: {e}")
@@ -39,4 +294,5 @@ def create_database():
 if __name__ == "__main__":
     # Перед первым запуском новых скриптов, удалите старый games.db
     # и выполните этот файл, чтобы создать базу с новой структурой.
-    create_database()
\ No newline at end of file
+    # Для существующей базы этот же запуск применит недостающие миграции.
+    create_database()
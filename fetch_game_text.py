@@ -2,12 +2,13 @@
 import os
 import re
 import json
-import sqlite3
 import time
 import requests
 from urllib.parse import urljoin
 from tqdm import tqdm
 import chardet
+from create_database import ensure_schema
+from storage import connect, save_full_text
 
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -150,11 +151,16 @@ def main():
     """
     Основной процесс: найти игры без текста и запустить для них Fetcher.
     """
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect(DB_FILE)
+    ensure_schema(conn)
     cursor = conn.cursor()
 
     # ИЗМЕНЕНИЕ: Теперь мы выбираем и original_url
-    cursor.execute("SELECT pocketbase_id, title, original_url FROM games WHERE full_text IS NULL OR full_text = ''")
+    # Плюс игры, у которых при синхронизации сменился источник (needs_fetch = 1)
+    cursor.execute("""
+        SELECT pocketbase_id, title, original_url FROM games
+        WHERE source_hash IS NULL OR (needs_fetch = 1 AND original_url IS NOT NULL)
+    """)
     games_to_process = cursor.fetchall()
 
     if not games_to_process:
@@ -184,11 +190,8 @@ def main():
                 text_content = fetcher.fetch(original_url)
 
                 if text_content:
-                    cursor.execute(
-                        "UPDATE games SET full_text = ? WHERE pocketbase_id = ?",
-                        (text_content, pb_id)
-                    )
-                    conn.commit()
+                    # Если текст изменился, старое описание и индекс устарели
+                    save_full_text(conn, pb_id, text_content)
                     success_count += 1
                 else:
                     fail_count += 1
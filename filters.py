@@ -0,0 +1,76 @@
+# filters.py
+# Фильтры поиска по атрибутам игр (статичная картинка, интерактивная, есть AI-описание).
+# Для каждого атрибута заранее упакованы битовые маски: по номерам игр (для индекса уровня
+# игр) и по id чанков (для индекса чанков). Маски применяются внутри поиска Faiss через
+# IDSelectorBitmap, поэтому даже редкий фильтр дает полную страницу, а не остатки топ-k.
+import numpy as np
+
+ATTRIBUTES = ("static", "interactive", "summary")
+CHUNK_TYPES = ("summary", "text")
+
+# Атрибуты игры по строке games: (pocketbase_id, image_urls, original_url, summary)
+ATTRIBUTES_SQL = """
+    SELECT pocketbase_id,
+           image_urls IS NOT NULL AND image_urls NOT IN ('', '[]'),
+           original_url IS NOT NULL AND original_url != '',
+           summary IS NOT NULL AND summary != ''
+    FROM games
+"""
+
+
+def _pack(mask):
+    return np.packbits(mask, bitorder="little")
+
+def selector(bits, count):
+    """IDSelectorBitmap над упакованной маской; маска должна жить, пока идет поиск."""
+    import faiss  # Не при импорте модуля: сервер импортирует faiss в фоне, вместе с загрузкой индекса
+    sel = faiss.IDSelectorBitmap(count, faiss.swig_ptr(bits))
+    sel.referenced_objects = [bits]
+    return sel
+
+
+class AttributeBitmaps:
+    def __init__(self, store, rows):
+        """store - ChunkStore загруженного индекса, rows - результат ATTRIBUTES_SQL."""
+        game_ids = store.game_id_list()
+        position = {game_id: i for i, game_id in enumerate(game_ids)}
+        self.games = len(game_ids)
+        self.chunks = len(store)
+        game_masks = {attr: np.zeros(self.games, dtype=bool) for attr in ATTRIBUTES}
+        for game_id, *flags in rows:
+            i = position.get(game_id)
+            if i is None:
+                continue
+            for attr, flag in zip(ATTRIBUTES, flags):
+                game_masks[attr][i] = bool(flag)
+
+        game_index = store.game_index_array()
+        chunk_types = store.chunk_type_array()
+        self.game_masks = game_masks
+        self.game_bits = {attr: _pack(mask) for attr, mask in game_masks.items()}
+        self.chunk_bits = {attr: _pack(mask[game_index]) for attr, mask in game_masks.items()}
+        self.type_bits = {name: _pack(chunk_types == i) for i, name in enumerate(CHUNK_TYPES)}
+        self.counts = {attr: int(mask.sum()) for attr, mask in game_masks.items()}
+
+    def _combine(self, parts):
+        bits = parts[0].copy()
+        for part in parts[1:]:
+            np.bitwise_and(bits, part, out=bits)
+        return bits
+
+    def game_selector(self, attributes):
+        """Селектор по номерам игр (id векторов индекса уровня игр)."""
+        return selector(self._combine([self.game_bits[a] for a in attributes]), self.games)
+
+    def chunk_mask(self, attributes, chunk_type=None):
+        """Упакованная маска id чанков: атрибуты игры и, если задан, тип чанка (режим поиска)."""
+        parts = [self.chunk_bits[a] for a in attributes]
+        if chunk_type:
+            parts.append(self.type_bits[chunk_type])
+        return self._combine(parts)
+
+    def chunk_selector(self, attributes, chunk_type=None):
+        return selector(self.chunk_mask(attributes, chunk_type), self.chunks)
+
+    def game_matches(self, position, attributes):
+        return all(self.game_masks[a][position] for a in attributes)
@@ -1,11 +1,19 @@
 # generate_summary.py
-import sqlite3
 import os
+import time
+import hashlib
+import queue
+import random
 import argparse
+import threading
 import concurrent.futures
 from dotenv import load_dotenv
+import openai
 from openai import OpenAI
 from tqdm import tqdm
+from datetime import datetime
+import storage
+from create_database import ensure_schema
 
 # --- Конфигурация ---
 load_dotenv()
@@ -17,78 +25,451 @@ GENERATION_MODEL_NAME = "deepseek/deepseek-v3.2-exp"
 
 DB_FILE = "games.db"
 PROMPT_FILE = "summary_prompt.txt"
+SECTION_PROMPT_FILE = "section_prompt.txt"
 
-def load_prompt():
+# --- Параметры map-reduce для длинных текстов ---
+# Тексты до SINGLE_PASS_MAX_CHARS описываются одним запросом, как раньше.
+# Более длинные режутся на секции, секции описываются параллельно (map),
+# затем заметки по секциям сводятся в итоговое описание (reduce).
+SINGLE_PASS_MAX_CHARS = 120000
+SECTION_MIN_CHARS = 20000   # Раньше этой длины секцию не закрываем
+SECTION_MAX_CHARS = 60000   # Жесткий предел секции (~15k токенов)
+SECTION_BOUNDARY_MODULUS = 8 # Граница секции - после абзаца, чей хэш делится на это число
+REDUCE_MAX_CHARS = 100000   # Если заметок больше - сводим их в несколько уровней
+
+# --- Параметры надежности и пропускной способности ---
+MAX_RETRIES = 5             # Попыток на один запрос при временных ошибках
+RETRY_BASE_DELAY = 2.0      # Базовая пауза (сек) для экспоненциального backoff
+RETRY_MAX_DELAY = 60.0      # Потолок паузы между попытками
+RATE_LIMIT_COOLDOWN = 10.0  # Пауза для всех потоков после 429, если сервер не прислал Retry-After
+
+WRITE_BATCH_SIZE = 20       # Сколько описаний писать в БД одной транзакцией
+WRITE_FLUSH_INTERVAL = 5.0  # Максимальная задержка (сек) перед записью неполного батча
+
+# Цены модели в долларах за 1M токенов (для оценки стоимости в прогресс-баре).
+# Если OpenRouter возвращает usage.cost, используется именно он.
+PRICE_PER_M_INPUT = 0.27
+PRICE_PER_M_OUTPUT = 0.40
+
+# Ошибки, после которых запрос имеет смысл повторить
+TRANSIENT_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+def load_prompt(path=PROMPT_FILE):
     """Загружает системный промпт из файла."""
-    if not os.path.exists(PROMPT_FILE):
-        raise FileNotFoundError(f"Не найден файл промпта: {PROMPT_FILE}")
-    with open(PROMPT_FILE, 'r', encoding='utf-8') as f:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Не найден файл промпта: {path}")
+    with open(path, 'r', encoding='utf-8') as f:
         return f.read().strip()
 
-# <--- ИЗМЕНЕНИЕ: Добавили 'game_title' для логирования ошибок --->
-def generate_summary_with_openrouter(client, model_name, base_prompt, game_title, game_text):
-    """Отправляет текст игры в OpenRouter и получает описание."""
+
+class AdaptiveConcurrency:
+    """
+    Ограничитель числа одновременных запросов по схеме AIMD:
+    каждый успешный "раунд" запросов увеличивает лимит на 1,
+    ошибка 429 уменьшает его вдвое и ставит общую паузу. Остальные 429 той же волны
+    (ответы на запросы, отправленные до паузы) лимит не трогают, пока пауза не кончилась.
+    """
+    def __init__(self, initial, maximum, minimum=1):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._decrease_until = 0.0  # До этого момента 429 только продлевают паузу
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                self._cond.wait()
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            # Аддитивный рост: +1 после того, как весь текущий лимит отработал без 429
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_rate_limit(self, retry_after=None):
+        with self._cond:
+            now = time.monotonic()
+            if now >= self._decrease_until:
+                self.limit = max(self.minimum, self.limit // 2)
+            self._successes = 0
+            cooldown = retry_after if retry_after is not None else RATE_LIMIT_COOLDOWN
+            self.paused_until = max(self.paused_until, now + cooldown)
+            self._decrease_until = self.paused_until
+
+
+class UsageStats:
+    """Потокобезопасный счетчик токенов и стоимости для прогресс-бара."""
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def add_usage(self, usage):
+        if usage is None:
+            return
+        prompt = getattr(usage, 'prompt_tokens', 0) or 0
+        completion = getattr(usage, 'completion_tokens', 0) or 0
+        reported_cost = getattr(usage, 'cost', None)
+        with self._lock:
+            self.prompt_tokens += prompt
+            self.completion_tokens += completion
+            if reported_cost is not None:
+                self.cost += float(reported_cost)
+            else:
+                self.cost += (prompt * PRICE_PER_M_INPUT + completion * PRICE_PER_M_OUTPUT) / 1_000_000
+
+    def add_retry(self, rate_limited=False):
+        with self._lock:
+            self.retries += 1
+            if rate_limited:
+                self.rate_limited += 1
+
+    def postfix(self, limiter):
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        tokens = self.prompt_tokens + self.completion_tokens
+        return {
+            "tok/s": f"{tokens / elapsed:.0f}",
+            "cost": f"${self.cost:.3f}",
+            "conc": limiter.limit,
+            "429": self.rate_limited,
+        }
+
+
+class SummaryWriter(threading.Thread):
+    """
+    Единственный поток, пишущий описания в БД. Копит результаты и сохраняет их
+    батчами по WRITE_BATCH_SIZE (или раз в WRITE_FLUSH_INTERVAL секунд) в одной транзакции.
+    """
+    _STOP = object()
+
+    def __init__(self, db_file):
+        super().__init__(name="summary-writer", daemon=True)
+        self.db_file = db_file
+        self.queue = queue.Queue()
+        self.written = 0
+        self.error = None
+
+    def put(self, pb_id, summary):
+        self.queue.put((summary, pb_id))
+
+    def close(self):
+        self.queue.put(self._STOP)
+        self.join()
+        if self.error:
+            raise self.error
+
+    def _flush(self, conn, batch):
+        if not batch:
+            return
+        with conn:
+            conn.executemany(
+                "UPDATE games SET summary = ?, last_indexed_at = NULL WHERE pocketbase_id = ?",
+                batch
+            )
+        self.written += len(batch)
+        batch.clear()
+
+    def run(self):
+        conn = storage.connect(self.db_file)
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    self._flush(conn, batch)
+                    deadline = None
+                    continue
+
+                if item is self._STOP:
+                    self._flush(conn, batch)
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    self._flush(conn, batch)
+                    deadline = None
+        except Exception as e:
+            self.error = e
+        finally:
+            conn.close()
+
+
+def _retry_after_seconds(error):
+    """Достает Retry-After из ответа 429, если сервер его прислал."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
     try:
-        # <--- ИЗМЕНЕНИЕ: Уменьшаем лимит символов, чтобы вписаться в лимит токенов модели --->
-        # Лимит модели ~163k токенов. 500k символов это ~125k токенов, что безопасно.
-        max_chars = 500000
-        
-        if len(game_text) > max_chars:
-             # Логируем, что текст был обрезан
-             tqdm.write(f"  [INFO] Текст для '{game_title}' слишком длинный ({len(game_text)} симв.), обрезается до {max_chars}.")
-        
-        truncated_text = game_text[:max_chars]
-        
-        response = client.chat.completions.create(
-            model=model_name,
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def call_with_retries(request_fn, limiter, stats):
+    """
+    Выполняет запрос к API под ограничителем конкурентности.
+    429 уменьшает конкурентность, временные ошибки повторяются с экспоненциальной
+    паузой и полным джиттером, остальные ошибки пробрасываются сразу.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        try:
+            result = request_fn()
+        except openai.RateLimitError as e:
+            limiter.on_rate_limit(_retry_after_seconds(e))
+            error, rate_limited = e, True
+        except TRANSIENT_ERRORS as e:
+            error, rate_limited = e, False
+        else:
+            limiter.on_success()
+            return result
+        finally:
+            limiter.release()
+
+        if attempt == MAX_RETRIES:
+            raise error
+        stats.add_retry(rate_limited)
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+        time.sleep(delay)
+
+def split_into_sections(text):
+    """
+    Делит текст на секции по границам абзацев. Граница ставится после абзаца,
+    хэш которого делится на SECTION_BOUNDARY_MODULUS (но не раньше SECTION_MIN_CHARS),
+    поэтому локальная правка текста меняет только соседние секции, а не сдвигает все.
+    """
+    sections = []
+    current = []
+    current_len = 0
+
+    def close_section():
+        nonlocal current, current_len
+        if current:
+            sections.append("\n\n".join(current))
+        current, current_len = [], 0
+
+    for paragraph in text.split("\n\n"):
+        # Гигантские "абзацы" (часто весь JSON в одну строку) режем жестко
+        while len(paragraph) > SECTION_MAX_CHARS:
+            close_section()
+            sections.append(paragraph[:SECTION_MAX_CHARS])
+            paragraph = paragraph[SECTION_MAX_CHARS:]
+
+        if current_len + len(paragraph) > SECTION_MAX_CHARS:
+            close_section()
+        current.append(paragraph)
+        current_len += len(paragraph) + 2
+
+        digest = hashlib.md5(paragraph.encode('utf-8')).digest()
+        if current_len >= SECTION_MIN_CHARS and digest[0] % SECTION_BOUNDARY_MODULUS == 0:
+            close_section()
+
+    close_section()
+    return [section for section in sections if section.strip()]
+
+
+class SectionCache:
+    """
+    Кэш описаний секций в таблице summary_sections. Ключ - хэш от модели,
+    промпта и текста секции, поэтому после повторного скачивания игры заново
+    описываются только изменившиеся секции.
+    """
+    def __init__(self, db_file):
+        self.conn = storage.connect(db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS summary_sections (
+                    content_hash TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    created_at TIMESTAMP
+                )
+            """)
+
+    @staticmethod
+    def key(model_name, prompt, text):
+        hasher = hashlib.sha256()
+        for part in (model_name, prompt, text):
+            hasher.update(part.encode('utf-8'))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT summary FROM summary_sections WHERE content_hash = ?", (key,)).fetchone()
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def put(self, key, summary):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summary_sections (content_hash, summary, created_at) VALUES (?, ?, ?)",
+                (key, summary, datetime.now().isoformat())
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+class Summarizer:
+    """Все, что нужно для описания одной игры: клиент, промпты, ограничитель, кэш секций."""
+    def __init__(self, client, model_name, base_prompt, section_prompt, limiter, stats, cache, section_executor):
+        self.client = client
+        self.model_name = model_name
+        self.base_prompt = base_prompt
+        self.section_prompt = section_prompt
+        self.limiter = limiter
+        self.stats = stats
+        self.cache = cache
+        self.section_executor = section_executor
+
+    def _complete(self, system_prompt, user_content):
+        response = call_with_retries(lambda: self.client.chat.completions.create(
+            model=self.model_name,
             messages=[
                 {
                     "role": "system",
-                    "content": base_prompt
+                    "content": system_prompt
                 },
                 {
                     "role": "user",
-                    "content": f"Input Game Text:\n{truncated_text}"
+                    "content": user_content
                 }
             ],
             temperature=0.2,
-        )
+        ), self.limiter, self.stats)
+        self.stats.add_usage(response.usage)
         return response.choices[0].message.content.strip()
+
+    def _summarize_section(self, game_title, index, total, text):
+        """Map-шаг: заметки по одной секции (с кэшем по хэшу содержимого)."""
+        key = self.cache.key(self.model_name, self.section_prompt, text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        notes = self._complete(
+            self.section_prompt,
+            f"Game: {game_title}\nSection {index} of {total}.\n\nInput Game Text:\n{text}"
+        )
+        self.cache.put(key, notes)
+        return notes
+
+    def _map(self, game_title, texts):
+        futures = [
+            self.section_executor.submit(self._summarize_section, game_title, i, len(texts), text)
+            for i, text in enumerate(texts, 1)
+        ]
+        return [future.result() for future in futures]
+
+    def summarize(self, game_title, game_text):
+        """Возвращает итоговое описание игры (одним запросом или через map-reduce)."""
+        if len(game_text) <= SINGLE_PASS_MAX_CHARS:
+            return self._complete(self.base_prompt, f"Input Game Text:\n{game_text}")
+
+        sections = split_into_sections(game_text)
+        tqdm.write(f"  [INFO] Текст '{game_title}' ({len(game_text)} симв.) разбит на {len(sections)} секций.")
+        notes = self._map(game_title, sections)
+
+        # Если заметок слишком много для одного reduce - сводим их группами, пока не влезут
+        while sum(len(n) for n in notes) > REDUCE_MAX_CHARS and len(notes) > 1:
+            groups, group, group_len = [], [], 0
+            for n in notes:
+                if group and group_len + len(n) > SECTION_MAX_CHARS:
+                    groups.append("\n\n".join(group))
+                    group, group_len = [], 0
+                group.append(n)
+                group_len += len(n)
+            groups.append("\n\n".join(group))
+            notes = self._map(game_title, groups)
+
+        combined = "\n\n".join(f"[Section {i} of {len(notes)} notes]\n{n}" for i, n in enumerate(notes, 1))
+        return self._complete(self.base_prompt, f"Input Game Text (condensed section notes):\n{combined}")
+
+
+# <--- ИЗМЕНЕНИЕ: Добавили 'game_title' для логирования ошибок --->
+def generate_summary_with_openrouter(summarizer, game_title, game_text):
+    """Отправляет текст игры в OpenRouter и получает описание."""
+    try:
+        return summarizer.summarize(game_title, game_text)
     except Exception as e:
         # Возвращаем ошибку, чтобы ее можно было обработать в главном потоке
         return f"API_ERROR: {e}"
 
-def process_game(game_data, client, model_name, base_prompt):
+def process_game(game_data, summarizer):
     """
     Функция-обработчик для одной игры. Вызывается в отдельном потоке.
     """
-    pb_id, title, full_text = game_data
+    pb_id, title = game_data
+    # Текст читаем (и распаковываем) только здесь, в рабочем потоке
+    full_text = storage.load_full_text(storage.thread_connection(DB_FILE), pb_id)
+    if not full_text:
+        return pb_id, title, "API_ERROR: текст игры не найден"
     # <--- ИЗМЕНЕНИЕ: Передаем 'title' в функцию генерации --->
-    summary = generate_summary_with_openrouter(client, model_name, base_prompt, title, full_text)
+    summary = generate_summary_with_openrouter(summarizer, title, full_text)
     return pb_id, title, summary
 
 def main():
     parser = argparse.ArgumentParser(description="Генератор описаний игр с помощью OpenRouter.")
     parser.add_argument('--limit', type=int, default=None, help="Количество игр для обработки за один запуск.")
-    parser.add_argument('--workers', type=int, default=5, help="Количество параллельных потоков для запросов к API.")
+    parser.add_argument('--workers', type=int, default=16, help="Максимальное количество параллельных запросов к API.")
+    parser.add_argument('--initial-workers', type=int, default=4, help="Стартовая конкурентность (дальше подстраивается сама).")
     args = parser.parse_args()
 
     base_prompt = load_prompt()
+    section_prompt = load_prompt(SECTION_PROMPT_FILE)
 
     client = OpenAI(
       base_url="https://openrouter.ai/api/v1",
       api_key=OPENROUTER_API_KEY,
+      max_retries=0, # Повторы делаем сами, с учетом общего ограничителя
     )
 
-    conn = sqlite3.connect(DB_FILE)
+    conn = storage.connect(DB_FILE)
+    ensure_schema(conn)
     cursor = conn.cursor()
 
     query = """
-        SELECT pocketbase_id, title, full_text 
-        FROM games 
-        WHERE full_text IS NOT NULL AND full_text != '' AND (summary IS NULL OR summary = '')
+        SELECT pocketbase_id, title
+        FROM games
+        WHERE source_hash IS NOT NULL AND summary IS NULL
     """
-    
+
     params = ()
     if args.limit:
         query += " LIMIT ?"
@@ -97,42 +478,55 @@ def main():
 
     cursor.execute(query, params)
     games_to_process = cursor.fetchall()
+    conn.close()
 
     if not games_to_process:
         print("Нет игр, требующих генерации описания.")
-        conn.close()
         return
 
     print(f"Найдено {len(games_to_process)} игр для генерации описаний с помощью {GENERATION_MODEL_NAME} через OpenRouter.")
-    print(f"Запускаем обработку в {args.workers} параллельных потоков...")
-    
+    print(f"Адаптивная конкурентность: старт {args.initial_workers}, максимум {args.workers} запросов...")
+
+    limiter = AdaptiveConcurrency(args.initial_workers, args.workers)
+    stats = UsageStats()
+    cache = SectionCache(DB_FILE)
+    writer = SummaryWriter(DB_FILE)
+    writer.start()
+
     success_count = 0
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-        future_to_game = {
-            executor.submit(process_game, game, client, GENERATION_MODEL_NAME, base_prompt): game
-            for game in games_to_process
-        }
-        
-        progress_bar = tqdm(concurrent.futures.as_completed(future_to_game), total=len(games_to_process), desc="Генерация описаний")
-        
-        for future in progress_bar:
-            pb_id, title, summary = future.result()
-            
-            if summary and not summary.startswith("API_ERROR:"):
-                cursor.execute(
-                    "UPDATE games SET summary = ?, last_indexed_at = NULL WHERE pocketbase_id = ?",
-                    (summary, pb_id)
-                )
-                conn.commit()
-                success_count += 1
-            else:
-                tqdm.write(f"\n[FAIL] Не удалось сгенерировать описание для '{title}'. Ошибка: {summary}")
 
-    conn.close()
+    try:
+        # Отдельный пул для секций: потоки игр только ждут свои секции, поэтому взаимоблокировки нет
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as section_executor:
+            summarizer = Summarizer(client, GENERATION_MODEL_NAME, base_prompt, section_prompt,
+                                    limiter, stats, cache, section_executor)
+            future_to_game = {
+                executor.submit(process_game, game, summarizer): game
+                for game in games_to_process
+            }
+
+            progress_bar = tqdm(concurrent.futures.as_completed(future_to_game), total=len(games_to_process), desc="Генерация описаний")
+
+            for future in progress_bar:
+                pb_id, title, summary = future.result()
+
+                if summary and not summary.startswith("API_ERROR:"):
+                    writer.put(pb_id, summary)
+                    success_count += 1
+                else:
+                    tqdm.write(f"\n[FAIL] Не удалось сгенерировать описание для '{title}'. Ошибка: {summary}")
+                progress_bar.set_postfix(stats.postfix(limiter))
+    finally:
+        # Дописываем в БД все, что успели получить, даже при Ctrl+C
+        writer.close()
+        cache.close()
+
     print(f"\nЗавершено. Успешно сгенерировано описаний: {success_count}/{len(games_to_process)}.")
+    print(f"Токенов: {stats.prompt_tokens} вход / {stats.completion_tokens} выход, стоимость ~${stats.cost:.3f}, повторов: {stats.retries}.")
+    print(f"Кэш секций: {cache.hits} попаданий, {cache.misses} промахов.")
     if success_count > 0:
         print("Теперь запустите 'python indexer.py', чтобы добавить новые описания в поисковый индекс.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,47 @@
+# index_build.py
+# Отметка сборки индекса. Индексатор подменяет файлы индекса по одному (каждый - атомарно),
+# а последним пишет index_build.json: номер сборки и для каждого файла его inode, размер и
+# время изменения. Сервер загружает файлы, только если все они совпадают с отметкой,
+# и сверяет их еще раз после открытия. Так ни сбой индексатора посреди подмены, ни перезагрузка
+# в этот момент не соберут новый chunk_store.bin со старым games.index.
+import os
+import json
+
+BUILD_FILE = "index_build.json"
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+def write(paths, build, chunks, path=BUILD_FILE):
+    """Пишет отметку для уже подмененных файлов paths (атомарно, через временный файл)."""
+    data = {"build": build, "chunks": chunks, "files": {p: _signature(p) for p in paths if os.path.exists(p)}}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+    return data
+
+def read(path=BUILD_FILE):
+    """Отметка сборки или None (индекс собран до появления отметок)."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def mismatched(build):
+    """Файлы, которые отсутствуют или подменены после записи отметки build."""
+    stale = []
+    for path, signature in build["files"].items():
+        try:
+            if _signature(path) != signature:
+                stale.append(path)
+        except FileNotFoundError:
+            stale.append(path)
+    return stale
+
+def stamp_mtime(index_file, path=BUILD_FILE):
+    """Что отслеживать для перезагрузки: отметку сборки, а для старых индексов - сам файл индекса."""
+    target = path if os.path.exists(path) else index_file
+    return os.path.getmtime(target) if os.path.exists(target) else None
@@ -6,9 +6,18 @@ import faiss
 import google.generativeai as genai
 import sqlite3
 import time
+import hashlib
 from dotenv import load_dotenv
 from tqdm import tqdm
 from datetime import datetime
+import storage
+from create_database import ensure_schema
+from chunk_store import write_store, game_order
+import lexical
+import similar
+import vector_store
+import shards
+import index_build
 
 # --- Конфигурация ---
 load_dotenv()
@@ -16,11 +25,19 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("Не найден GOOGLE_API_KEY в .env файле")
 
-genai.configure(api_key=GOOGLE_API_KEY)
+# GEMINI_API_ENDPOINT - другой адрес API эмбеддингов, например локальная заглушка mock_gemini.py
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+if GEMINI_API_ENDPOINT:
+    genai.configure(api_key=GOOGLE_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+else:
+    genai.configure(api_key=GOOGLE_API_KEY)
 # Для эмбеддингов используем ту же модель
 EMBEDDING_MODEL_NAME = "gemini-embedding-001"
 
-OUTPUT_DIMENSION = 256
+# Matryoshka: у Gemini запрашиваем полную размерность (она хранится на диске в float16),
+# в индекс Faiss идет только нормированный префикс (см. vector_store.py)
+FULL_DIMENSION = vector_store.FULL_DIMENSION
+COARSE_DIMENSION = vector_store.COARSE_DIMENSION
 BATCH_SIZE = 100 # Можно увеличить для embedding-001
 MAX_RETRIES = 3
 API_REQUEST_DELAY = 3 # Пауза в секундах между API запросами для избежания rate limit
@@ -29,6 +46,100 @@ API_REQUEST_DELAY = 3 # Пауза в секундах между API запро
 DB_FILE = "games.db"
 OUTPUT_INDEX_FILE = "games.index"
 OUTPUT_MAPPING_FILE = "chunk_map.json"
+OUTPUT_STORE_FILE = "chunk_store.bin"  # Та же карта в виде, который сервер отображает в память
+OUTPUT_LEXICAL_FILE = lexical.LEXICAL_FILE  # BM25 (FTS5) - запасной путь сервера, когда Gemini не отвечает
+OUTPUT_GAME_INDEX_FILE = "games_level.index"  # Несколько векторов на игру - первая стадия поиска
+OUTPUT_VECTORS_FILE = vector_store.VECTORS_FILE  # Полные векторы чанков (float16) для точной переоценки
+OUTPUT_SHARDS_DIR = shards.SHARDS_DIR
+
+# Число шардов (shards.py): при INDEX_SHARDS > 1 чанки дополнительно раскладываются по играм
+# в shards/shard_N для воркеров shard_worker.py
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+
+# Индекс уровня игр: вектор описания и до GAME_TEXT_CENTROIDS центроидов текста
+# (чанки текста делятся на части подряд, каждая часть усредняется)
+GAME_TEXT_CENTROIDS = 3
+
+# Кэш эмбеддингов по хэшу текста чанка: при пересборке индекса к API уходят только новые чанки
+EMBEDDING_CACHE_TABLE = "chunk_embeddings"
+
+def ensure_embedding_cache(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {EMBEDDING_CACHE_TABLE} (
+            text_hash TEXT PRIMARY KEY,
+            vector BLOB NOT NULL
+        )
+    """)
+    conn.commit()
+
+def _embedding_key(text):
+    # Модель и размерность входят в ключ: при их смене кэш не смешивается
+    return hashlib.sha1(f"{EMBEDDING_MODEL_NAME}:{FULL_DIMENSION}:{text}".encode('utf-8')).hexdigest()
+
+def generate_embeddings_cached(conn, texts):
+    """
+    Как generate_embeddings_in_batches, но сначала берет готовые векторы из кэша.
+    Возвращает (список векторов или None, индексы успешных) в том же формате.
+    """
+    keys = [_embedding_key(t) for t in texts]
+    cached = {}
+    for i in range(0, len(keys), 500):
+        part = keys[i:i + 500]
+        placeholders = ','.join('?' * len(part))
+        for key, blob in conn.execute(
+            f"SELECT text_hash, vector FROM {EMBEDDING_CACHE_TABLE} WHERE text_hash IN ({placeholders})", part
+        ):
+            cached[key] = np.frombuffer(blob, dtype='float32').tolist()
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    print(f"Эмбеддинги: {len(texts) - len(missing)} из кэша, {len(missing)} запрашиваем у API.")
+    new_embeddings, new_indices = generate_embeddings_in_batches([texts[i] for i in missing])
+
+    with conn:
+        for local_idx in new_indices:
+            emb = new_embeddings[local_idx]
+            if emb is None: continue
+            key = keys[missing[local_idx]]
+            cached[key] = emb
+            conn.execute(
+                f"INSERT OR REPLACE INTO {EMBEDDING_CACHE_TABLE} (text_hash, vector) VALUES (?, ?)",
+                (key, np.asarray(emb, dtype='float32').tobytes())
+            )
+
+    all_embeddings = [cached.get(key) for key in keys]
+    successful_indices = [i for i, emb in enumerate(all_embeddings) if emb is not None]
+    return all_embeddings, successful_indices
+
+def _replace_file(write_fn, path):
+    """Пишет файл во временный и атомарно подменяет: сервер никогда не увидит половину индекса."""
+    tmp_path = f"{path}.tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+def build_game_level_index(chunks, embeddings):
+    """
+    Индекс с несколькими векторами на игру; id вектора - номер игры в chunk_store.
+    chunks идут в порядке векторов, и чанки одной игры лежат подряд.
+    """
+    game_pos = {game_id: i for i, game_id in enumerate(game_order(chunks))}
+    per_game = {}
+    for i, chunk in enumerate(chunks):
+        per_game.setdefault(chunk["game_id"], {"summary": [], "text": []})[chunk["type"]].append(i)
+
+    vectors, ids = [], []
+    for game_id, rows in per_game.items():
+        group_vectors = [embeddings[i] for i in rows["summary"]]
+        for part in np.array_split(np.array(rows["text"], dtype=np.int64), min(GAME_TEXT_CENTROIDS, len(rows["text"])) or 1):
+            if len(part):
+                group_vectors.append(embeddings[part].mean(axis=0))
+        vectors.extend(group_vectors)
+        ids.extend([game_pos[game_id]] * len(group_vectors))
+
+    vectors_np = np.array(vectors, dtype='float32')
+    faiss.normalize_L2(vectors_np)
+    index = faiss.IndexIDMap(faiss.IndexFlatIP(embeddings.shape[1]))
+    index.add_with_ids(vectors_np, np.array(ids, dtype='int64'))
+    return index
 
 def chunk_raw_text(text, chunk_size=500, overlap=50):
     """Разбивает сырой текст игры на чанки."""
@@ -62,7 +173,7 @@ def generate_embeddings_in_batches(texts):
                     model=f"models/{EMBEDDING_MODEL_NAME}",
                     content=batch_texts,
                     task_type="RETRIEVAL_DOCUMENT",
-                    output_dimensionality=OUTPUT_DIMENSION
+                    output_dimensionality=FULL_DIMENSION
                 )
                 # Gemini может вернуть None для некоторых текстов в батче, если сработают фильтры безопасности
                 embeddings = result.get('embedding', [])
@@ -93,51 +204,53 @@ def generate_embeddings_in_batches(texts):
 
     return all_embeddings, successful_indices
 
-def main():
-    # Мы всегда пересоздаем индекс целиком для простоты и надежности (Faiss FlatIP быстрый)
+def build_index(db_file=DB_FILE):
+    """
+    Пересобирает индекс целиком (Faiss FlatIP быстрый), но эмбеддинги для уже
+    встречавшихся чанков берутся из кэша. Возвращает множество проиндексированных игр.
+    """
     print("Подготовка к полной переиндексации...")
 
-    conn = sqlite3.connect(DB_FILE)
+    conn = storage.connect(db_file)
     conn.row_factory = sqlite3.Row
+    ensure_schema(conn)
     cursor = conn.cursor()
+    ensure_embedding_cache(conn)
 
     # Берем ВСЕ игры, у которых есть хоть что-то (текст или саммари)
-    cursor.execute("""
-        SELECT pocketbase_id, title, full_text, summary 
-        FROM games 
-        WHERE (full_text IS NOT NULL AND full_text != '') OR (summary IS NOT NULL AND summary != '')
-    """)
-    all_games = cursor.fetchall()
+    games_filter = "WHERE g.source_hash IS NOT NULL OR g.summary IS NOT NULL"
+    games_count = conn.execute(f"SELECT COUNT(*) FROM games g {games_filter}").fetchone()[0]
 
-    if not all_games:
+    if not games_count:
         print("В базе нет данных для индексации.")
         conn.close()
-        return
+        return set()
 
-    print(f"Загружено {len(all_games)} игр. Подготовка чанков...")
+    print(f"Найдено {games_count} игр. Подготовка чанков...")
 
     texts_to_embed = []
     temp_chunk_map = [] # Список словарей метаданных
+    lexical_rows = [] # (game_id, тип, название, текст) для BM25 - без "обогащающих" префиксов
 
-    for game in tqdm(all_games, desc="Чанкинг"):
-        game_id = game['pocketbase_id']
-        game_title = game['title']
-        
+    # Тексты читаются и распаковываются по одному, а не все сразу в память
+    games = storage.iter_full_texts(conn, games_filter)
+    for game_id, game_title, summary, full_text in tqdm(games, total=games_count, desc="Чанкинг"):
         # 1. Обработка SUMMARY (если есть)
-        if game['summary']:
+        if summary:
             # Описание добавляем как один большой, важный чанк.
             # Добавляем контекст в сам текст для лучшей семантики.
-            enriched_summary = f"Summary/Description of CYOA game '{game_title}': {game['summary']}"
+            enriched_summary = f"Summary/Description of CYOA game '{game_title}': {summary}"
             texts_to_embed.append(enriched_summary)
             temp_chunk_map.append({
                 "game_id": game_id,
                 "type": "summary", # Метка типа
-                "text_snippet": game['summary'][:300] + "..." # Для дебага в JSON
+                "text_snippet": summary[:300] + "..." # Для дебага в JSON
             })
+            lexical_rows.append((game_id, "summary", game_title, summary))
 
         # 2. Обработка FULL_TEXT (если есть)
-        if game['full_text']:
-            raw_chunks = chunk_raw_text(game['full_text'])
+        if full_text:
+            raw_chunks = chunk_raw_text(full_text)
             for chunk in raw_chunks:
                 enriched_chunk = f"Text excerpt from CYOA game '{game_title}': {chunk}"
                 texts_to_embed.append(enriched_chunk)
@@ -146,16 +259,17 @@ def main():
                     "type": "text", # Метка типа
                     "text_snippet": chunk[:200] + "..."
                 })
+                lexical_rows.append((game_id, "text", game_title, chunk))
 
     print(f"Всего подготовлено {len(texts_to_embed)} чанков (Summary + Text).")
 
     # --- Генерация эмбеддингов ---
-    raw_embeddings, successful_indices = generate_embeddings_in_batches(texts_to_embed)
+    raw_embeddings, successful_indices = generate_embeddings_cached(conn, texts_to_embed)
 
     if not successful_indices:
         print("Не удалось сгенерировать эмбеддинги.")
         conn.close()
-        return
+        return set()
 
     # Фильтруем и сопоставляем
     final_embeddings = []
@@ -176,15 +290,42 @@ def main():
     print("Нормализация векторов (L2) для Cosine Similarity...")
     faiss.normalize_L2(embeddings_np)
 
-    print(f"Создание IndexFlatIP для {len(embeddings_np)} векторов...")
-    index = faiss.IndexFlatIP(OUTPUT_DIMENSION)
-    index.add(embeddings_np)
+    # В индекс - префикс размерности COARSE_DIMENSION, полные векторы - в chunk_vectors.npy
+    coarse_np = vector_store.truncate(embeddings_np, COARSE_DIMENSION)
+    print(f"Создание IndexFlatIP ({COARSE_DIMENSION}-d) для {len(coarse_np)} векторов...")
+    index = faiss.IndexFlatIP(COARSE_DIMENSION)
+    index.add(coarse_np)
 
     # --- Сохранение результатов ---
     print("Сохранение индекса и карты...")
-    faiss.write_index(index, OUTPUT_INDEX_FILE)
-    with open(OUTPUT_MAPPING_FILE, 'w', encoding='utf-8') as f:
-        json.dump(final_chunk_map, f, ensure_ascii=False, indent=2)
+    def write_mapping(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(final_chunk_map, f, ensure_ascii=False, indent=2)
+    chunks_in_order = [final_chunk_map[i] for i in range(len(final_chunk_map))]
+    game_index = build_game_level_index(chunks_in_order, coarse_np)
+    print(f"Индекс уровня игр: {game_index.ntotal} векторов.")
+    # Каждый файл подменяется атомарно, но по отдельности: сервер загружает их только вместе
+    # с отметкой сборки (index_build.py), которая пишется последней
+    build = datetime.now().isoformat()
+    _replace_file(write_mapping, OUTPUT_MAPPING_FILE)
+    _replace_file(lambda path: write_store(path, chunks_in_order), OUTPUT_STORE_FILE)
+    _replace_file(lambda path: faiss.write_index(game_index, path), OUTPUT_GAME_INDEX_FILE)
+    _replace_file(lambda path: vector_store.write_vectors(path, embeddings_np), OUTPUT_VECTORS_FILE)
+    if INDEX_SHARDS > 1:
+        sizes = shards.write_shards(OUTPUT_SHARDS_DIR, [chunk["game_id"] for chunk in chunks_in_order],
+                                    embeddings_np, coarse_np, INDEX_SHARDS, build)
+        print(f"Шарды: {INDEX_SHARDS}, чанков в шардах: {sizes}.")
+    # Лексический индекс строится по всем чанкам, включая те, для которых не удалось получить эмбеддинг
+    _replace_file(lambda path: lexical.build(path, lexical_rows), OUTPUT_LEXICAL_FILE)
+    _replace_file(lambda path: faiss.write_index(index, path), OUTPUT_INDEX_FILE)
+    index_build.write([OUTPUT_INDEX_FILE, OUTPUT_STORE_FILE, OUTPUT_GAME_INDEX_FILE, OUTPUT_VECTORS_FILE,
+                       OUTPUT_LEXICAL_FILE], build, index.ntotal)
+
+    # --- Похожие игры: векторы игр из векторов чанков и готовые списки соседей ---
+    print("Обновление списков похожих игр...")
+    vectors = similar.game_vectors(chunks_in_order, embeddings_np)
+    recomputed, total = similar.update_neighbors(conn, vectors)
+    print(f"Похожие игры: пересчитано {recomputed} списков из {total}.")
 
     # --- Обновление статусов в БД ---
     print("Обновление статуса индексации в базе данных...")
@@ -202,6 +343,10 @@ def main():
 
     conn.close()
     print("\n--- Индексация полностью завершена ---")
+    return processed_game_ids
+
+def main():
+    build_index()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
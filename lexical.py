@@ -0,0 +1,105 @@
+# lexical.py
+# Лексический поиск (BM25) по описаниям и текстам игр: SQLite FTS5 в отдельном файле lexical.db.
+# Индексатор строит его вместе с индексом Faiss. Сервер отвечает из него, когда Gemini
+# не уложился в бюджет задержки или недоступен, и смешивает его с семантической выдачей,
+# когда эмбеддинг пришел вовремя. Запрос к FTS5 занимает миллисекунды и не требует сети.
+# Токенизатор porter: "dragons" находит "dragon" (тексты игр почти все на английском).
+import os
+import re
+import sqlite3
+import threading
+
+LEXICAL_FILE = "lexical.db"
+CHUNK_TYPES = ("summary", "text")
+SUMMARY_RANK_WEIGHT = 2.0   # Вес колонки title+summary относительно текста в bm25()
+CHUNK_CANDIDATES = 200      # Сколько лучших чанков брать перед агрегацией по играм
+MAX_QUERY_TERMS = 16
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def build(path, rows):
+    """
+    rows - итерируемое из (game_id, chunk_type, title, text). Описание индексируется вместе
+    с названием, чанки текста - без него. Сами тексты в lexical.db не хранятся (contentless FTS5),
+    только инвертированный индекс и соответствие rowid -> игра.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(
+            "CREATE VIRTUAL TABLE chunks_fts USING fts5("
+            "head, body, content='', tokenize='porter unicode61 remove_diacritics 2')"
+        )
+        conn.execute("CREATE TABLE chunks (id INTEGER PRIMARY KEY, game_id TEXT NOT NULL, type INTEGER NOT NULL)")
+        count = 0
+        with conn:
+            for rowid, (game_id, chunk_type, title, text) in enumerate(rows, start=1):
+                head = f"{title} {text}" if chunk_type == "summary" else ""
+                body = "" if chunk_type == "summary" else text
+                conn.execute("INSERT INTO chunks_fts (rowid, head, body) VALUES (?, ?, ?)", (rowid, head, body))
+                conn.execute("INSERT INTO chunks (id, game_id, type) VALUES (?, ?, ?)",
+                             (rowid, game_id, CHUNK_TYPES.index(chunk_type)))
+                count += 1
+            conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('optimize')")
+        return count
+    finally:
+        conn.close()
+
+def match_expression(query):
+    """Запрос пользователя -> выражение FTS5: термы в кавычках через OR (синтаксис FTS5 не пропускаем)."""
+    terms = []
+    for term in _TERM.findall(query.casefold()):
+        if len(term) > 1 and term not in terms:
+            terms.append(term)
+    return " OR ".join(f'"{term}"' for term in terms[:MAX_QUERY_TERMS])
+
+
+class LexicalIndex:
+    """Поиск по lexical.db; у каждого потока свое соединение только для чтения."""
+    def __init__(self, path=LEXICAL_FILE):
+        self.path = path
+        self._local = threading.local()
+        self.count = self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def __len__(self):
+        return self.count
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        return conn
+
+    def search(self, query, chunk_type=None, limit=20):
+        """
+        Лучшие игры по BM25: [(game_id, score, match_type)], score > 0, больше - лучше.
+        Оценка игры - оценка ее лучшего чанка; chunk_type ограничивает поиск описаниями или текстами.
+        """
+        expression = match_expression(query)
+        if not expression:
+            return []
+        # Тип чанка фильтруется до LIMIT: иначе 200 лучших текстовых чанков вытесняли бы все описания
+        type_filter, params = "", [expression]
+        if chunk_type:
+            type_filter = "AND c.type = ?"
+            params.append(CHUNK_TYPES.index(chunk_type))
+        rows = self._conn().execute(
+            f"""
+            SELECT c.game_id, c.type, -chunks_fts.rank
+            FROM chunks_fts
+            JOIN chunks c ON c.id = chunks_fts.rowid
+            WHERE chunks_fts MATCH ? AND chunks_fts.rank MATCH 'bm25({SUMMARY_RANK_WEIGHT}, 1.0)' {type_filter}
+            ORDER BY chunks_fts.rank LIMIT ?
+            """,
+            (*params, CHUNK_CANDIDATES)
+        ).fetchall()
+        games = {}
+        for game_id, type_code, score in rows:
+            if game_id not in games:
+                games[game_id] = (game_id, score, CHUNK_TYPES[type_code])
+                if len(games) >= limit:
+                    break
+        return list(games.values())
@@ -0,0 +1,348 @@
+# load_test.py
+# Нагрузочный тест сервера по HTTP: смесь запросов к /api/semantic-search, /games и /stats
+# с заданной параллельностью или интенсивностью потока. Запросы поиска - из журнала
+# user_queries.jsonl (в том порядке и с теми повторами, что были у пользователей) или
+# сгенерированные. Gemini на время теста заменяется заглушкой mock_gemini.py (GEMINI_API_ENDPOINT).
+#
+#   python mock_gemini.py --latency-ms 150 --jitter-ms 50 --error-rate 0.02
+#   GEMINI_API_ENDPOINT=http://127.0.0.1:8300 GOOGLE_API_KEY=mock uvicorn main:app --port 8100
+#   python load_test.py --concurrency 32 --duration 60 --out before.json
+#   python load_test.py --profile 20:30,50:30,100:30 --replay --out after.json --compare before.json
+#
+# Замкнутый цикл (--concurrency): N клиентов, каждый шлет следующий запрос после ответа на
+# предыдущий. Открытый цикл (--rate или --profile "интенсивность:секунды,..."): запросы приходят
+# пуассоновским потоком независимо от ответов, задержка считается от запланированного момента
+# отправки - перегрузка видна как рост задержки, а не прячется за замедлившимися клиентами.
+#
+# Отчет (JSON, одинаковая структура у всех прогонов): по каждому эндпоинту и в сумме -
+# пропускная способность, p50/p95/p99 задержки, доля ошибок с разбивкой по статусам; для
+# поиска - кем обслужен ответ (semantic/lexical) и сколько ответов неполные; по ступеням
+# профиля; статистика батчинга и кэшей сервера и счетчики заглушки Gemini.
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter, deque
+from datetime import datetime
+import numpy as np
+import httpx
+from query_analytics import QUERY_LOG_FILE, log_files, iter_entries
+
+ENDPOINTS = ("search", "games", "stats")
+DEFAULT_MIX = "search=8,games=1.5,stats=0.5"
+DEFAULT_URL = "http://127.0.0.1:8100"
+CURSOR_POOL = 200        # Сколько курсоров /games помнить для перехода на следующие страницы
+NEXT_PAGE_SHARE = 0.5    # Доля запросов /games к следующей странице, а не к первой
+# Сгенерированные запросы: сочетания дают сотни различных строк, чтобы не все попадали в кэш ответов
+QUERY_THEMES = ("magic school", "space pirates", "monster girls", "isekai", "superpowers", "post apocalypse",
+                "cultivation", "dragons", "time travel", "mecha pilot", "vampires", "demon lord",
+                "survival", "kingdom building", "cyberpunk", "fantasy romance", "dungeon", "wizard tower")
+QUERY_MODIFIERS = ("", "dark", "comedy", "short", "gauntlet", "with companions", "power fantasy",
+                   "drawbacks", "modern", "medieval", "jumpchain", "builder")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"неизвестный эндпоинт '{name.strip()}' (есть: {', '.join(ENDPOINTS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def parse_profile(text):
+    """'20:30,50:30' -> [(20.0, 30.0), (50.0, 30.0)]: интенсивность (запросов/с) и длительность ступени."""
+    stages = []
+    for part in text.split(","):
+        rate, _, seconds = part.partition(":")
+        stages.append((float(rate), float(seconds)))
+    return stages
+
+def replay_queries(log_path, since=None):
+    """Запросы из журнала в исходном порядке: (q, mode, фильтры) - повторы сохраняются."""
+    queries = []
+    for entry in iter_entries(log_files(log_path, since)):
+        query = str(entry.get("query", "")).strip()
+        if len(query) >= 2:
+            queries.append((query, entry.get("mode", "mixed"), tuple(entry.get("filters", ()))))
+    return queries
+
+def generated_queries():
+    return [(f"{modifier} {theme}".strip(), "mixed", ()) for theme in QUERY_THEMES for modifier in QUERY_MODIFIERS]
+
+def search_params(query):
+    text, mode, filters = query
+    params = {"q": text, "mode": mode}
+    for name in filters:
+        if name == "summary":
+            params["has_summary"] = "true"
+        else:
+            params["kind"] = name
+    return params
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {**{f"p{p}": None for p in points}, "mean": None, "max": None}
+    result = {f"p{p}": round(float(np.percentile(values, p)), 2) for p in points}
+    result.update(mean=round(float(np.mean(values)), 2), max=round(float(np.max(values)), 2))
+    return result
+
+
+class Recorder:
+    """Результаты запросов: задержки и статусы по эндпоинтам, плюс отметка ступени профиля."""
+    def __init__(self):
+        self.samples = []  # (эндпоинт, ступень, статус, задержка в мс)
+        self.served_by = Counter()
+        self.partial = 0
+        self.recording = True
+
+    def record(self, endpoint, stage, status, latency_ms):
+        if self.recording:
+            self.samples.append((endpoint, stage, status, latency_ms))
+
+    def summary(self, samples, seconds):
+        statuses = Counter(str(status) for _, _, status, _ in samples)
+        errors = {status: count for status, count in statuses.items() if not status.startswith(("2", "3"))}
+        ok_latencies = [latency for _, _, status, latency in samples if isinstance(status, int) and status < 400]
+        return {
+            "requests": len(samples),
+            "ok": len(ok_latencies),
+            "errors": dict(sorted(errors.items())),
+            "error_rate": round(sum(errors.values()) / len(samples), 4) if samples else None,
+            "throughput_rps": round(len(ok_latencies) / seconds, 2) if seconds else None,
+            "latency_ms": percentiles(ok_latencies),
+        }
+
+
+class LoadTest:
+    def __init__(self, client, queries, mix, seed, timeout):
+        self.client = client
+        self.queries = queries
+        self.endpoints = list(mix)
+        self.weights = list(mix.values())
+        self.random = random.Random(seed)
+        self.query_cycle = itertools.cycle(queries)
+        self.cursors = deque(maxlen=CURSOR_POOL)
+        self.timeout = timeout
+        self.recorder = Recorder()
+        self.in_flight = 0
+
+    def next_request(self):
+        endpoint = self.random.choices(self.endpoints, self.weights)[0]
+        if endpoint == "search":
+            return endpoint, "/api/semantic-search", search_params(next(self.query_cycle))
+        if endpoint == "games":
+            if self.cursors and self.random.random() < NEXT_PAGE_SHARE:
+                return endpoint, "/games", {"cursor": self.random.choice(self.cursors)}
+            return endpoint, "/games", {}
+        return endpoint, "/stats", {}
+
+    async def issue(self, stage, scheduled=None):
+        endpoint, path, params = self.next_request()
+        started = scheduled if scheduled is not None else time.perf_counter()
+        self.in_flight += 1
+        try:
+            response = await self.client.get(path, params=params, timeout=self.timeout)
+            status = response.status_code
+            if status == 200 and endpoint in ("search", "games"):
+                payload = response.json()
+                if endpoint == "games" and payload.get("next_cursor"):
+                    self.cursors.append(payload["next_cursor"])
+                elif endpoint == "search" and self.recorder.recording:
+                    self.recorder.served_by[payload.get("served_by", "semantic")] += 1
+                    self.recorder.partial += bool(payload.get("partial"))
+        except httpx.TimeoutException:
+            status = "timeout"
+        except httpx.HTTPError as e:
+            status = e.__class__.__name__
+        finally:
+            self.in_flight -= 1
+        self.recorder.record(endpoint, stage, status, (time.perf_counter() - started) * 1000)
+
+    async def closed_loop(self, concurrency, duration):
+        deadline = time.perf_counter() + duration
+
+        async def client_loop():
+            while time.perf_counter() < deadline:
+                await self.issue(0)
+
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+
+    async def open_loop(self, stages, max_in_flight):
+        """Пуассоновский поток по ступеням. Сверх max_in_flight запросы не шлются и считаются как 'dropped'."""
+        tasks = set()
+        scheduled = time.perf_counter()
+        for number, (rate, seconds) in enumerate(stages):
+            stage_end = scheduled + seconds
+            while rate > 0:
+                scheduled += self.random.expovariate(rate)
+                if scheduled >= stage_end:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.in_flight >= max_in_flight:
+                    self.recorder.record(self.next_request()[0], number, "dropped", 0.0)
+                    continue
+                task = asyncio.create_task(self.issue(number, scheduled))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            scheduled = stage_end
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+
+async def fetch_json(client, url):
+    try:
+        response = await client.get(url, timeout=10)
+        return response.json() if response.status_code == 200 else None
+    except (httpx.HTTPError, ValueError):
+        return None
+
+def counter_delta(before, after):
+    if before is None or after is None:
+        return after
+    return {name: value - before.get(name, 0) for name, value in after.items()}
+
+async def run(args):
+    queries = replay_queries(args.log, args.since) if args.replay else generated_queries()
+    if not queries:
+        raise SystemExit(f"В {args.log} нет запросов для воспроизведения.")
+    if not args.replay:
+        random.Random(args.seed).shuffle(queries)
+    stages = parse_profile(args.profile) if args.profile else [(args.rate, args.duration)] if args.rate else None
+    connections = args.concurrency if stages is None else args.max_in_flight
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+
+    async with httpx.AsyncClient(base_url=args.url.rstrip("/"), limits=limits) as client:
+        if await fetch_json(client, "/stats") is None:
+            raise SystemExit(f"Сервер {args.url} не отвечает на /stats.")
+        mock_before = await fetch_json(client, f"{args.mock_url.rstrip('/')}/stats") if args.mock_url else None
+        test = LoadTest(client, queries, args.mix, args.seed, args.timeout)
+        if args.warmup > 0:
+            test.recorder.recording = False
+            await test.closed_loop(min(args.concurrency, 8), args.warmup)
+            test.recorder.recording = True
+        started = time.perf_counter()
+        started_at = datetime.now().isoformat(timespec="seconds")
+        if stages is None:
+            await test.closed_loop(args.concurrency, args.duration)
+        else:
+            await test.open_loop(stages, args.max_in_flight)
+        elapsed = time.perf_counter() - started
+        server = {"batching": await fetch_json(client, "/stats/batching"),
+                  "cache": await fetch_json(client, "/stats/cache")}
+        mock_after = await fetch_json(client, f"{args.mock_url.rstrip('/')}/stats") if args.mock_url else None
+
+    recorder = test.recorder
+    samples = recorder.samples
+    report = {
+        "started_at": started_at,
+        "url": args.url,
+        "config": {
+            "mode": "closed" if stages is None else "open",
+            "concurrency": args.concurrency if stages is None else None,
+            "profile": [{"rate": rate, "seconds": seconds} for rate, seconds in stages] if stages else None,
+            "max_in_flight": args.max_in_flight if stages else None,
+            "duration_seconds": args.duration if stages is None else sum(seconds for _, seconds in stages),
+            "mix": args.mix,
+            "queries": {"source": args.log if args.replay else "generated", "count": len(queries),
+                        "distinct": len(set(queries))},
+            "timeout_seconds": args.timeout,
+            "seed": args.seed,
+        },
+        "elapsed_seconds": round(elapsed, 2),
+        "total": recorder.summary(samples, elapsed),
+        "endpoints": {endpoint: recorder.summary([s for s in samples if s[0] == endpoint], elapsed)
+                      for endpoint in ENDPOINTS if endpoint in args.mix},
+        "search": {"served_by": dict(recorder.served_by), "partial": recorder.partial},
+        "stages": [dict(rate=rate, seconds=seconds, **recorder.summary([s for s in samples if s[1] == number], seconds))
+                   for number, (rate, seconds) in enumerate(stages)] if stages else None,
+        "server": server,
+        "mock_gemini": counter_delta(mock_before, mock_after),
+    }
+    return report
+
+def print_report(report):
+    config = report["config"]
+    load = (f"{config['concurrency']} параллельных клиентов" if config["mode"] == "closed"
+            else "поток " + ", ".join(f"{s['rate']:g}/с x {s['seconds']:g} с" for s in config["profile"]))
+    print(f"\n{report['url']}: {load}, {report['elapsed_seconds']} с, запросы: {config['queries']['source']} "
+          f"({config['queries']['distinct']} различных)")
+    print(f"{'эндпоинт':<10} {'запросов':>9} {'ok/с':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ошибки':>8}  статусы")
+    rows = list(report["endpoints"].items()) + [("всего", report["total"])]
+    for name, row in rows:
+        latency = row["latency_ms"]
+        cells = [f"{latency[p]:>8.1f}" if latency[p] is not None else f"{'-':>8}" for p in ("p50", "p95", "p99")]
+        error_rate = f"{row['error_rate']:.2%}" if row["error_rate"] is not None else "-"
+        statuses = ", ".join(f"{status}: {count}" for status, count in row["errors"].items())
+        print(f"{name:<10} {row['requests']:>9} {row['throughput_rps'] or 0:>8.1f} {' '.join(cells)} {error_rate:>8}  {statuses}")
+    for stage in report["stages"] or ():
+        p95 = stage["latency_ms"]["p95"]
+        print(f"  ступень {stage['rate']:g}/с: {stage['throughput_rps'] or 0:.1f} ok/с, "
+              f"p95 {p95 if p95 is not None else '-'} мс, ошибки {stage['error_rate'] or 0:.2%}")
+    if report["search"]["served_by"]:
+        print(f"Поиск обслужен: {report['search']['served_by']}, неполных ответов: {report['search']['partial']}")
+    batching = report["server"]["batching"] or {}
+    for name, stats in batching.items():
+        if stats:
+            print(f"Батчинг {name}: пачек {stats['batches']}, средний размер {stats['mean_batch_size']}")
+    if report["mock_gemini"]:
+        print(f"Заглушка Gemini: {report['mock_gemini']}")
+
+def print_comparison(report, previous):
+    """Разница с прошлым отчетом (например, до и после изменения) по каждому эндпоинту."""
+    print(f"\nСравнение с прогоном {previous.get('started_at')}:")
+    print(f"{'эндпоинт':<10} {'ok/с':>16} {'p50':>18} {'p95':>18} {'p99':>18} {'ошибки':>16}")
+
+    def cell(old, new, width, percent=False):
+        if old is None or new is None:
+            return f"{'-':>{width}}"
+        text = f"{old:.2%} -> {new:.2%}" if percent else f"{old:.1f} -> {new:.1f}"
+        return f"{text:>{width}}"
+
+    names = [name for name in report["endpoints"] if name in previous.get("endpoints", {})]
+    for name in names + ["total"]:
+        new = report["total"] if name == "total" else report["endpoints"][name]
+        old = previous["total"] if name == "total" else previous["endpoints"][name]
+        latency = [cell(old["latency_ms"][p], new["latency_ms"][p], 18) for p in ("p50", "p95", "p99")]
+        print(f"{'всего' if name == 'total' else name:<10} {cell(old['throughput_rps'], new['throughput_rps'], 16)} "
+              f"{' '.join(latency)} {cell(old['error_rate'], new['error_rate'], 16, percent=True)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера поиска по HTTP.")
+    parser.add_argument('--url', default=DEFAULT_URL)
+    parser.add_argument('--concurrency', type=int, default=16, help="Клиентов в замкнутом цикле.")
+    parser.add_argument('--duration', type=float, default=30, help="Длительность в секундах (без --profile).")
+    parser.add_argument('--rate', type=float, help="Открытый цикл: запросов в секунду (пуассоновский поток).")
+    parser.add_argument('--profile', help="Открытый цикл по ступеням: 'интенсивность:секунды,...'.")
+    parser.add_argument('--max-in-flight', type=int, default=256, help="Предел одновременных запросов в открытом цикле.")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"Веса эндпоинтов ({DEFAULT_MIX}).")
+    parser.add_argument('--replay', action='store_true', help="Запросы поиска из журнала запросов.")
+    parser.add_argument('--log', default=QUERY_LOG_FILE)
+    parser.add_argument('--since', help="YYYY-MM-DD: только части журнала не старше этой даты.")
+    parser.add_argument('--warmup', type=float, default=0, help="Секунд прогрева, не попадающих в отчет.")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mock-url', help="Адрес mock_gemini.py - его счетчики попадут в отчет.")
+    parser.add_argument('--out', help="Сохранить отчет в JSON.")
+    parser.add_argument('--compare', help="JSON-отчет прошлого прогона для сравнения.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(report, json.load(f))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен в {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,78 @@
 # main.py (Финальная версия с продвинутым ранжированием и ЛОГИРОВАНИЕМ ЗАПРОСОВ)
+import time
+IMPORT_STARTED = time.perf_counter()  # Начало запуска - для журнала фаз (см. startup_phase)
 import os
 import json
 import numpy as np
-import faiss
-import google.generativeai as genai
 import sqlite3
+import storage
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from typing import List, Dict, Any
+from fastapi.responses import FileResponse, JSONResponse
+from typing import Optional
 from enum import Enum
 from collections import defaultdict
 from datetime import datetime # <--- НОВЫЙ ИМПОРТ
 import math
+import base64
+import struct
+import asyncio
 import logging
+from response_cache import CachedResponse, ResponseCache
+from query_log import QueryLogWriter
+from chunk_store import ChunkStore, convert as convert_chunk_map
+from title_index import TitleIndex
+from lexical import LexicalIndex
+from filters import AttributeBitmaps, ATTRIBUTES_SQL
+import similar
+import lexical
+import vector_store
+import index_build
+from shards import ShardCoordinator, read_manifest, SHARDS_DIR
+from micro_batch import MicroBatcher
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import metrics
+from contextlib import contextmanager
 from fastapi.middleware.cors import CORSMiddleware 
 
 # --- Конфигурация ---
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=GOOGLE_API_KEY)
+# GEMINI_API_ENDPOINT - другой адрес API эмбеддингов, например локальная заглушка mock_gemini.py
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+# google.generativeai импортируется больше секунды - это большая часть времени запуска.
+# Импорт идет в отдельном потоке с самого старта, параллельно загрузке индекса, и готовность
+# его не ждет (см. gemini() и import_gemini())
+_genai = None
+_genai_lock = threading.Lock()
+# faiss тоже не нужен, пока индекс не загружен: его импортирует фоновая загрузка (import_faiss)
+faiss = None
 
 EMBEDDING_MODEL_NAME = "gemini-embedding-001"
-OUTPUT_DIMENSION = 256
+OUTPUT_DIMENSION = 256 # Размерность запроса для индекса без chunk_vectors.npy (см. query_dimension)
 DB_FILE = "games.db"
 INDEX_FILE = "games.index"
 MAPPING_FILE = "chunk_map.json"
+CHUNK_STORE_FILE = "chunk_store.bin"
+GAME_INDEX_FILE = "games_level.index"
+VECTORS_FILE = vector_store.VECTORS_FILE
 BASE_GAME_URL = "https://cyoa.cafe/game/"
 
 # --- ПАРАМЕТРЫ ДЛЯ РАНЖИРОВАНИЯ ---
 SUMMARY_WEIGHT = 0.70 
 TEXT_WEIGHT = 0.30    
 DECAY_FACTOR = 0.85 
+TEXT_NORMALIZING_DIVISOR = 5.0
+DEFAULT_K = 200
+DEFAULT_THRESHOLD = 0.40
+RESCORE_FACTOR = 4 # Во сколько раз больше k кандидатов берется из грубого индекса для точной переоценки
+
+# Варианты ранжирования для экспериментов: {"имя": {параметр: значение}}. Вариант выбирается
+# параметром ?variant=имя, отдельные параметры можно переопределить прямо в запросе.
+# Офлайн-сравнение вариантов на реальных запросах - replay_queries.py.
+RANKING_VARIANTS_FILE = "ranking_variants.json"
 
 # --- СЕКЦИЯ: КОНФИГУРАЦИЯ ЛОГИРОВАНИЯ ---
 # --- ИЗМЕНЕНИЕ: Отключаем детальное логгирование для продакшена ---
@@ -64,24 +104,11 @@ else:
         def info(self, msg, *args, **kwargs): pass
     logger = DummyLogger()
 
-# --- НОВЫЙ БЛОК: ЛОГИРОВАНИЕ ЗАПРОСОВ ПОЛЬЗОВАТЕЛЕЙ ДЛЯ АНАЛИТИКИ ---
+# --- ЛОГИРОВАНИЕ ЗАПРОСОВ ПОЛЬЗОВАТЕЛЕЙ ДЛЯ АНАЛИТИКИ ---
+# Запись идет в фоновом потоке пачками, с ротацией файлов (см. query_log.py).
+# Сводки по дням строит query_analytics.py.
 QUERY_LOG_FILE = "user_queries.jsonl"
-
-# Настраиваем специальный логгер для сохранения запросов в виде JSON
-query_logger = logging.getLogger('user_queries')
-query_logger.setLevel(logging.INFO)
-
-# Убираем обработчики по умолчанию, чтобы избежать дублирования вывода в консоль
-query_logger.propagate = False
-
-# Добавляем файловый обработчик, если его еще нет
-if not query_logger.handlers:
-    # Используем mode='a' для дозаписи в файл
-    query_handler = logging.FileHandler(QUERY_LOG_FILE, mode='a', encoding='utf-8')
-    # Форматтер выводит только само сообщение, т.к. мы передаем готовую JSON-строку
-    query_handler.setFormatter(logging.Formatter('%(message)s'))
-    query_logger.addHandler(query_handler)
-# --- КОНЕЦ НОВОГО БЛОКА ---
+query_log = QueryLogWriter(QUERY_LOG_FILE)
 # --- КОНЕЦ СЕКЦИИ ЛОГИРОВАНИЯ ---
 
 
@@ -90,6 +117,10 @@ class SearchMode(str, Enum):
     summary = "summary"
     text = "text"
 
+class GameKind(str, Enum):
+    static = "static"            # Картинки (image_urls)
+    interactive = "interactive"  # Интерактивная CYOA (original_url)
+
 app = FastAPI(title="CYOA Semantic Search API v5 (User Query Logging)")
 
 
@@ -109,93 +140,944 @@ app.add_middleware(
 )
 
 # Глобальные переменные    
+# Индекс и метаданные чанков отображаются в память только для чтения: при запуске
+# с несколькими воркерами (uvicorn --workers N) все процессы делят одни и те же
+# страницы page cache, и каждый новый воркер стартует почти мгновенно.
 faiss_index = None
-chunk_map = {}
+chunk_map = None # ChunkStore: метаданные чанка по id вектора
+index_mtime = None # Время изменения отметки сборки (index_build.json) или, без нее, файла индекса
+# Matryoshka (vector_store.py): в faiss_index - короткий префикс векторов, полные векторы
+# в float16 отображены в память и читаются только для переоценки кандидатов
+chunk_vectors = None
+
+# Двухстадийный поиск: сначала короткий список игр по индексу уровня игр (несколько векторов
+# на игру), затем точная оценка всех чанков только этих игр. Стоимость растет с числом игр,
+# а не чанков, и длинные игры не вытесняют остальные из пула кандидатов.
+TWO_STAGE_SEARCH = os.getenv("TWO_STAGE_SEARCH", "1") == "1"
+
+RANKING_DEFAULTS = {
+    "summary_weight": SUMMARY_WEIGHT,
+    "text_weight": TEXT_WEIGHT,
+    "decay": DECAY_FACTOR,
+    "text_divisor": TEXT_NORMALIZING_DIVISOR,
+    "k": DEFAULT_K,
+    "threshold": DEFAULT_THRESHOLD,
+    "two_stage": TWO_STAGE_SEARCH,
+    "rescore_factor": RESCORE_FACTOR,
+}
+
+def load_ranking_variants(path=RANKING_VARIANTS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        variants = json.load(f)
+    for name, overrides in variants.items():
+        unknown = set(overrides) - set(RANKING_DEFAULTS)
+        if unknown:
+            print(f"WARN: Вариант ранжирования '{name}': неизвестные параметры {sorted(unknown)} пропущены.")
+    return {name: {key: value for key, value in overrides.items() if key in RANKING_DEFAULTS}
+            for name, overrides in variants.items()}
+
+ranking_variants = load_ranking_variants()
+
+def ranking_params(variant=None, **overrides):
+    """Параметры ранжирования: значения по умолчанию, затем вариант, затем параметры запроса."""
+    params = dict(RANKING_DEFAULTS)
+    if variant:
+        if variant not in ranking_variants:
+            raise HTTPException(status_code=400, detail=f"Неизвестный вариант ранжирования: {variant}")
+        params.update(ranking_variants[variant])
+    params.update({key: value for key, value in overrides.items() if value is not None})
+    return params
+GAME_SHORTLIST = 100
+GAME_VECTORS_PER_GAME = 4   # Описание + до 3 центроидов текста (см. indexer.GAME_TEXT_CENTROIDS)
+game_level_index = None
+game_ranges = None # (starts, ends): диапазоны id чанков каждой игры в индексе
+
+# Как часто проверять, не пересобрал ли индексатор/конвейер индекс (сек)
+INDEX_RELOAD_INTERVAL = 30
+
+# --- Запуск ---
+# Сервер принимает соединения сразу, индекс загружается и прогревается в фоне.
+# /health - процесс жив; /ready - индекс загружен и прогрет (для балансировщика и автоскейлинга).
+LOAD_RETRY_SECONDS = float(os.getenv("LOAD_RETRY_SECONDS", "1"))  # Пауза после неудачной загрузки, удваивается до INDEX_RELOAD_INTERVAL
+WARMUP_VECTORS_MB = int(os.getenv("WARMUP_VECTORS_MB", "256"))    # Сколько мегабайт полных векторов прочитать при прогреве
+WARMUP_BLOCK = 1024 * 1024
+# status: starting -> loading -> ready; failed - загрузка не удалась (будет повтор), no_index - файлов нет
+startup_state = {"status": "starting", "attempts": 0, "error": None, "phases_ms": {}}
+
+# --- Каталог /games ---
+GAMES_PAGE_SIZE = 100
+GAMES_PAGE_MAX = 500
+GAMES_CACHE_BYTES = 32 * 1024 * 1024
+GENERATION_CHECK_INTERVAL = 2.0 # Сек: как часто сверять поколение каталога с базой
+games_cache = ResponseCache(GAMES_CACHE_BYTES)
+catalog_generation = None
+catalog_generation_checked_at = 0.0
+
+# --- Кэш результатов поиска ---
+# Популярные запросы и переключения режима в интерфейсе дают одинаковые ответы
+# много раз в минуту. Ключ включает поколение индекса, поэтому новый индекс
+# сразу делает старые ответы недоступными; TTL ограничивает устаревание
+# названий/описаний, которые меняются без пересборки индекса.
+SEARCH_CACHE_BYTES = 64 * 1024 * 1024
+SEARCH_CACHE_TTL = 600
+search_cache = ResponseCache(SEARCH_CACHE_BYTES, ttl=SEARCH_CACHE_TTL)
+index_generation = 0 # Растет при каждой загрузке индекса
+
+# --- Постраничная выдача поиска ---
+# Ранжируется до MAX_RANKED_GAMES игр; первая страница отдается сразу, а остаток списка
+# упаковывается в курсор. Следующие страницы - только чтение метаданных из базы,
+# без эмбеддинга и Faiss.
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+MAX_RANKED_GAMES = 200
+SEARCH_CURSOR_VERSION = 2
+MATCH_TYPES = ("summary", "text", "keyword", "title")
+SERVED_BY = ("semantic", "hybrid", "lexical", "title")
+game_positions = {} # game_id -> номер игры в chunk_store (для курсоров)
+
+# --- Фильтры по атрибутам игр (filters.py) ---
+# Битовые маски строятся при загрузке индекса и пересобираются при смене поколения каталога
+attribute_bitmaps = None
+attribute_bitmaps_key = None
+attribute_bitmaps_lock = threading.Lock()
+
+# --- Бюджет задержки и лексический поиск ---
+# Эмбеддинг запроса ждем не дольше EMBED_BUDGET_SECONDS: если Gemini не успел или вернул
+# ошибку, отвечаем из лексического индекса (BM25, lexical.db). Если успел - обе выдачи
+# смешиваются через Reciprocal Rank Fusion. Без lexical.db ждем до EMBED_TIMEOUT_SECONDS.
+EMBED_BUDGET_SECONDS = float(os.getenv("EMBED_BUDGET_SECONDS", "1.5"))
+EMBED_TIMEOUT_SECONDS = 10.0
+EMBED_WORKERS = 8           # Отдельный пул: зависший Gemini не занимает потоки для SQLite и Faiss
+RRF_K = 60                  # Константа RRF: чем больше, тем ровнее вклад нижних позиций
+LEXICAL_LIMIT = 20
+BM25_HALF_SCORE = 10.0      # Оценка BM25, которая показывается как 50% (только для лексических результатов)
+LEXICAL_FILE = lexical.LEXICAL_FILE
+lexical_index = None
+embed_executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
+
+# --- Микро-батчинг (micro_batch.py) ---
+# Запросы, пришедшие в пределах MICRO_BATCH_WINDOW_MS, идут к Gemini одним embed_content,
+# а в Faiss - одним многострочным search. MICRO_BATCH_WINDOW_MS=0 отключает батчинг.
+MICRO_BATCH_WINDOW_MS = float(os.getenv("MICRO_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX = 32
+FAISS_BATCH_MAX = 64
+FAISS_BATCH_WORKERS = 2
+embed_batcher = None
+faiss_batcher = None
+if MICRO_BATCH_WINDOW_MS > 0:
+    embed_batcher = MicroBatcher("embed", lambda texts: embed_queries(texts), MICRO_BATCH_WINDOW_MS / 1000,
+                                 EMBED_BATCH_MAX, embed_executor, EMBED_WORKERS)
+    faiss_batcher = MicroBatcher("faiss", lambda keys: faiss_search_batch(keys), MICRO_BATCH_WINDOW_MS / 1000,
+                                 FAISS_BATCH_MAX, ThreadPoolExecutor(max_workers=FAISS_BATCH_WORKERS, thread_name_prefix="faiss"),
+                                 FAISS_BATCH_WORKERS)
+
+# --- Шарды индекса (shards.py, shard_worker.py) ---
+# Если заданы адреса воркеров, вектор запроса рассылается всем шардам, а их лучшие чанки
+# сливаются перед агрегацией по играм. Шарды, не ответившие за SHARD_TIMEOUT_SECONDS,
+# пропускаются, ответ помечается полем "partial".
+SHARD_ADDRESSES = [a.strip() for a in os.getenv("SHARD_ADDRESSES", "").split(",") if a.strip()]
+SHARD_TIMEOUT_SECONDS = float(os.getenv("SHARD_TIMEOUT_SECONDS", "0.5"))
+shard_coordinator = ShardCoordinator(SHARD_ADDRESSES, SHARD_TIMEOUT_SECONDS) if SHARD_ADDRESSES else None
+shard_manifest = None
+
+# --- Индекс названий (автодополнение и запросы-названия) ---
+# "boost" - точное совпадение с названием ставится первым поверх семантической выдачи;
+# "short_circuit" - при точном совпадении отвечаем сразу, без эмбеддинга и Faiss.
+EXACT_TITLE_POLICY = os.getenv("EXACT_TITLE_POLICY", "boost")
+AUTOCOMPLETE_LIMIT = 10
+title_index = None
+title_index_generation = None
+title_index_lock = threading.Lock()
+# Пересборки в фоне (индекс названий, маски фильтров): не больше одной каждого вида
+rebuilds_running = set()
+rebuilds_lock = threading.Lock()
+
+# --- Метрики (/metrics, формат Prometheus) ---
+SEARCH_PHASE_SECONDS = metrics.Histogram(
+    "search_phase_seconds", "Время фаз поиска: title, embed, lexical, shortlist, faiss, rescore, shards, aggregate, db, serialize", ("phase",))
+SEARCH_REQUEST_SECONDS = metrics.Histogram(
+    "search_request_seconds", "Полное время обработки поискового запроса", ("cache",))
+SEARCH_REQUESTS = metrics.Counter("search_requests_total", "Поисковые запросы", ("mode", "cache"))
+SEARCH_ERRORS = metrics.Counter("search_errors_total", "Поисковые запросы, завершившиеся ошибкой", ("mode",))
+
+def _cache_gauge(field):
+    return lambda: {("search",): search_cache.stats()[field], ("games",): games_cache.stats()[field]}
+
+metrics.Gauge("response_cache_entries", "Записей в кэше ответов", _cache_gauge("entries"), ("cache",))
+metrics.Gauge("response_cache_bytes", "Объем кэша ответов в байтах", _cache_gauge("bytes"), ("cache",))
+metrics.Gauge("response_cache_hit_ratio", "Доля попаданий в кэш ответов", _cache_gauge("hit_rate"), ("cache",))
+metrics.Gauge("response_cache_evictions", "Вытеснений из кэша ответов", _cache_gauge("evictions"), ("cache",))
+metrics.Gauge("query_log_queue_size", "Записей журнала запросов в очереди на запись", lambda: query_log.stats()["queued"])
+metrics.Gauge("query_log_dropped", "Записей журнала, отброшенных из-за переполнения очереди", lambda: query_log.stats()["dropped"])
+metrics.Gauge("index_vectors", "Векторов в загруженном индексе", lambda: faiss_index.ntotal if faiss_index else 0)
+metrics.Gauge("index_generation", "Номер загрузки индекса", lambda: index_generation)
+metrics.Gauge("title_index_size", "Названий в индексе автодополнения", lambda: len(title_index) if title_index else 0)
+TITLE_MATCHES = metrics.Counter("search_title_matches_total", "Запросы, совпавшие с названием игры", ("policy",))
+SEARCH_SERVED_BY = metrics.Counter("search_served_total", "Чем обслужен поисковый запрос: semantic, hybrid, lexical", ("path",))
+EMBED_FAILURES = metrics.Counter("search_embed_failures_total", "Эмбеддинг запроса не получен: timeout или error", ("reason",))
+metrics.Gauge("filter_games", "Игр с атрибутом (для фильтров поиска)",
+              lambda: {(attr,): n for attr, n in attribute_bitmaps.counts.items()} if attribute_bitmaps else {}, ("attribute",))
+SHARD_FAILURES = metrics.Counter("search_shard_failures_total", "Шард не ответил на запрос: timeout, unavailable, error, stale", ("shard", "reason"))
+SEARCH_PARTIAL = metrics.Counter("search_partial_total", "Ответы поиска без части шардов")
+metrics.Gauge("lexical_index_chunks", "Чанков в лексическом индексе", lambda: len(lexical_index) if lexical_index else 0)
+
+metrics.Gauge("startup_phase_seconds", "Длительность фаз запуска и последней загрузки индекса",
+              lambda: {(phase,): ms / 1000 for phase, ms in startup_state["phases_ms"].items()}, ("phase",))
+metrics.Gauge("server_ready", "Индекс загружен и прогрет (1) или нет (0)", lambda: int(startup_state["status"] == "ready"))
+
+@contextmanager
+def startup_phase(phase):
+    """Замер фазы запуска или загрузки индекса: в startup_state (его отдает /ready) и в метрику."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_state["phases_ms"][phase] = round((time.perf_counter() - start) * 1000, 1)
+
+def import_faiss():
+    """Модуль faiss: импортируется при первой загрузке индекса, а не при запуске сервера."""
+    global faiss
+    if faiss is None:
+        import faiss as module
+        faiss = module
+    return faiss
 
-@app.on_event("startup")
 def load_data():
-    global faiss_index, chunk_map
+    """Загружает индекс и метаданные; False, если файлов индекса нет."""
+    global faiss_index, chunk_map, index_mtime, index_generation, lexical_index, game_level_index, game_ranges
+    global game_positions, chunk_vectors, shard_manifest
     print("Загрузка индекса и карты...")
-    if os.path.exists(INDEX_FILE) and os.path.exists(MAPPING_FILE):
-        faiss_index = faiss.read_index(INDEX_FILE)
-        with open(MAPPING_FILE, 'r', encoding='utf-8') as f:
-            chunk_map = {int(k): v for k, v in json.load(f).items()}
-        print(f"Индекс загружен: {faiss_index.ntotal} векторов.")
-    else:
-        print("WARN: Файлы индекса не найдены. Поиск не будет работать.")
+    if os.path.exists(INDEX_FILE) and (os.path.exists(CHUNK_STORE_FILE) or os.path.exists(MAPPING_FILE)):
+        if faiss is None:
+            with startup_phase("faiss_import"):
+                import_faiss()
+        mtime = index_build.stamp_mtime(INDEX_FILE)
+        build = index_build.read()
+        # Файлы от разных сборок (индексатор еще подменяет их или упал посередине) не загружаем:
+        # ошибка - повтор с паузой, прежний индекс продолжает отвечать
+        if build is not None and index_build.mismatched(build):
+            raise RuntimeError(f"Файлы индекса не совпадают со сборкой {build['build']}: "
+                               f"{', '.join(index_build.mismatched(build))}")
+        # Сначала открываем оба файла, потом подменяем глобальные - запросы не видят половину
+        with startup_phase("index"):
+            new_index = faiss.read_index(INDEX_FILE, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        with startup_phase("chunk_store"):
+            new_map = ChunkStore(CHUNK_STORE_FILE) if os.path.exists(CHUNK_STORE_FILE) else None
+            if new_map is None or len(new_map) != new_index.ntotal:
+                # Индекс собран старым индексатором (есть только chunk_map.json) - конвертируем один раз
+                print("Хранилище чанков отсутствует или устарело, конвертация chunk_map.json...")
+                convert_chunk_map(MAPPING_FILE, CHUNK_STORE_FILE)
+                new_map = ChunkStore(CHUNK_STORE_FILE)
+        # Лексический индекс необязателен: без него поиск работает как раньше, только без запасного пути
+        with startup_phase("lexical"):
+            new_lexical = LexicalIndex(LEXICAL_FILE) if os.path.exists(LEXICAL_FILE) else None
+        with startup_phase("game_level"):
+            new_game_index, new_ranges = load_game_level(new_map)
+        with startup_phase("vectors"):
+            new_vectors = load_full_vectors(new_index)
+        if build is not None and (index_build.mismatched(build) or index_build.stamp_mtime(INDEX_FILE) != mtime):
+            raise RuntimeError(f"Файлы индекса подменены во время загрузки сборки {build['build']}")
+        faiss_index, chunk_map, index_mtime, lexical_index = new_index, new_map, mtime, new_lexical
+        chunk_vectors = new_vectors
+        if shard_coordinator is not None:
+            shard_manifest = read_manifest(SHARDS_DIR)
+            if (shard_manifest is None or shard_manifest["chunks"] != new_index.ntotal
+                    or (build is not None and shard_manifest.get("build") != build["build"])):
+                print("WARN: Манифест шардов отсутствует или от другой сборки индекса.")
+        game_level_index, game_ranges = new_game_index, new_ranges
+        game_positions = {game_id: i for i, game_id in enumerate(new_map.game_id_list())}
+        with startup_phase("filters"):
+            try:
+                get_attribute_bitmaps()  # Маски фильтров - сразу, а не на первом запросе
+            except sqlite3.Error as e:
+                print(f"WARN: Маски фильтров не построены: {e}")
+        index_generation += 1
+        search_cache.set_generation(index_generation)
+        print(f"Индекс загружен: {faiss_index.ntotal} векторов ({faiss_index.d}-d"
+              + (f", переоценка по {chunk_vectors.shape[1]}-d)" if chunk_vectors is not None else ")")
+              + (f", лексический индекс: {len(lexical_index)} чанков" if lexical_index else ", лексического индекса нет")
+              + (f", шардов: {len(shard_coordinator.clients)}." if shard_coordinator is not None
+                 else f", индекс игр: {game_level_index.ntotal} векторов." if game_level_index else ", поиск в одну стадию."))
+        return True
+    print("WARN: Файлы индекса не найдены. Поиск не будет работать.")
+    return False
 
-@app.get("/api/semantic-search")
+def load_game_level(store):
+    """Индекс уровня игр и диапазоны чанков; (None, None), если их нет или они не от этого индекса."""
+    if not os.path.exists(GAME_INDEX_FILE):
+        return None, None
+    ranges = store.game_ranges()
+    index = faiss.read_index(GAME_INDEX_FILE, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    game_ids = faiss.vector_to_array(index.id_map)
+    if ranges is None or not len(game_ids) or game_ids.max() >= len(store.game_id_list()):
+        print("WARN: Индекс уровня игр не соответствует хранилищу чанков, поиск в одну стадию.")
+        return None, None
+    return index, ranges
 
-async def search_games(
-    q: str = Query(..., min_length=2),
-    mode: SearchMode = Query(SearchMode.mixed, description="Режим поиска: по тексту, по описанию или смешанный"),
-    k: int = 200, 
-    threshold: float = 0.40 
-):
-    if not faiss_index or not chunk_map:
-        raise HTTPException(status_code=503, detail="Индекс не готов.")
+def load_full_vectors(index):
+    """Полные векторы чанков для переоценки; None, если их нет или они не от этого индекса."""
+    if not os.path.exists(VECTORS_FILE):
+        return None
+    vectors = vector_store.load_vectors(VECTORS_FILE)
+    if vectors.ndim != 2 or vectors.shape[0] != index.ntotal or vectors.shape[1] <= index.d:
+        print("WARN: chunk_vectors.npy не соответствует индексу, поиск без переоценки.")
+        return None
+    return vectors
 
-    logger.info(f"\n{'='*25} НОВЫЙ ПОИСКОВЫЙ ЗАПРОС {'='*25}")
-    logger.info(f"Query: '{q}' | Mode: {mode} | k: {k} | threshold: {threshold}")
-    
+def query_dimension():
+    """Размерность эмбеддинга запроса: полная, если есть векторы для переоценки, иначе как у индекса."""
+    if chunk_vectors is not None:
+        return chunk_vectors.shape[1]
+    return faiss_index.d if faiss_index is not None else OUTPUT_DIMENSION
+
+def touch_file(path, limit=None):
+    """Читает файл (не больше limit байт), чтобы его страницы были в page cache до первого запроса."""
+    if not os.path.exists(path):
+        return
+    buffer = bytearray(WARMUP_BLOCK)
+    read = 0
+    with open(path, "rb", buffering=0) as f:
+        while limit is None or read < limit:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            read += n
+
+def gemini():
+    """Модуль google.generativeai: импортируется и настраивается при первом обращении."""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                if GEMINI_API_ENDPOINT:
+                    genai.configure(api_key=GOOGLE_API_KEY, transport="rest", client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+                else:
+                    genai.configure(api_key=GOOGLE_API_KEY)
+                _genai = genai
+    return _genai
+
+def warm_up():
+    """
+    Прогрев перед объявлением готовности: файлы индекса читаются в page cache (они отображены
+    в память, и иначе первый запрос платил бы за чтение с диска), пробный вектор проходит через
+    Faiss и переоценку, строится индекс названий. Клиент Gemini импортируется отдельно (import_gemini).
+    """
+    with startup_phase("warmup_files"):
+        for path in (INDEX_FILE, GAME_INDEX_FILE, CHUNK_STORE_FILE, LEXICAL_FILE):
+            touch_file(path)
+        if chunk_vectors is not None:
+            touch_file(VECTORS_FILE, WARMUP_VECTORS_MB * 1024 * 1024)
+    with startup_phase("warmup_search"):
+        index, vectors = faiss_index, chunk_vectors
+        probe = np.random.default_rng(0).standard_normal((1, query_dimension())).astype('float32')
+        faiss.normalize_L2(probe)
+        _, I = index.search(coarse_query(probe, index), DEFAULT_K)
+        if game_level_index is not None:
+            game_level_index.search(coarse_query(probe, game_level_index), GAME_SHORTLIST * GAME_VECTORS_PER_GAME)
+        if vectors is not None and vectors.shape[1] == probe.shape[1]:
+            vector_store.rescore(vectors, I[0][I[0] != -1], probe[0])
+    with startup_phase("warmup_titles"):
+        try:
+            get_title_index()
+        except sqlite3.Error as e:
+            print(f"WARN: Индекс названий не построен: {e}")
+
+def import_gemini():
+    """Фоновый импорт клиента Gemini с запуска. Запрос, пришедший раньше, дождется его в gemini()."""
     try:
-        # 1. Эмбеддинг запроса
-        q_emb = genai.embed_content(
-            model=f"models/{EMBEDDING_MODEL_NAME}",
-            content=q,
-            task_type="RETRIEVAL_QUERY",
-            output_dimensionality=OUTPUT_DIMENSION
-        )['embedding']
-        q_vec = np.array([q_emb]).astype('float32')
-        faiss.normalize_L2(q_vec)
-
-        # 2. Фаза 1: Retrieval - Поиск K ближайших ЧАНКОВ
-        D, I = faiss_index.search(q_vec, k)
-        
+        with startup_phase("gemini_import"):
+            gemini()
+        print(f"Клиент Gemini импортирован за {startup_state['phases_ms']['gemini_import']:g} мс.")
+    except Exception as e:
+        print(f"ERROR: Не удалось импортировать google.generativeai: {e}")
+
+def load_index():
+    """Загрузка (или перезагрузка) и прогрев индекса; готовность объявляется после прогрева."""
+    startup_state["attempts"] += 1
+    if startup_state["status"] != "ready":
+        startup_state["status"] = "loading"  # При перезагрузке старый индекс продолжает отвечать
+    if not load_data():
+        startup_state["status"] = "no_index"
+        return
+    warm_up()
+    if "ready" not in startup_state["phases_ms"]:
+        # Время от начала импорта до первой готовности
+        startup_state["phases_ms"]["ready"] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+    startup_state.update(status="ready", error=None)
+    phases = ", ".join(f"{phase} {ms:g}" for phase, ms in startup_state["phases_ms"].items())
+    print(f"Сервер готов. Фазы запуска, мс: {phases}")
+
+async def watch_index_files():
+    """
+    Загружает индекс в фоне после старта, затем перезагружает его, когда индексатор атомарно
+    подменил файлы. Неудачная загрузка повторяется через LOAD_RETRY_SECONDS с удвоением паузы
+    до INDEX_RELOAD_INTERVAL; пока загружен прежний индекс, он продолжает отвечать.
+    """
+    retry = LOAD_RETRY_SECONDS
+    first = True
+    while True:
+        pause = INDEX_RELOAD_INTERVAL
+        try:
+            if first or index_build.stamp_mtime(INDEX_FILE) not in (None, index_mtime):
+                first = False
+                await asyncio.to_thread(load_index)
+            retry = LOAD_RETRY_SECONDS
+        except Exception as e:
+            if startup_state["status"] != "ready":
+                startup_state["status"] = "failed"
+            startup_state["error"] = f"{e.__class__.__name__}: {e}"
+            print(f"ERROR: Не удалось загрузить индекс (попытка {startup_state['attempts']}, "
+                  f"повтор через {retry:g} с): {e}")
+            pause, retry = retry, min(retry * 2, INDEX_RELOAD_INTERVAL)
+        await asyncio.sleep(pause)
+
+@app.on_event("startup")
+async def start_index_watcher():
+    startup_state["phases_ms"]["imports"] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+    print(f"Сервер принимает соединения через {startup_state['phases_ms']['imports']:g} мс, индекс загружается в фоне.")
+    threading.Thread(target=import_gemini, name="gemini-import", daemon=True).start()
+    asyncio.create_task(watch_index_files())
+
+@app.on_event("startup")
+def start_query_log():
+    query_log.start()
+
+@app.on_event("shutdown")
+def stop_query_log():
+    query_log.close()
+
+def normalize_query(q):
+    """Регистр и лишние пробелы не меняют смысл запроса - и не должны плодить записи в кэше."""
+    return " ".join(q.split()).lower()
+
+def log_user_query(q, mode, started_at, meta, cached=False, context=None):
+    """
+    Компактная запись запроса и его результатов в user_queries.jsonl.
+    Только кладет словарь в очередь - сериализация и диск в фоновом потоке.
+    context - нестандартные фильтры/вариант ранжирования (нужны replay_queries.py).
+    """
+    log_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "query": q,
+        "mode": mode.value,
+        "latency_ms": round((time.perf_counter() - started_at) * 1000, 1),
+        **(context or {}),
+        **meta
+    }
+    if cached:
+        log_entry["cached"] = True
+    query_log.log(log_entry)
+
+def search_response(cache_key, generation, results, mode, trace=None, served_by="semantic", next_cursor=None,
+                    partial=None):
+    """
+    Сериализует ответ поиска один раз и кладет готовые байты в кэш. Ответы с трассировкой,
+    ответы только из лексического индекса (Gemini не успел) и неполные ответы (не ответили
+    шарды индекса; partial - какие) не кэшируются.
+    """
+    meta = {
+        "served_by": served_by,
+        **({"partial": True} if partial else {}),
+        "results_count": len(results),
+        "top_results": [
+            {"id": r["id"], "title": r["title"], "score": r["score"]}
+            for r in results[:3]
+        ]
+    }
+    with phase_timer("serialize", trace):
+        payload = {"results": results, "mode_used": mode.value, "served_by": served_by, "next_cursor": next_cursor}
+        if partial:
+            payload["partial"] = partial
+        if trace is not None:
+            payload["debug"] = trace
+        entry = CachedResponse.from_json(payload, meta)
+    if trace is None and served_by != "lexical" and not partial:
+        search_cache.put(cache_key, entry, generation)
+    return entry
+
+def rebuild_in_background(name, build):
+    """
+    Запускает build() в фоновом потоке, если такая пересборка еще не идет. Пока она идет,
+    запросы обслуживает прежняя версия - event loop не ждет секунду сборки.
+    """
+    with rebuilds_lock:
+        if name in rebuilds_running:
+            return
+        rebuilds_running.add(name)
+
+    def run():
+        try:
+            build()
+        except Exception as e:
+            print(f"ERROR: Не удалось пересобрать {name}: {e}")
+        finally:
+            with rebuilds_lock:
+                rebuilds_running.discard(name)
+
+    threading.Thread(target=run, name=f"rebuild-{name}", daemon=True).start()
+
+def build_title_index(generation):
+    global title_index, title_index_generation
+    conn = storage.connect_readonly(DB_FILE)
+    try:
+        games = conn.execute("SELECT pocketbase_id, title FROM games").fetchall()
+    finally:
+        conn.close()
+    title_index, title_index_generation = TitleIndex(games), generation
+
+def get_title_index():
+    """
+    Индекс названий. Первый раз строится сразу (обычно при прогреве), а при смене поколения
+    каталога пересобирается в фоне - до готовности отвечает прежний.
+    """
+    generation = current_catalog_generation()
+    if title_index is None:
+        with title_index_lock:
+            if title_index is None:
+                build_title_index(generation)
+    elif generation != title_index_generation:
+        rebuild_in_background("title_index", lambda: build_title_index(generation))
+    return title_index
+
+def title_results(matches):
+    """Результаты поиска для игр, найденных по названию (описание подтягивается из базы)."""
+    if not matches:
+        return []
+    ids = [m["id"] for m in matches]
+    conn = storage.connect_readonly(DB_FILE)
+    try:
+        placeholders = ','.join('?' * len(ids))
+        summaries = dict(conn.execute(
+            f"SELECT pocketbase_id, summary FROM games WHERE pocketbase_id IN ({placeholders})", ids
+        ).fetchall())
+    finally:
+        conn.close()
+    return [{
+        "id": m["id"],
+        "title": m["title"],
+        "url": f"{BASE_GAME_URL}{m['id']}",
+        "score": 100,
+        "match_type": "title",
+        "snippet": (summaries[m["id"]][:200] + "...") if summaries.get(m["id"]) else ""
+    } for m in matches if m["id"] in summaries]
+
+def exact_title_matches(query, attributes):
+    """Игры, название которых совпадает с запросом (и которые проходят фильтры)."""
+    return [m for m in get_title_index().exact(query) if passes_filters(m["id"], attributes)]
+
+def boost_title_matches(ranked, exact_titles):
+    """Точные совпадения по названию - первыми в ранжированном списке, без дублей в остальной части."""
+    if not exact_titles:
+        return ranked
+    pinned_ids = [m["id"] for m in exact_titles]
+    pinned = [(game_id, {"score": 1.0, "match_type": "title"}) for game_id in pinned_ids]
+    return pinned + [(game_id, data) for game_id, data in ranked if game_id not in pinned_ids]
+
+def display_score(score_data):
+    """Оценка для показа в процентах: семантическая, а для найденных только по словам - BM25."""
+    if score_data["score"] is not None:
+        return max(0, min(int(score_data["score"] * 100), 100))
+    return lexical_display_score(score_data["lexical"])
+
+def hydrate_results(page):
+    """page - [(game_id, оценка, тип совпадения)]: названия и описания из базы, порядок сохраняется."""
+    if not page:
+        return []
+    game_ids = [game_id for game_id, _, _ in page]
+    conn = storage.connect_readonly(DB_FILE)
+    try:
+        placeholders = ','.join('?' * len(game_ids))
+        rows = conn.execute(
+            f"SELECT pocketbase_id, title, summary FROM games WHERE pocketbase_id IN ({placeholders})", game_ids
+        ).fetchall()
+    finally:
+        conn.close()
+    game_meta_map = {row[0]: (row[1], row[2]) for row in rows}
+    results = []
+    for game_id, score, match_type in page:
+        if game_id in game_meta_map:
+            title, summary = game_meta_map[game_id]
+            results.append({
+                "id": game_id,
+                "title": title,
+                "url": f"{BASE_GAME_URL}{game_id}",
+                "score": score,
+                "match_type": match_type,
+                "snippet": (summary[:200] + "...") if summary else ""
+            })
+    return results
+
+def index_stamp():
+    """Отпечаток загруженного индекса, одинаковый во всех воркерах (время изменения файла, мс)."""
+    return int(index_mtime * 1000) & 0xFFFFFFFF
+
+def encode_search_cursor(ranked, mode, served_by):
+    """
+    Курсор следующих страниц поиска - сам остаток ранжированного списка, упакованный компактно:
+    номера игр в chunk_store (uint16/uint32), оценки и типы совпадения (по байту). Игры без векторов
+    (найденные только по словам) идут с номером-заглушкой, а их id - в хвосте курсора. Сервер ничего
+    не хранит, поэтому курсор работает в любом воркере; при смене индекса он устаревает.
+    """
+    if not ranked:
+        return None
+    positions, scores, types, extras = [], [], [], []
+    for game_id, score, match_type in ranked:
+        position = game_positions.get(game_id)
+        if position is None:
+            extras.append(game_id)
+        positions.append(position)
+        scores.append(score)
+        types.append(MATCH_TYPES.index(match_type))
+    wide = max((p for p in positions if p is not None), default=0) >= 0xFFFF
+    missing = 0xFFFFFFFF if wide else 0xFFFF
+    header = struct.pack("<BIBBH", SEARCH_CURSOR_VERSION | (0x80 if wide else 0), index_stamp(),
+                         list(SearchMode).index(mode), SERVED_BY.index(served_by), len(positions))
+    raw = (header + np.array([missing if p is None else p for p in positions],
+                             dtype=np.uint32 if wide else np.uint16).tobytes()
+           + bytes(scores) + bytes(types) + "\n".join(extras).encode("utf-8"))
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_search_cursor(cursor):
+    """(отпечаток индекса, режим, served_by, [(game_id, оценка, тип совпадения)])."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        version, stamp, mode_code, served_code, count = struct.unpack_from("<BIBBH", raw)
+        wide = bool(version & 0x80)
+        if version & 0x7F != SEARCH_CURSOR_VERSION:
+            raise ValueError(version)
+        offset = struct.calcsize("<BIBBH")
+        positions = np.frombuffer(raw, dtype=np.uint32 if wide else np.uint16, count=count, offset=offset)
+        offset += positions.nbytes
+        scores = raw[offset:offset + count]
+        types = raw[offset + count:offset + 2 * count]
+        if len(types) != count:
+            raise ValueError("truncated")
+        missing = 0xFFFFFFFF if wide else 0xFFFF
+        extras = iter(raw[offset + 2 * count:].decode("utf-8").split("\n"))
+        mode = list(SearchMode)[mode_code]
+        served_by = SERVED_BY[served_code]
+        game_ids = chunk_map.game_id_list()
+        ranked = [(next(extras) if p == missing else game_ids[p], scores[i], MATCH_TYPES[types[i]])
+                  for i, p in enumerate(positions)]
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор.")
+    return stamp, mode, served_by, ranked
+
+def embed_query(text, dimension=None):
+    q_emb = gemini().embed_content(
+        model=f"models/{EMBEDDING_MODEL_NAME}",
+        content=text,
+        task_type="RETRIEVAL_QUERY",
+        output_dimensionality=dimension or query_dimension()
+    )['embedding']
+    q_vec = np.array([q_emb]).astype('float32')
+    faiss.normalize_L2(q_vec)
+    return q_vec
+
+def embed_queries(texts):
+    """Пачка запросов одним вызовом Gemini (для микро-батчинга): список векторов (1, d)."""
+    result = gemini().embed_content(
+        model=f"models/{EMBEDDING_MODEL_NAME}",
+        content=list(texts),
+        task_type="RETRIEVAL_QUERY",
+        output_dimensionality=query_dimension()
+    )['embedding']
+    vectors = np.array(result).astype('float32')
+    faiss.normalize_L2(vectors)
+    return [vectors[i:i + 1] for i in range(len(texts))]
+
+async def embed_with_budget(loop, text, trace=None, has_fallback=True):
+    """
+    Вектор запроса или None, если Gemini не уложился в бюджет или ответил ошибкой
+    (тогда отвечает лексический индекс). Без запасного пути ошибка пробрасывается как раньше.
+    """
+    budget = EMBED_BUDGET_SECONDS if has_fallback else EMBED_TIMEOUT_SECONDS
+    with phase_timer("embed", trace):
+        try:
+            if embed_batcher is not None:
+                future = asyncio.wrap_future(embed_batcher.submit(text))
+            else:
+                future = loop.run_in_executor(embed_executor, embed_query, text)
+            return await asyncio.wait_for(future, budget)
+        except asyncio.TimeoutError:
+            EMBED_FAILURES.inc("timeout")
+            if trace is not None:
+                trace["embed_error"] = f"timeout after {budget}s"
+            if not has_fallback:
+                raise HTTPException(status_code=504, detail="Сервис эмбеддингов не ответил вовремя.")
+            return None
+        except Exception as e:
+            EMBED_FAILURES.inc("error")
+            if trace is not None:
+                trace["embed_error"] = str(e)
+            if not has_fallback:
+                raise
+            print(f"WARN: Эмбеддинг запроса не получен, ответ из лексического индекса: {e}")
+            return None
+
+def lexical_search(index, text, mode, trace=None):
+    """BM25 по lexical.db (в пуле потоков). Ошибка индекса не должна ронять поиск - тогда None."""
+    chunk_type = None if mode == SearchMode.mixed else mode.value
+    with phase_timer("lexical", trace):
+        try:
+            return index.search(text, chunk_type, LEXICAL_LIMIT)
+        except Exception as e:
+            print(f"ERROR: Лексический поиск не удался: {e}")
+            return None
+
+def fuse_rankings(semantic_games, lexical_games, limit=20):
+    """
+    Reciprocal Rank Fusion: сумма 1 / (RRF_K + позиция) по обеим выдачам. Оценки Faiss и BM25
+    несопоставимы, а позиции - да. Семантическая оценка и тип совпадения сохраняются.
+    """
+    fused = {}
+    for rank, (game_id, data) in enumerate(semantic_games, start=1):
+        fused[game_id] = {**data, "rrf": 1.0 / (RRF_K + rank)}
+    for rank, (game_id, score, _) in enumerate(lexical_games, start=1):
+        entry = fused.setdefault(game_id, {"score": None, "match_type": "keyword", "rrf": 0.0})
+        entry["lexical"] = score
+        entry["rrf"] += 1.0 / (RRF_K + rank)
+    ranked = sorted(fused.items(), key=lambda item: item[1]["rrf"], reverse=True)
+    return ranked[:limit]
+
+def lexical_display_score(score):
+    """BM25 не ограничена сверху - для показа в процентах плавно насыщаем ее."""
+    return int(100 * score / (score + BM25_HALF_SCORE))
+
+@contextmanager
+def phase_timer(phase, trace=None):
+    """Замер фазы поиска: всегда в гистограмму, в трассировку - только если она запрошена."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SEARCH_PHASE_SECONDS.observe(elapsed, phase)
+        if trace is not None:
+            trace["phases_ms"][phase] = round(elapsed * 1000, 3)
+
+def build_attribute_bitmaps(store, key):
+    global attribute_bitmaps, attribute_bitmaps_key
+    conn = storage.connect_readonly(DB_FILE)
+    try:
+        rows = conn.execute(ATTRIBUTES_SQL).fetchall()
+    finally:
+        conn.close()
+    bitmaps = AttributeBitmaps(store, rows)
+    # Фоновая сборка для прежнего хранилища не должна затереть маски нового индекса
+    if store is chunk_map:
+        attribute_bitmaps, attribute_bitmaps_key = bitmaps, key
+    return bitmaps
+
+def get_attribute_bitmaps():
+    """
+    Маски атрибутов для загруженного индекса. Для нового индекса (другие id чанков) строятся
+    сразу - это делает загрузка индекса; при смене поколения каталога пересобираются в фоне,
+    а до готовности отвечают прежние.
+    """
+    store = chunk_map
+    key = (id(store), current_catalog_generation())
+    bitmaps, current = attribute_bitmaps, attribute_bitmaps_key
+    if current is None or current[0] != key[0]:
+        with attribute_bitmaps_lock:
+            bitmaps, current = attribute_bitmaps, attribute_bitmaps_key
+            if current is None or current[0] != key[0]:
+                bitmaps = build_attribute_bitmaps(store, key)
+    elif current != key:
+        rebuild_in_background("attribute_bitmaps", lambda: build_attribute_bitmaps(store, key))
+    return bitmaps
+
+def search_params(selector):
+    return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+def passes_filters(game_id, attributes):
+    """Для результатов не из Faiss (названия, BM25): проходит ли игра фильтры."""
+    if not attributes:
+        return True
+    position = game_positions.get(game_id)
+    return position is not None and get_attribute_bitmaps().game_matches(position, attributes)
+
+def faiss_search_batch(keys):
+    """
+    Пачка поисков Faiss (для микро-батчинга). Ключ - (индекс "chunks"/"games", вектор в байтах, k,
+    атрибуты, тип чанка); запросы с одинаковыми индексом, k и фильтрами идут одним многострочным search.
+    """
+    groups = defaultdict(list)
+    for i, (which, _, k, attributes, chunk_type) in enumerate(keys):
+        groups[(which, k, attributes, chunk_type)].append(i)
+    results = [None] * len(keys)
+    for (which, k, attributes, chunk_type), rows in groups.items():
+        vectors = np.vstack([np.frombuffer(keys[i][1], dtype=np.float32) for i in rows])
+        D, I = index_search(which, vectors, k, attributes, chunk_type)
+        for row, i in enumerate(rows):
+            results[i] = (D[row:row + 1], I[row:row + 1])
+    return results
+
+def index_search(which, vectors, k, attributes=(), chunk_type=None):
+    """Поиск в индексе чанков или уровня игр; фильтры и режим - маской внутри Faiss."""
+    if which == "games":
+        index = game_level_index
+        selector = get_attribute_bitmaps().game_selector(attributes) if attributes else None
+    else:
+        index = faiss_index
+        selector = get_attribute_bitmaps().chunk_selector(attributes, chunk_type) if attributes or chunk_type else None
+    return index.search(vectors, k, params=search_params(selector))
+
+def faiss_search(which, q_vec, k, attributes=(), chunk_type=None):
+    """Поиск одного вектора; при включенном микро-батчинге - в общей пачке с соседними запросами."""
+    if faiss_batcher is None:
+        return index_search(which, q_vec, k, attributes, chunk_type)
+    return faiss_batcher.submit((which, q_vec.tobytes(), k, attributes, chunk_type)).result()
+
+def coarse_query(q_vec, index):
+    """Вектор запроса в размерности индекса: префикс Matryoshka, если индекс грубый."""
+    return q_vec if q_vec.shape[1] == index.d else vector_store.truncate(q_vec, index.d)
+
+def rescore_vectors(q_vec):
+    """Полные векторы чанков, если они загружены и совпадают по размерности с запросом."""
+    vectors = chunk_vectors
+    return vectors if vectors is not None and vectors.shape[1] == q_vec.shape[1] else None
+
+def shortlist_size(k):
+    """
+    Игр в коротком списке двухстадийного поиска: k задает ширину пула кандидатов и здесь -
+    GAME_SHORTLIST игр при k по умолчанию, пропорционально больше или меньше при другом k.
+    """
+    return max(1, round(GAME_SHORTLIST * k / DEFAULT_K))
+
+def shortlist_chunks(q_vec, shortlist=GAME_SHORTLIST, trace=None, attributes=()):
+    """
+    Стадия 1: shortlist лучших игр по индексу уровня игр (фильтры - маской по номерам игр
+    прямо в Faiss). Стадия 2: точные оценки всех чанков этих игр - векторы читаются диапазонами id
+    из полных векторов (или из индекса, если их нет). Возвращает (indices, scores) по убыванию оценки.
+    """
+    full_vectors = rescore_vectors(q_vec)
+    with phase_timer("shortlist", trace):
+        _, game_hits = faiss_search(
+            "games", coarse_query(q_vec, game_level_index), shortlist * GAME_VECTORS_PER_GAME, attributes)
+        games = list(dict.fromkeys(int(g) for g in game_hits[0] if g != -1))[:shortlist]
+    with phase_timer("rescore" if full_vectors is not None else "faiss", trace):
+        starts, ends = game_ranges
+        if not games:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        indices = np.concatenate([np.arange(starts[g], ends[g]) for g in games])
+        if full_vectors is not None:
+            scores = vector_store.rescore_ranges(full_vectors, starts[games], ends[games], q_vec[0])
+        else:
+            vectors = np.vstack([faiss_index.reconstruct_n(int(starts[g]), int(ends[g] - starts[g])) for g in games])
+            scores = vectors @ q_vec[0]
+        order = np.argsort(-scores, kind="stable")
+    if trace is not None:
+        trace["shortlist_games"] = len(games)
+    return indices[order], scores[order]
+
+def sharded_chunks(q_vec, mode, params, trace=None, attributes=(), status=None):
+    """
+    Рассылает вектор запроса воркерам шардов; фильтры и режим передаются маской id чанков.
+    Возвращает (indices, scores) лучших k чанков ответивших шардов, отчет о шардах - в status.
+    """
+    k = params["k"]
+    manifest = shard_manifest or {}
+    with phase_timer("shards", trace):
+        bits = None
+        if attributes or mode != SearchMode.mixed:
+            chunk_type = None if mode == SearchMode.mixed else mode.value
+            bits = get_attribute_bitmaps().chunk_mask(attributes, chunk_type).tobytes()
+        indices, scores, report = shard_coordinator.search(
+            q_vec[0], k, k * max(1, int(params["rescore_factor"])), bits, len(chunk_map),
+            manifest.get("build"), manifest.get("shards"))
+    for address, reason in report["failed"].items():
+        SHARD_FAILURES.inc(address, reason.split(":")[0])
+    if trace is not None:
+        trace["shards"] = report
+    if status is not None:
+        status["shards"] = report
+    if not report["answered"]:
+        raise HTTPException(status_code=503, detail="Шарды индекса не ответили.")
+    return indices, scores
+
+def semantic_ranking(q_vec, mode, params, trace=None, attributes=(), status=None):
+    """
+    Поиск ближайших чанков в Faiss и переранжирование по играм ("золотая формула").
+    params - параметры ранжирования (см. ranking_params); в status (если передан) записывается
+    отчет о шардах индекса.
+    Возвращает ([(game_id, {"score", "match_type"})] лучших MAX_RANKED_GAMES, разбор по играм или None).
+    """
+    k, threshold = params["k"], params["threshold"]
+    summary_weight, text_weight = params["summary_weight"], params["text_weight"]
+    # 2. Фаза 1: Retrieval - чанки от шардов, короткий список игр и их чанки, либо K ближайших ЧАНКОВ
+    if shard_coordinator is not None:
+        indices, scores = sharded_chunks(q_vec, mode, params, trace, attributes, status)
+    elif params["two_stage"] and game_level_index is not None:
+        # В режиме "summary" в короткий список попадают только игры, у которых описание есть
+        if mode == SearchMode.summary and "summary" not in attributes:
+            attributes = attributes + ("summary",)
+        indices, scores = shortlist_chunks(q_vec, shortlist_size(k), trace, attributes)
+    else:
+        full_vectors = rescore_vectors(q_vec)
+        with phase_timer("faiss", trace):
+            # Фильтры и режим - маской id чанков внутри Faiss: k кандидатов уже из подходящих чанков
+            chunk_type = None if mode == SearchMode.mixed else mode.value
+            # В грубом индексе берем с запасом: точная переоценка оставит лучшие k
+            candidates = k * max(1, int(params["rescore_factor"])) if full_vectors is not None else k
+            D, I = faiss_search("chunks", coarse_query(q_vec, faiss_index), candidates, attributes, chunk_type)
         indices = I[0]
         scores = D[0]
+        if full_vectors is not None:
+            with phase_timer("rescore", trace):
+                indices = indices[indices != -1]
+                scores = vector_store.rescore(full_vectors, indices, q_vec[0])
+                order = np.argsort(-scores, kind="stable")[:k]
+                indices, scores = indices[order], scores[order]
+    if DEBUG_LOGGING:
         logger.info(f"[Фаза 1] Поиск в Faiss. Найдено {len(indices)} потенциальных чанков-кандидатов.")
 
-        # 3. Агрегация данных по играм
+    # 3. Агрегация данных по играм и переранжирование
+    with phase_timer("aggregate", trace):
         game_data = defaultdict(lambda: {"summary_chunks": [], "text_chunks": []})
 
         for idx, raw_score in zip(indices, scores):
             if idx == -1 or raw_score < threshold: continue
             
-            chunk_info = chunk_map.get(int(idx))
-            if not chunk_info: continue
+            if idx >= len(chunk_map): continue
 
-            game_id = chunk_info['game_id']
-            chunk_type = chunk_info.get('type', 'text')
+            game_id = chunk_map.game_id(idx)
+            chunk_type = chunk_map.chunk_type(idx)
 
             if mode == SearchMode.summary and chunk_type != 'summary': continue
             if mode == SearchMode.text and chunk_type != 'text': continue
             
-            chunk_details = {
-                "score": float(raw_score),
-                "snippet": chunk_info.get('text_snippet', 'N/A')
-            }
+            chunk_details = {"score": float(raw_score)}
+            if DEBUG_LOGGING:
+                chunk_details["snippet"] = chunk_map.snippet(idx)
 
             if chunk_type == 'summary':
                 game_data[game_id]["summary_chunks"].append(chunk_details)
             else:
                 game_data[game_id]["text_chunks"].append(chunk_details)
 
-        if not game_data:
-            logger.info("Порог релевантности не пройден ни одним чанком. Результатов нет.")
-            return {"results": [], "mode_used": mode}
-        
-        logger.info(f"\n--- [Фаза 2] Агрегация чанков по {len(game_data)} играм ---")
-        for game_id, data in game_data.items():
-            logger.info(f"Игра ID: {game_id}")
-            for chunk in data['summary_chunks']:
-                logger.info(f"  [SUMMARY] Score: {chunk['score']:.4f} | Snippet: {chunk['snippet']}")
-            for chunk in data['text_chunks']:
-                logger.info(f"  [TEXT]    Score: {chunk['score']:.4f} | Snippet: {chunk['snippet']}")
-
-        # 4. Фаза 2: Re-ranking - Применяем "Золотую формулу"
-        logger.info("\n--- [Фаза 3] Переранжирование и расчет 'Волшебной формулы' ---")
+        if trace is not None:
+            trace["candidates"] = int((indices != -1).sum())
+            trace["games_matched"] = len(game_data)
+
+        if DEBUG_LOGGING:
+            logger.info(f"\n--- [Фаза 2] Агрегация чанков по {len(game_data)} играм ---")
+            for game_id, data in game_data.items():
+                logger.info(f"Игра ID: {game_id}")
+                for chunk in data['summary_chunks']:
+                    logger.info(f"  [SUMMARY] Score: {chunk['score']:.4f} | Snippet: {chunk['snippet']}")
+                for chunk in data['text_chunks']:
+                    logger.info(f"  [TEXT]    Score: {chunk['score']:.4f} | Snippet: {chunk['snippet']}")
+            # 4. Фаза 2: Re-ranking - Применяем "Золотую формулу"
+            logger.info("\n--- [Фаза 3] Переранжирование и расчет 'Волшебной формулы' ---")
+
         final_game_scores = {}
+        breakdown = {} if trace is not None else None
 
         for game_id, data in game_data.items():
             summary_scores = [c['score'] for c in data['summary_chunks']]
@@ -206,106 +1088,187 @@ async def search_games(
             text_score = 0
             sorted_text_scores = sorted(text_scores, reverse=True)
             for i, score in enumerate(sorted_text_scores):
-                text_score += score * (DECAY_FACTOR ** i)
+                text_score += score * (params["decay"] ** i)
             
-            normalizing_divisor = 5.0 
-            normalized_text_score = math.log1p(text_score) / normalizing_divisor if text_score > 0 else 0
+            normalized_text_score = math.log1p(text_score) / params["text_divisor"] if text_score > 0 else 0
 
-            final_score = (summary_score * SUMMARY_WEIGHT) + (normalized_text_score * TEXT_WEIGHT)
+            final_score = (summary_score * summary_weight) + (normalized_text_score * text_weight)
             
             final_game_scores[game_id] = {
                 "score": final_score,
                 "match_type": "summary" if summary_score > 0 else "text"
             }
+
+            if breakdown is not None:
+                breakdown[game_id] = {
+                    "summary_scores": [round(s, 4) for s in summary_scores],
+                    "text_scores": [round(s, 4) for s in sorted_text_scores],
+                    "summary_score": round(summary_score, 4),
+                    "text_score_decayed": round(text_score, 4),
+                    "text_score_normalized": round(normalized_text_score, 4),
+                    "final_score": round(final_score, 4)
+                }
             
-            log_msg = (
-                f"Расчет для игры ID: {game_id}\n"
-                f"  - Summary Scores: {[f'{s:.4f}' for s in summary_scores]}\n"
-                f"  - -> Max Summary Score (A): {summary_score:.4f}\n"
-                f"  - Text Scores (sorted): {[f'{s:.4f}' for s in sorted_text_scores]}\n"
-                f"  - -> Raw Text Score (decayed sum): {text_score:.4f}\n"
-                f"  - -> Normalized Text Score (B): {normalized_text_score:.4f}\n"
-                f"  >>> ИТОГОВАЯ ФОРМУЛА: (A * {SUMMARY_WEIGHT}) + (B * {TEXT_WEIGHT})\n"
-                f"  >>> РЕЗУЛЬТАТ: ({summary_score:.4f} * {SUMMARY_WEIGHT}) + ({normalized_text_score:.4f} * {TEXT_WEIGHT}) = {final_score:.4f}"
-            )
-            logger.info(log_msg)
+            if DEBUG_LOGGING:
+                logger.info(
+                    f"Расчет для игры ID: {game_id}\n"
+                    f"  - Summary Scores: {[f'{s:.4f}' for s in summary_scores]}\n"
+                    f"  - -> Max Summary Score (A): {summary_score:.4f}\n"
+                    f"  - Text Scores (sorted): {[f'{s:.4f}' for s in sorted_text_scores]}\n"
+                    f"  - -> Raw Text Score (decayed sum): {text_score:.4f}\n"
+                    f"  - -> Normalized Text Score (B): {normalized_text_score:.4f}\n"
+                    f"  >>> ИТОГОВАЯ ФОРМУЛА: (A * {summary_weight}) + (B * {text_weight})\n"
+                    f"  >>> РЕЗУЛЬТАТ: ({summary_score:.4f} * {summary_weight}) + ({normalized_text_score:.4f} * {text_weight}) = {final_score:.4f}"
+                )
             
         # 5. Сортировка и выбор топ-результатов
         sorted_games = sorted(final_game_scores.items(), key=lambda item: item[1]["score"], reverse=True)
-        top_games = sorted_games[:20]
-        top_game_ids = [g_id for g_id, data in top_games]
+        return sorted_games[:MAX_RANKED_GAMES], breakdown
 
-        if not top_game_ids:
-            return {"results": [], "mode_used": mode}
-        
-        logger.info("\n--- [Фаза 4] Финальный топ-20 ---")
-        for i, (game_id, score_data) in enumerate(top_games):
-             logger.info(f"  #{i+1}: ID={game_id}, Final Score={score_data['score']:.4f}")
-
-        # 6. Получение метаданных из БД и формирование ответа
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        placeholders = ','.join('?' * len(top_game_ids))
-        sql = f"SELECT pocketbase_id, title, summary FROM games WHERE pocketbase_id IN ({placeholders})"
-        cursor.execute(sql, top_game_ids)
-        rows = cursor.fetchall()
-        conn.close()
+@app.get("/api/semantic-search")
 
-        game_meta_map = {row[0]: (row[1], row[2]) for row in rows}
-        
-        results = []
-        for game_id, score_data in top_games:
-            if game_id in game_meta_map:
-                title, summary = game_meta_map[game_id]
-                summary_snippet = (summary[:200] + "...") if summary else ""
-                
-                display_score = min(int(score_data["score"] * 100), 100)
-
-                results.append({
-                    "id": game_id,
-                    "title": title,
-                    "url": f"{BASE_GAME_URL}{game_id}",
-                    "score": display_score,
-                    "match_type": score_data["match_type"],
-                    "snippet": summary_snippet
+async def search_games(
+    request: Request,
+    q: str = Query(..., min_length=2),
+    mode: SearchMode = Query(SearchMode.mixed, description="Режим поиска: по тексту, по описанию или смешанный"),
+    k: Optional[int] = Query(None, ge=1, le=2048, description=f"Кандидатов-чанков из Faiss (по умолчанию {DEFAULT_K}); в двухстадийном поиске - игр в коротком списке: {GAME_SHORTLIST} * k / {DEFAULT_K}"),
+    threshold: Optional[float] = Query(None, description=f"Порог оценки чанка (по умолчанию {DEFAULT_THRESHOLD})"),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX, description="Размер первой страницы"),
+    kind: Optional[GameKind] = Query(None, description="Только статичные (картинки) или только интерактивные CYOA"),
+    has_summary: bool = Query(False, description="Только игры с AI-описанием"),
+    variant: Optional[str] = Query(None, description="Вариант ранжирования из ranking_variants.json"),
+    summary_weight: Optional[float] = None,
+    text_weight: Optional[float] = None,
+    decay: Optional[float] = Query(None, gt=0, le=1),
+    text_divisor: Optional[float] = Query(None, gt=0),
+    debug: bool = Query(False, description="Вернуть в ответе разбор ранжирования и время фаз (без кэша)")
+):
+    if not faiss_index or not chunk_map:
+        raise HTTPException(status_code=503, detail="Индекс не готов.")
+
+    params = ranking_params(variant, k=k, threshold=threshold, summary_weight=summary_weight,
+                            text_weight=text_weight, decay=decay, text_divisor=text_divisor)
+    started_at = time.perf_counter()
+    normalized_q = normalize_query(q)
+    generation = index_generation
+    attributes = tuple(([kind.value] if kind else []) + (["summary"] if has_summary else []))
+    cache_key = (normalized_q, mode.value, tuple(sorted(params.items())), limit, attributes, generation)
+    log_context = {key: value for key, value in (("filters", list(attributes)), ("variant", variant)) if value}
+    # Трассировка собирается только по запросу: при debug=0 это просто None и проверки "is not None"
+    trace = None
+    if debug:
+        trace = {
+            "query": normalized_q, "mode": mode.value, "filters": list(attributes),
+            "variant": variant, "params": params,
+            "index_generation": generation, "phases_ms": {}, "games": []
+        }
+    else:
+        cached = search_cache.get(cache_key)
+        if cached is not None:
+            SEARCH_REQUESTS.inc(mode.value, "hit")
+            SEARCH_REQUEST_SECONDS.observe(time.perf_counter() - started_at, "hit")
+            log_user_query(q, mode, started_at, cached.meta, cached=True, context=log_context)
+            return cached.to_response(request)
+    SEARCH_REQUESTS.inc(mode.value, "debug" if debug else "miss")
+
+    if DEBUG_LOGGING:
+        logger.info(f"\n{'='*25} НОВЫЙ ПОИСКОВЫЙ ЗАПРОС {'='*25}")
+        logger.info(f"Query: '{q}' | Mode: {mode} | params: {params}")
+    
+    try:
+        # 0. Запрос - это название игры? Поиск по индексу названий занимает микросекунды, но раз
+        # в GENERATION_CHECK_INTERVAL он читает поколение каталога из базы - поэтому в пуле потоков
+        with phase_timer("title", trace):
+            exact_titles = await asyncio.to_thread(exact_title_matches, normalized_q, attributes)
+        if exact_titles:
+            TITLE_MATCHES.inc(EXACT_TITLE_POLICY)
+            if trace is not None:
+                trace["title_matches"] = exact_titles
+            if EXACT_TITLE_POLICY == "short_circuit":
+                results = await asyncio.to_thread(title_results, exact_titles)
+                entry = search_response(cache_key, generation, results, mode, trace, "title")
+                log_user_query(q, mode, started_at, entry.meta, context=log_context)
+                SEARCH_REQUEST_SECONDS.observe(time.perf_counter() - started_at, "miss")
+                return entry.to_response(request)
+
+        # 1. Эмбеддинг запроса - с бюджетом задержки; параллельно идет лексический поиск
+        loop = asyncio.get_running_loop()
+        lexical_future = None
+        status = {} # Отчет о шардах индекса (если поиск идет по шардам)
+        if lexical_index is not None:
+            lexical_future = loop.run_in_executor(None, lexical_search, lexical_index, normalized_q, mode, trace)
+        q_vec = await embed_with_budget(loop, normalized_q, trace, has_fallback=lexical_future is not None)
+        lexical_games = await lexical_future if lexical_future is not None else None
+        if lexical_games and attributes:
+            lexical_games = [g for g in lexical_games if passes_filters(g[0], attributes)]
+
+        if q_vec is None:
+            # Gemini не успел или недоступен - отвечаем из лексического индекса
+            if lexical_games is None:
+                raise HTTPException(status_code=503, detail="Поиск временно недоступен.")
+            served_by = "lexical"
+            top_games = [(game_id, {"score": None, "lexical": score, "match_type": "keyword"})
+                         for game_id, score, _ in lexical_games]
+            breakdown = None
+        else:
+            # В пуле потоков: ранжирование ждет общую пачку Faiss и не должно держать цикл событий
+            top_games, breakdown = await loop.run_in_executor(
+                None, semantic_ranking, q_vec, mode, params, trace, attributes, status)
+            served_by = "semantic"
+            if lexical_games:
+                served_by = "hybrid"
+                top_games = fuse_rankings(top_games, lexical_games, MAX_RANKED_GAMES)
+        SEARCH_SERVED_BY.inc(served_by)
+        if trace is not None:
+            trace["served_by"] = served_by
+        # Точные совпадения по названию - первыми (без дублей)
+        top_games = boost_title_matches(top_games, exact_titles)
+        # Весь ранжированный список: первая страница отдается сразу, остальное - по курсору
+        ranked = [(game_id, display_score(data), data["match_type"]) for game_id, data in top_games]
+
+        if DEBUG_LOGGING:
+            logger.info(f"\n--- [Фаза 4] Финальный топ-{limit} ---")
+            for i, (game_id, score_data) in enumerate(top_games[:limit]):
+                logger.info(f"  #{i+1}: ID={game_id}, Final Score={score_data['score']}, BM25={score_data.get('lexical')}")
+
+        # 6. Получение метаданных из БД (в пуле потоков - медленный запрос не должен держать цикл событий)
+        with phase_timer("db", trace):
+            results = await asyncio.to_thread(hydrate_results, ranked[:limit])
+        if not results and DEBUG_LOGGING:
+            logger.info("Порог релевантности не пройден ни одним чанком. Результатов нет.")
+
+        if trace is not None:
+            score_map = dict(top_games)
+            for result in results:
+                score_data = score_map[result["id"]]
+                trace["games"].append({
+                    "id": result["id"], "title": result["title"], **(breakdown or {}).get(result["id"], {}),
+                    **{key: score_data[key] for key in ("lexical", "rrf") if key in score_data}
                 })
+
+        next_cursor = encode_search_cursor(ranked[limit:], mode, served_by) if len(ranked) > limit else None
+
+        # Компактное логирование запроса и результатов
+        partial = None
+        report = status.get("shards")
+        if report and report["missing"]:
+            SEARCH_PARTIAL.inc()
+            partial = {"shards": report["shards"], "missing_shards": report["missing"]}
+        entry = search_response(cache_key, generation, results, mode, trace, served_by, next_cursor, partial)
+        log_user_query(q, mode, started_at, entry.meta, context=log_context)
+        SEARCH_REQUEST_SECONDS.observe(time.perf_counter() - started_at, "miss")
         
-        # --- НОВЫЙ БЛОК: Компактное логирование запроса и результатов ---
-        try:
-            log_entry = {
-                "timestamp": datetime.now().isoformat(),
-                "query": q,
-                "mode": mode.value,
-                "results_count": len(results),
-                "top_results": [
-                    {"id": r["id"], "title": r["title"], "score": r["score"]} 
-                    for r in results[:3]
-                ]
-            }
-            # Преобразуем в JSON и записываем в лог
-            query_logger.info(json.dumps(log_entry, ensure_ascii=False))
-        except Exception as log_e:
-            # Не ломаем ответ пользователю, если логирование упало.
-            print(f"ERROR: Could not write user query to log: {log_e}")
-        # --- КОНЕЦ НОВОГО БЛОКА ---
-        
-        logger.info(f"{'='*28} КОНЕЦ ЗАПРОСА {'='*28}\n")
-        return {"results": results, "mode_used": mode}
+        if DEBUG_LOGGING:
+            logger.info(f"{'='*28} КОНЕЦ ЗАПРОСА {'='*28}\n")
+        return entry.to_response(request)
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.info(f"КРИТИЧЕСКАЯ ОШИБКА ПОИСКА: {e}")
-        # --- НОВЫЙ БЛОК: Логируем также и ошибку в файл запросов ---
-        try:
-            log_entry = {
-                "timestamp": datetime.now().isoformat(),
-                "query": q,
-                "mode": mode.value,
-                "error": str(e)
-            }
-            query_logger.info(json.dumps(log_entry, ensure_ascii=False))
-        except Exception as log_e:
-             print(f"ERROR: Could not write user query error to log: {log_e}")
-        # --- КОНЕЦ НОВОГО БЛОКА ---
+        SEARCH_ERRORS.inc(mode.value)
+        logger.info("КРИТИЧЕСКАЯ ОШИБКА ПОИСКА: %s", e)
+        # Логируем также и ошибку в файл запросов
+        log_user_query(q, mode, started_at, {"error": str(e)}, context=log_context)
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- Статика и вспомогательные роуты (без изменений) ---
@@ -315,47 +1278,193 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 async def read_root():
     return FileResponse("static/index.html")
 
+# Обработчики с запросами к SQLite объявлены через def, а не async def: FastAPI выполняет их
+# в пуле потоков, и медленный запрос к базе не останавливает остальные запросы воркера
 @app.get("/stats")
-async def get_stats():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    total = cur.execute("SELECT COUNT(*) FROM games").fetchone()[0]
-    with_text = cur.execute("SELECT COUNT(*) FROM games WHERE full_text IS NOT NULL AND full_text != ''").fetchone()[0]
-    with_summary = cur.execute("SELECT COUNT(*) FROM games WHERE summary IS NOT NULL AND summary != ''").fetchone()[0]
-    indexed = cur.execute("SELECT COUNT(*) FROM games WHERE last_indexed_at IS NOT NULL").fetchone()[0]
-    conn.close()
-    return {"total": total, "with_text": with_text, "with_summary": with_summary, "indexed": indexed}
-
-@app.get("/games", response_model=List[Dict[str, Any]])
-async def get_all_games():
-    """Возвращает список всех игр в базе данных с их статусами."""
+def get_stats():
+    # Счетчики поддерживаются триггерами в базе - никаких полных проходов по таблице
+    conn = storage.connect_readonly(DB_FILE)
     try:
-        conn = sqlite3.connect(DB_FILE)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT 
-                title, 
-                summary, 
-                last_indexed_at 
-            FROM games 
-            ORDER BY title ASC
-        """)
-        rows = cursor.fetchall()
+        counters = storage.read_counters(conn)
+    except sqlite3.OperationalError:
+        raise HTTPException(status_code=503, detail="Схема базы устарела: запустите create_database.py")
+    finally:
         conn.close()
+    return {name: counters.get(name, 0) for name in ("total", "with_text", "with_summary", "indexed")}
 
-        games_list = []
-        for row in rows:
-            games_list.append({
-                "title": row["title"],
-                "summary": row["summary"],
-                "has_summary": bool(row["summary"]),
-                "is_indexed": row["last_indexed_at"] is not None
-            })
-        
-        return games_list
+def encode_games_cursor(title, game_id):
+    """Непрозрачный курсор каталога: позиция последней отданной игры в порядке (title, id)."""
+    raw = json.dumps([title, game_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_games_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        title, game_id = json.loads(raw)
+        return str(title), str(game_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор.")
+
+def current_catalog_generation():
+    """Поколение каталога из базы; читается не чаще раза в GENERATION_CHECK_INTERVAL секунд."""
+    global catalog_generation, catalog_generation_checked_at
+    now = time.monotonic()
+    if catalog_generation is None or now - catalog_generation_checked_at >= GENERATION_CHECK_INTERVAL:
+        conn = storage.connect_readonly(DB_FILE)
+        try:
+            catalog_generation = storage.read_generation(conn)
+        finally:
+            conn.close()
+        catalog_generation_checked_at = now
+        games_cache.set_generation(catalog_generation)
+    return catalog_generation
+
+def build_games_page(cursor, limit, lite):
+    conn = storage.connect_readonly(DB_FILE)
+    conn.row_factory = sqlite3.Row
+    try:
+        columns = "pocketbase_id, title, summary IS NOT NULL AS has_summary, last_indexed_at"
+        if not lite:
+            columns += ", summary"
+        # Keyset-пагинация по индексу idx_games_title: стоимость страницы не зависит от ее номера
+        if cursor:
+            after_title, after_id = decode_games_cursor(cursor)
+            rows = conn.execute(f"""
+                SELECT {columns} FROM games
+                WHERE (title, pocketbase_id) > (?, ?)
+                ORDER BY title ASC, pocketbase_id ASC LIMIT ?
+            """, (after_title, after_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(
+                f"SELECT {columns} FROM games ORDER BY title ASC, pocketbase_id ASC LIMIT ?", (limit + 1,)
+            ).fetchall()
+    finally:
+        conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    games_list = []
+    for row in rows:
+        game = {
+            "id": row["pocketbase_id"],
+            "title": row["title"],
+            "has_summary": bool(row["has_summary"]),
+            "is_indexed": row["last_indexed_at"] is not None
+        }
+        if not lite:
+            game["summary"] = row["summary"]
+        games_list.append(game)
 
+    next_cursor = encode_games_cursor(rows[-1]["title"], rows[-1]["pocketbase_id"]) if has_more else None
+    return {"games": games_list, "next_cursor": next_cursor}
+
+@app.get("/api/semantic-search/next")
+def search_next_page(
+    cursor: str = Query(..., description="next_cursor из предыдущего ответа поиска"),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX)
+):
+    """Следующая страница выдачи: срез списка из курсора и метаданные из базы, без повторного поиска."""
+    if not faiss_index or not chunk_map:
+        raise HTTPException(status_code=503, detail="Индекс не готов.")
+    stamp, mode, served_by, ranked = decode_search_cursor(cursor)
+    if stamp != index_stamp():
+        raise HTTPException(status_code=410, detail="Индекс обновился, повторите поиск.")
+    with phase_timer("db"):
+        results = hydrate_results(ranked[:limit])
+    next_cursor = encode_search_cursor(ranked[limit:], mode, served_by) if len(ranked) > limit else None
+    return {"results": results, "mode_used": mode.value, "served_by": served_by, "next_cursor": next_cursor}
+
+@app.get("/api/similar/{game_id}")
+def similar_games(game_id: str, limit: int = Query(10, ge=1, le=similar.NEIGHBORS)):
+    """Похожие игры по заранее посчитанным соседям (индексатор) - без Gemini и Faiss."""
+    conn = storage.connect_readonly(DB_FILE)
+    try:
+        neighbors = similar.load_neighbors(conn, game_id, limit)
+    except sqlite3.OperationalError:
+        raise HTTPException(status_code=503, detail="Списки похожих игр еще не построены.")
+    finally:
+        conn.close()
+    if neighbors is None:
+        raise HTTPException(status_code=404, detail="Игра не найдена в индексе.")
+    return {
+        "game_id": game_id,
+        "results": [{
+            "id": pb_id,
+            "title": title,
+            "url": f"{BASE_GAME_URL}{pb_id}",
+            "score": min(int(score * 100), 100),
+            "snippet": (summary[:200] + "...") if summary else ""
+        } for pb_id, title, summary, score in neighbors]
+    }
+
+@app.get("/api/autocomplete")
+def autocomplete(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(AUTOCOMPLETE_LIMIT, ge=1, le=50)
+):
+    """Подсказки по названиям игр: префикс названия или слова, затем нечеткие совпадения."""
+    return {"suggestions": get_title_index().suggest(q, limit)}
+
+@app.get("/health")
+async def health():
+    """Проверка живости: процесс отвечает (индекс может еще загружаться)."""
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    """Готовность к поиску: индекс загружен и прогрет. 503, пока нет - балансировщик не шлет сюда запросы."""
+    state = {**startup_state, "phases_ms": dict(startup_state["phases_ms"]),
+             "index_vectors": faiss_index.ntotal if faiss_index else 0}
+    return JSONResponse(state, status_code=200 if state["status"] == "ready" else 503)
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/stats/cache")
+async def get_cache_stats():
+    """Эффективность кэшей ответов (попадания, объем, вытеснения)."""
+    return {"search": search_cache.stats(), "games": games_cache.stats()}
+
+@app.get("/stats/batching")
+async def get_batching_stats():
+    """Микро-батчинг: распределение размеров пачек и времени ожидания запросов."""
+    return {name: batcher.stats() if batcher is not None else None
+            for name, batcher in (("embed", embed_batcher), ("faiss", faiss_batcher))}
+
+@app.get("/games")
+def get_all_games(
+    request: Request,
+    cursor: Optional[str] = Query(None, description="Курсор из next_cursor предыдущей страницы"),
+    limit: int = Query(GAMES_PAGE_SIZE, ge=1, le=GAMES_PAGE_MAX),
+    lite: bool = Query(True, description="Без текстов описаний (их можно получить через /games/{id}/summary)")
+):
+    """Постраничный список игр с их статусами. Готовые страницы кэшируются до изменения базы."""
+    try:
+        generation = current_catalog_generation()
+        key = (cursor, limit, lite)
+        entry = games_cache.get(key)
+        if entry is None:
+            page = build_games_page(cursor, limit, lite)
+            page["generation"] = generation
+            entry = CachedResponse.from_json(page)
+            games_cache.put(key, entry, generation)
+        return entry.to_response(request, {"Cache-Control": "no-cache"})
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error fetching all games: {e}")
-        raise HTTPException(status_code=500, detail="Could not fetch game list from database.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Could not fetch game list from database.")
+
+@app.get("/games/{game_id}/summary")
+def get_game_summary(game_id: str):
+    """Описание одной игры - подгружается интерфейсом по клику."""
+    conn = storage.connect_readonly(DB_FILE)
+    try:
+        row = conn.execute("SELECT title, summary FROM games WHERE pocketbase_id = ?", (game_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Игра не найдена.")
+    return {"id": game_id, "title": row[0], "summary": row[1]}
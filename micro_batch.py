@@ -0,0 +1,140 @@
+# micro_batch.py
+# Микро-батчинг: запросы, пришедшие почти одновременно, собираются в пачку и обрабатываются
+# одним вызовом (один embed_content на несколько текстов, один многострочный search в Faiss).
+# Пачка отправляется, когда истекло окно ожидания с момента прихода ее первого запроса или
+# набралось max_batch различных запросов; одинаковые запросы в пачке считаются один раз.
+# Пока пачка выполняется в пуле потоков, следующая уже собирается. Если все max_in_flight
+# пачек еще выполняются, новая продолжает набираться, а не стоит в очереди пула.
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+import metrics
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+RECENT_WAITS = 1000  # Сколько последних ожиданий хранить для перцентилей в /stats/batching
+SLOT_POLL_SECONDS = 0.001
+
+BATCH_SIZE = metrics.Histogram(
+    "micro_batch_size", "Различных запросов в пачке", ("batcher",), BATCH_SIZE_BUCKETS)
+BATCH_WAIT_SECONDS = metrics.Histogram(
+    "micro_batch_wait_seconds", "Ожидание запроса в очереди до отправки его пачки", ("batcher",))
+BATCH_DEDUPLICATED = metrics.Counter(
+    "micro_batch_deduplicated_total", "Одинаковые запросы, объединенные внутри пачки", ("batcher",))
+
+
+class MicroBatcher:
+    def __init__(self, name, fn, window, max_batch, executor, max_in_flight):
+        """
+        fn(keys) -> список результатов в том же порядке (ключи хэшируемые и различные).
+        window - окно сбора пачки в секундах, executor - пул, в котором выполняется fn
+        (не больше max_in_flight пачек одновременно).
+        """
+        self.name = name
+        self.fn = fn
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = executor
+        self._queue = queue.SimpleQueue()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._sizes = {}
+        self._waits = deque(maxlen=RECENT_WAITS)
+        threading.Thread(target=self._collect, name=f"batch-{name}", daemon=True).start()
+
+    def submit(self, key):
+        """Future с результатом fn для key; отмененный до отправки запрос в пачку не попадет."""
+        future = Future()
+        self._queue.put((key, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        while True:
+            key, future, submitted = self._queue.get()
+            groups = {key: [(future, submitted)]}
+            # Окно считается от прихода первого запроса: если он ждал, пока выполнялась
+            # предыдущая пачка, новая уходит сразу
+            deadline = submitted + self.window
+            while len(groups) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    key, future, submitted = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                groups.setdefault(key, []).append((future, submitted))
+            # Все слоты заняты - пачка растет дальше, пока какой-нибудь не освободится
+            while not self._slots.acquire(timeout=SLOT_POLL_SECONDS if len(groups) < self.max_batch else None):
+                self._drain(groups)
+            self._dispatch(groups)
+
+    def _drain(self, groups):
+        while len(groups) < self.max_batch:
+            try:
+                key, future, submitted = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            groups.setdefault(key, []).append((future, submitted))
+
+    def _dispatch(self, groups):
+        now = time.perf_counter()
+        live = {}
+        for key, waiters in groups.items():
+            futures = [future for future, _ in waiters if future.set_running_or_notify_cancel()]
+            if futures:
+                live[key] = futures
+        if not live:
+            self._slots.release()
+            return
+        requests = sum(len(futures) for futures in live.values())
+        BATCH_SIZE.observe(len(live), self.name)
+        if requests > len(live):
+            BATCH_DEDUPLICATED.inc(self.name, amount=requests - len(live))
+        with self._lock:
+            self._batches += 1
+            self._requests += requests
+            self._sizes[len(live)] = self._sizes.get(len(live), 0) + 1
+            for waiters in groups.values():
+                for _, submitted in waiters:
+                    BATCH_WAIT_SECONDS.observe(now - submitted, self.name)
+                    self._waits.append(now - submitted)
+        self.executor.submit(self._execute, live)
+
+    def _execute(self, live):
+        keys = list(live)
+        try:
+            results = self.fn(keys)
+        except Exception as e:
+            for futures in live.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        for key, result in zip(keys, results):
+            for future in live[key]:
+                future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            sizes = dict(sorted(self._sizes.items()))
+            batches, requests = self._batches, self._requests
+        distinct = sum(size * count for size, count in sizes.items())
+
+        def wait_ms(share):
+            return round(waits[min(len(waits) - 1, int(share * len(waits)))] * 1000, 3) if waits else None
+
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": batches,
+            "requests": requests,
+            "mean_batch_size": round(distinct / batches, 2) if batches else None,
+            "batch_sizes": sizes,
+            "wait_ms": {"p50": wait_ms(0.50), "p95": wait_ms(0.95), "p99": wait_ms(0.99)},
+        }
@@ -0,0 +1,118 @@
+# mock_gemini.py
+# Локальная заглушка API эмбеддингов Gemini (embedContent и batchEmbedContents) для нагрузочных
+# тестов и проверки индексатора без квоты и сети. Задержка и доля ошибок настраиваются.
+#
+#   python mock_gemini.py --latency-ms 150 --jitter-ms 50 --error-rate 0.02 --port 8300
+#   GEMINI_API_ENDPOINT=http://127.0.0.1:8300 GOOGLE_API_KEY=mock uvicorn main:app --port 8100
+#   python load_test.py --url http://127.0.0.1:8100 --mock-url http://127.0.0.1:8300 ...
+#
+# Векторы детерминированы по тексту (одинаковый текст - одинаковый вектор) и убывают по
+# компонентам, как эмбеддинги Matryoshka. GET /stats - счетчики запросов, текстов и ошибок.
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ROUTE = re.compile(r"^/v1(?:beta)?/models/([^/:]+):(embedContent|batchEmbedContents)$")
+DEFAULT_DIMENSION = 768
+
+
+def fake_embedding(text, dimension):
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:4], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    vector /= np.sqrt(1 + np.arange(dimension) / 16)
+    return (vector / np.linalg.norm(vector)).round(6).tolist()
+
+def _text(request):
+    return " ".join(part.get("text", "") for part in request.get("content", {}).get("parts", []))
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    error_status = 500
+    counters = None
+    lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            with self.lock:
+                self._send_json(200, dict(self.counters))
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found."}})
+
+    def do_POST(self):
+        match = ROUTE.match(urlparse(self.path).path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not match:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found."}})
+            return
+        requests = body.get("requests", []) if match.group(2) == "batchEmbedContents" else [body]
+        # Задержка как у сетевого вызова: база плюс равномерный разброс
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            self._count(requests=1, errors=1)
+            self._send_json(self.error_status, {"error": {"code": self.error_status, "message": "Injected error."}})
+            return
+        self._count(requests=1, texts=len(requests), **{match.group(2): 1})
+        embeddings = [{"values": fake_embedding(_text(r), int(r.get("outputDimensionality") or DEFAULT_DIMENSION))}
+                      for r in requests]
+        if match.group(2) == "batchEmbedContents":
+            self._send_json(200, {"embeddings": embeddings})
+        else:
+            self._send_json(200, {"embedding": embeddings[0]})
+
+
+def serve(host="127.0.0.1", port=8300, latency_ms=150, jitter_ms=0, error_rate=0.0, error_status=500, in_thread=False):
+    """Запускает заглушку. С in_thread=True возвращает сервер, работающий в фоне."""
+    handler = type("Handler", (MockGeminiHandler,), {
+        "latency": latency_ms / 1000, "jitter": jitter_ms / 1000, "error_rate": error_rate,
+        "error_status": error_status, "counters": {}, "lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    if in_thread:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f"Заглушка Gemini слушает http://{host}:{server.server_port} "
+          f"(задержка {latency_ms}±{jitter_ms} мс, ошибки {error_rate:.0%} -> {error_status})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка API эмбеддингов Gemini.")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8300)
+    parser.add_argument('--latency-ms', type=float, default=150)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля запросов, завершающихся ошибкой (0..1).")
+    parser.add_argument('--error-status', type=int, default=500, help="HTTP-статус ошибки (например, 429 или 503).")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.error_status)
@@ -0,0 +1,172 @@
+# mock_pocketbase.py
+# Локальная заглушка REST API записей PocketBase для проверки sync_with_pocketbase.py без cyoa.cafe.
+#
+#   python mock_pocketbase.py records.json --port 8090
+#   python sync_with_pocketbase.py --url http://127.0.0.1:8090
+#
+# records.json - JSON-список записей коллекции games (поля как в PocketBase: id, collectionId,
+# title, img_or_link, iframe_url, cyoa_pages, created, updated). Файл перечитывается на каждый
+# запрос, поэтому изменения/удаления можно имитировать, просто редактируя его между запусками синхронизации.
+import re
+import json
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\(|\)|&&|\|\|)|(\w+)\s*(>=|<=|!=|>|<|=)\s*"([^"]*)")')
+OPERATORS = {
+    ">=": lambda a, b: a >= b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    "<": lambda a, b: a < b,
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+}
+
+def parse_filter(expression):
+    """
+    Подмножество синтаксиса фильтров: условия вида field op "value", && и || (&& связывает
+    сильнее) и скобки. Возвращает предикат для записи.
+    """
+    tokens, pos = [], 0
+    while expression[pos:].strip():
+        match = TOKEN_PATTERN.match(expression, pos)
+        if not match:
+            raise ValueError(f"Неподдерживаемый фильтр: {expression[pos:]!r}")
+        tokens.append(match.group(1) or match.group(2, 3, 4))
+        pos = match.end()
+    tokens.append(None)
+    position = [0]
+
+    def take():
+        token = tokens[position[0]]
+        position[0] += 1
+        return token
+
+    def parse_or():
+        parts = [parse_and()]
+        while tokens[position[0]] == "||":
+            take()
+            parts.append(parse_and())
+        return lambda r: any(part(r) for part in parts)
+
+    def parse_and():
+        parts = [parse_atom()]
+        while tokens[position[0]] == "&&":
+            take()
+            parts.append(parse_atom())
+        return lambda r: all(part(r) for part in parts)
+
+    def parse_atom():
+        token = take()
+        if token == "(":
+            inner = parse_or()
+            if take() != ")":
+                raise ValueError(f"Незакрытая скобка в фильтре: {expression!r}")
+            return inner
+        if not isinstance(token, tuple):
+            raise ValueError(f"Неподдерживаемый фильтр: {expression!r}")
+        field, op, value = token
+        return lambda r: OPERATORS[op](str(r.get(field, "")), value)
+
+    predicate = parse_or()
+    if tokens[position[0]] is not None:
+        raise ValueError(f"Неподдерживаемый фильтр: {expression!r}")
+    return predicate
+
+def apply_filter(records, expression):
+    predicate = parse_filter(expression)
+    return [r for r in records if predicate(r)]
+
+def apply_sort(records, expression):
+    # Сортировки применяем с конца, чтобы первая была главной (сортировка в Python стабильна)
+    for field in reversed([f.strip() for f in expression.split(",") if f.strip()]):
+        reverse = field.startswith("-")
+        field = field.lstrip("-+")
+        records = sorted(records, key=lambda r: str(r.get(field, "")), reverse=reverse)
+    return records
+
+
+class MockPocketBaseHandler(BaseHTTPRequestHandler):
+    records_path = None
+
+    def log_message(self, format, *args):
+        pass  # Не засоряем вывод синхронизации
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if path in ("/api/collections/_superusers/auth-with-password", "/api/admins/auth-with-password"):
+            self._send_json(200, {"token": "mock-token", "record": {"id": "mockadmin"}})
+        else:
+            self._send_json(404, {"message": "Not found."})
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        match = re.fullmatch(r"/api/collections/([^/]+)/records", parsed.path)
+        if not match:
+            self._send_json(404, {"message": "Not found."})
+            return
+
+        query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+        with open(self.records_path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+
+        try:
+            if query.get("filter"):
+                records = apply_filter(records, query["filter"])
+            if query.get("sort"):
+                records = apply_sort(records, query["sort"])
+        except ValueError as e:
+            self._send_json(400, {"message": str(e)})
+            return
+
+        page = max(1, int(query.get("page", 1)))
+        per_page = max(1, min(1000, int(query.get("perPage", 30))))
+        items = records[(page - 1) * per_page: page * per_page]
+        if query.get("fields"):
+            fields = [f.strip() for f in query["fields"].split(",")]
+            items = [{k: r[k] for k in fields if k in r} for r in items]
+
+        skip_total = query.get("skipTotal") in ("1", "true")
+        self._send_json(200, {
+            "page": page,
+            "perPage": per_page,
+            "totalItems": -1 if skip_total else len(records),
+            "totalPages": -1 if skip_total else (len(records) + per_page - 1) // per_page,
+            "items": items,
+        })
+
+
+def serve(records_path, host="127.0.0.1", port=8090, in_thread=False):
+    """Запускает заглушку. С in_thread=True возвращает сервер, работающий в фоне."""
+    handler = type("Handler", (MockPocketBaseHandler,), {"records_path": records_path})
+    server = ThreadingHTTPServer((host, port), handler)
+    if in_thread:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f"Заглушка PocketBase слушает http://{host}:{server.server_port} (записи: {records_path})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка REST API PocketBase.")
+    parser.add_argument('records', help="JSON-файл со списком записей коллекции games.")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8090)
+    args = parser.parse_args()
+    serve(args.records, args.host, args.port)
@@ -0,0 +1,529 @@
+# pipeline.py
+# Единый инкрементальный конвейер: sync -> извлечение текста (fetch/OCR) -> описание -> индекс.
+#
+# Для каждой игры и каждого этапа хранится явное состояние (таблица game_stage_state)
+# с отпечатком входных данных этапа. Через этап проходят только "грязные" игры:
+# новые, с изменившимся входом или упавшие (с ограниченным числом повторов).
+# Этапы работают параллельно: игра, у которой уже есть текст, идет на описание,
+# пока другие еще скачиваются. Все события пишутся в журнал запусков (pipeline_runs /
+# pipeline_events), прерванный запуск продолжается со следующего старта.
+#
+#   python pipeline.py                # один проход по всем грязным играм
+#   python pipeline.py --watch        # работать постоянно (sync раз в --sync-interval секунд)
+#   python pipeline.py --status       # сводка по этапам и последним запускам
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+import traceback
+import concurrent.futures
+from datetime import datetime
+from dotenv import load_dotenv
+
+import storage
+from create_database import ensure_schema
+
+# --- Конфигурация ---
+load_dotenv()
+DB_FILE = "games.db"
+
+STAGES = ("extract", "summary", "index")
+MAX_ATTEMPTS = 3            # Столько раз подряд игра может упасть на этапе, потом ждет изменения входа
+RETRY_BACKOFF = 600         # Сек: пауза перед повтором упавшей игры (умножается на число попыток)
+SCAN_INTERVAL = 30          # Сек: как часто искать грязные игры в базе
+SYNC_INTERVAL = 300         # Сек: как часто синхронизироваться с PocketBase в режиме --watch
+INDEX_DEBOUNCE = 60         # Сек тишины после последнего изменения перед пересборкой индекса
+INDEX_MAX_DELAY = 300       # Но не дольше этого с момента первого изменения
+
+_STOP = object()
+
+
+def _md5(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest() if value is not None else None
+
+def connect(db_file=DB_FILE, **kwargs):
+    """Соединение для потока конвейера: с таймаутом блокировки и функцией md5() в SQL."""
+    conn = storage.connect(db_file, **kwargs)
+    conn.create_function("md5", 1, _md5, deterministic=True)
+    return conn
+
+def ensure_pipeline_schema(conn):
+    ensure_schema(conn)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS game_stage_state (
+            pocketbase_id TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            status TEXT NOT NULL,          -- pending / running / done / failed
+            input_hash TEXT,               -- отпечаток входа, с которым этап выполнялся
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (pocketbase_id, stage)
+        );
+        CREATE INDEX IF NOT EXISTS idx_stage_state_status ON game_stage_state (stage, status);
+
+        CREATE TABLE IF NOT EXISTS pipeline_runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            status TEXT,
+            args TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS pipeline_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER,
+            ts TIMESTAMP,
+            pocketbase_id TEXT,
+            stage TEXT,
+            event TEXT,
+            detail TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_pipeline_events_run ON pipeline_events (run_id);
+    """)
+    conn.commit()
+
+
+# --- Отпечатки входа для каждого этапа (SQL-выражения над таблицей games g) ---
+EXTRACT_FINGERPRINT = "md5(coalesce(g.original_url, '') || '|' || coalesce(g.image_urls, ''))"
+SUMMARY_FINGERPRINT = "g.source_hash"
+INDEX_FINGERPRINT = "md5(coalesce(g.source_hash, '') || ':' || coalesce(g.summary, ''))"
+
+def _dirty_condition(fingerprint):
+    """Общее условие "игру нужно (пере)обработать на этапе"."""
+    return f"""(
+        s.status IS NULL
+        OR s.input_hash IS NOT {fingerprint}
+        OR s.status = 'pending'
+        OR (s.status = 'failed' AND s.attempts < :max_attempts AND s.updated_at < :now - :backoff * s.attempts)
+    )"""
+
+DIRTY_QUERIES = {
+    "extract": f"""
+        SELECT g.pocketbase_id, g.title, g.original_url, g.image_urls, {EXTRACT_FINGERPRINT}
+        FROM games g
+        LEFT JOIN game_stage_state s ON s.pocketbase_id = g.pocketbase_id AND s.stage = 'extract'
+        WHERE (g.original_url IS NOT NULL OR (g.image_urls IS NOT NULL AND g.image_urls != '[]'))
+          AND ({_dirty_condition(EXTRACT_FINGERPRINT)} OR (s.status = 'done' AND g.needs_fetch = 1))
+    """,
+    "summary": f"""
+        SELECT g.pocketbase_id, g.title, {SUMMARY_FINGERPRINT}
+        FROM games g
+        LEFT JOIN game_stage_state s ON s.pocketbase_id = g.pocketbase_id AND s.stage = 'summary'
+        WHERE g.source_hash IS NOT NULL
+          AND ({_dirty_condition(SUMMARY_FINGERPRINT)} OR (s.status = 'done' AND g.summary IS NULL))
+    """,
+    "index": f"""
+        SELECT g.pocketbase_id, {INDEX_FINGERPRINT}
+        FROM games g
+        LEFT JOIN game_stage_state s ON s.pocketbase_id = g.pocketbase_id AND s.stage = 'index'
+        WHERE (g.source_hash IS NOT NULL OR g.summary IS NOT NULL)
+          AND {_dirty_condition(INDEX_FINGERPRINT)}
+    """,
+}
+
+def find_dirty(conn, stage):
+    params = {"max_attempts": MAX_ATTEMPTS, "now": time.time(), "backoff": RETRY_BACKOFF}
+    return conn.execute(DIRTY_QUERIES[stage], params).fetchall()
+
+def set_stage_state(conn, pb_id, stage, status, input_hash=None, error=None):
+    """Записывает состояние этапа. Попытки сбрасываются при успехе или смене входа."""
+    with conn:
+        conn.execute("""
+            INSERT INTO game_stage_state (pocketbase_id, stage, status, input_hash, attempts, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(pocketbase_id, stage) DO UPDATE SET
+                attempts = CASE
+                    WHEN excluded.status = 'done' OR game_stage_state.input_hash IS NOT excluded.input_hash THEN excluded.attempts
+                    WHEN excluded.status = 'failed' THEN game_stage_state.attempts + 1
+                    ELSE game_stage_state.attempts
+                END,
+                status = excluded.status,
+                input_hash = excluded.input_hash,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+        """, (pb_id, stage, status, input_hash, 1 if status == 'failed' else 0, error, time.time()))
+
+def seed_existing_state(conn):
+    """
+    Первый запуск на существующей базе: считаем уже выполненными этапы, результат
+    которых в базе есть, чтобы не прогонять весь каталог заново.
+    """
+    # Отпечатки текстов (source_hash) для старых записей заполняет миграция схемы
+    seeded = conn.execute("SELECT COUNT(*) FROM game_stage_state").fetchone()[0] == 0
+    with conn:
+        now = time.time()
+        conn.execute(f"""
+            INSERT OR IGNORE INTO game_stage_state (pocketbase_id, stage, status, input_hash, updated_at)
+            SELECT g.pocketbase_id, 'extract', 'done', {EXTRACT_FINGERPRINT}, ?
+            FROM games g WHERE g.source_hash IS NOT NULL AND coalesce(g.needs_fetch, 0) = 0
+        """, (now,))
+        conn.execute(f"""
+            INSERT OR IGNORE INTO game_stage_state (pocketbase_id, stage, status, input_hash, updated_at)
+            SELECT g.pocketbase_id, 'summary', 'done', {SUMMARY_FINGERPRINT}, ?
+            FROM games g WHERE g.summary IS NOT NULL AND g.summary != '' AND g.source_hash IS NOT NULL
+        """, (now,))
+        conn.execute(f"""
+            INSERT OR IGNORE INTO game_stage_state (pocketbase_id, stage, status, input_hash, updated_at)
+            SELECT g.pocketbase_id, 'index', 'done', {INDEX_FINGERPRINT}, ?
+            FROM games g WHERE g.last_indexed_at IS NOT NULL
+        """, (now,))
+    return seeded
+
+
+class RunLog:
+    """Журнал запуска конвейера. Потокобезопасен, пишет через собственное соединение."""
+    def __init__(self, db_file, args):
+        # Соединение общее для всех потоков, доступ сериализуется блокировкой
+        self.conn = connect(db_file, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO pipeline_runs (started_at, status, args) VALUES (?, 'running', ?)",
+                (datetime.now().isoformat(), json.dumps(args))
+            )
+            self.run_id = cursor.lastrowid
+
+    def event(self, pb_id, stage, event, detail=None):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO pipeline_events (run_id, ts, pocketbase_id, stage, event, detail) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.run_id, datetime.now().isoformat(), pb_id, stage, event, detail)
+            )
+        label = f"{stage}:{pb_id}" if pb_id else stage
+        print(f"[{datetime.now():%H:%M:%S}] {label} {event}" + (f" - {detail}" if detail else ""))
+
+    def finish(self, status):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE pipeline_runs SET finished_at = ?, status = ? WHERE run_id = ?",
+                (datetime.now().isoformat(), status, self.run_id)
+            )
+        self.conn.close()
+
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        self.db_file = args.db
+        self.queues = {"fetch": queue.Queue(), "ocr": queue.Queue(), "summary": queue.Queue()}
+        self.queue_workers = {name: 0 for name in self.queues}   # Потоков на очередь - столько _STOP при остановке
+        self.in_flight = {stage: set() for stage in STAGES}
+        self._lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.index_dirty_since = None   # Когда появилось первое неучтенное в индексе изменение
+        self.index_last_change = None   # Когда было последнее такое изменение
+        self.threads = []
+        self.log = None
+
+    # --- Планирование ---
+
+    def _claim(self, stage, pb_id):
+        with self._lock:
+            if pb_id in self.in_flight[stage]:
+                return False
+            self.in_flight[stage].add(pb_id)
+            return True
+
+    def _release(self, stage, pb_id):
+        with self._lock:
+            self.in_flight[stage].discard(pb_id)
+
+    def busy(self):
+        with self._lock:
+            return any(self.in_flight[stage] for stage in ("extract", "summary"))
+
+    def mark_index_dirty(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.index_dirty_since is None:
+                self.index_dirty_since = now
+            self.index_last_change = now
+
+    def schedule(self, conn):
+        """Ищет грязные игры и ставит в очереди тех, кто еще не в работе."""
+        queued = 0
+        if "extract" in self.args.stages:
+            for pb_id, title, original_url, image_urls, fingerprint in find_dirty(conn, "extract"):
+                if not self._claim("extract", pb_id):
+                    continue
+                set_stage_state(conn, pb_id, "extract", "pending", fingerprint)
+                target = "fetch" if original_url else "ocr"
+                self.queues[target].put((pb_id, title, original_url, image_urls, fingerprint))
+                queued += 1
+        if "summary" in self.args.stages:
+            for pb_id, title, fingerprint in find_dirty(conn, "summary"):
+                # Пока текст перескачивается, описывать старый нет смысла
+                with self._lock:
+                    if pb_id in self.in_flight["extract"]:
+                        continue
+                if not self._claim("summary", pb_id):
+                    continue
+                set_stage_state(conn, pb_id, "summary", "pending", fingerprint)
+                self.queues["summary"].put((pb_id, title, fingerprint))
+                queued += 1
+        if "index" in self.args.stages and find_dirty(conn, "index"):
+            self.mark_index_dirty()
+        return queued
+
+    # --- Обработчики этапов ---
+
+    def _stage_loop(self, q, stage, handler, setup=None, teardown=None):
+        conn = connect(self.db_file)
+        context = setup() if setup else None
+        try:
+            while not self.stop_event.is_set():
+                item = q.get()
+                # После остановки оставшиеся задачи не берем: они в состоянии pending
+                # и продолжатся со следующего запуска
+                if item is _STOP or self.stop_event.is_set():
+                    if item is not _STOP:
+                        self._release(stage, item[0])
+                    break
+                pb_id, fingerprint = item[0], item[-1]
+                set_stage_state(conn, pb_id, stage, "running", fingerprint)
+                self.log.event(pb_id, stage, "started")
+                try:
+                    detail, changed = handler(conn, context, *item)
+                    set_stage_state(conn, pb_id, stage, "done", fingerprint)
+                    self.log.event(pb_id, stage, "done", detail)
+                    # Тот же текст или то же описание - индекс пересобирать незачем
+                    if changed:
+                        self.mark_index_dirty()
+                except Exception as e:
+                    set_stage_state(conn, pb_id, stage, "failed", fingerprint, error=str(e))
+                    self.log.event(pb_id, stage, "failed", f"{e.__class__.__name__}: {e}")
+                    if self.args.verbose:
+                        traceback.print_exc()
+                finally:
+                    self._release(stage, pb_id)
+        finally:
+            if teardown and context is not None:
+                teardown(context)
+            conn.close()
+
+    def _fetch(self, conn, fetcher, pb_id, title, original_url, image_urls, fingerprint):
+        text = fetcher.fetch(original_url)
+        if not text:
+            raise RuntimeError("текст не извлечен")
+        changed = storage.save_full_text(conn, pb_id, text)
+        return f"{len(text)} симв." + ("" if changed else ", без изменений"), changed
+
+    def _ocr(self, conn, session, pb_id, title, original_url, image_urls, fingerprint):
+        import process_static_cyoa
+        text = process_static_cyoa.recognize_game_pages(conn, session, json.loads(image_urls))
+        if not text:
+            raise RuntimeError("ни одна страница не распознана")
+        changed = storage.save_full_text(conn, pb_id, text)
+        with conn:
+            conn.execute("UPDATE games SET is_indexed = 1 WHERE pocketbase_id = ?", (pb_id,))
+        return f"{len(text)} симв." + ("" if changed else ", без изменений"), changed
+
+    def _summarize(self, conn, summarizer, pb_id, title, source_hash):
+        current = conn.execute("SELECT source_hash, summary FROM games WHERE pocketbase_id = ?", (pb_id,)).fetchone()
+        full_text = storage.load_full_text(conn, pb_id)
+        if not current or current[0] != source_hash or not full_text:
+            raise RuntimeError("текст изменился или пропал до генерации описания")
+        summary = summarizer.summarize(title, full_text)
+        changed = summary != current[1]
+        with conn:
+            # Условие на source_hash: если текст успели перескачать, описание уже устарело.
+            # Отметка индексации сбрасывается, только если описание действительно другое
+            cursor = conn.execute("""
+                UPDATE games SET summary = ?,
+                    last_indexed_at = CASE WHEN summary IS ? THEN last_indexed_at ELSE NULL END
+                WHERE pocketbase_id = ? AND source_hash IS ?
+            """, (summary, summary, pb_id, source_hash))
+        if cursor.rowcount == 0:
+            raise RuntimeError("текст изменился во время генерации описания")
+        return f"{len(summary)} симв." + ("" if changed else ", без изменений"), changed
+
+    def _index_loop(self):
+        import indexer
+        conn = connect(self.db_file)
+        try:
+            while not self.stop_event.is_set():
+                time.sleep(1)
+                with self._lock:
+                    since, last = self.index_dirty_since, self.index_last_change
+                if since is None:
+                    continue
+                now = time.monotonic()
+                quiet = now - last >= self.args.index_debounce
+                overdue = now - since >= INDEX_MAX_DELAY
+                # В разовом режиме индекс строим, когда остальные этапы закончили
+                drained = not self.args.watch and self.idle()
+                if not (quiet or overdue or drained):
+                    continue
+                self.rebuild_index(conn, indexer)
+        finally:
+            conn.close()
+
+    def rebuild_index(self, conn, indexer):
+        with self._lock:
+            self.index_dirty_since = None
+            self.index_last_change = None
+        snapshot = find_dirty(conn, "index")
+        self.log.event(None, "index", "started", f"{len(snapshot)} измененных игр")
+        try:
+            indexer.build_index(self.db_file)
+        except Exception as e:
+            self.log.event(None, "index", "failed", f"{e.__class__.__name__}: {e}")
+            for pb_id, fingerprint in snapshot:
+                set_stage_state(conn, pb_id, "index", "failed", fingerprint, error=str(e))
+            return
+        for pb_id, fingerprint in snapshot:
+            set_stage_state(conn, pb_id, "index", "done", fingerprint)
+        self.log.event(None, "index", "done", f"{len(snapshot)} игр учтено")
+
+    def idle(self):
+        return not self.busy() and all(q.empty() for q in self.queues.values())
+
+    # --- Запуск ---
+
+    def _start(self, target, name, queue_name=None):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        if queue_name:
+            self.queue_workers[queue_name] += 1
+
+    def _start_workers(self):
+        stages = self.args.stages
+        if "extract" in stages:
+            def fetch_setup():
+                from fetch_game_text import GameTextFetcher
+                return GameTextFetcher()
+            # Selenium-драйвер не потокобезопасен - один поток на fetch
+            self._start(lambda: self._stage_loop(self.queues["fetch"], "extract", self._fetch,
+                                                 fetch_setup, lambda f: f.close()), "fetch", "fetch")
+
+            def ocr_setup():
+                import requests
+                return requests.Session()
+            for i in range(self.args.ocr_workers):
+                self._start(lambda: self._stage_loop(self.queues["ocr"], "extract", self._ocr, ocr_setup),
+                            f"ocr-{i}", "ocr")
+
+        if "summary" in stages:
+            import generate_summary as gs
+            client = gs.OpenAI(base_url="https://openrouter.ai/api/v1", api_key=gs.OPENROUTER_API_KEY, max_retries=0)
+            self.section_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.args.summary_workers)
+            self.section_cache = gs.SectionCache(self.db_file)
+            summarizer = gs.Summarizer(
+                client, gs.GENERATION_MODEL_NAME, gs.load_prompt(), gs.load_prompt(gs.SECTION_PROMPT_FILE),
+                gs.AdaptiveConcurrency(2, self.args.summary_workers), gs.UsageStats(),
+                self.section_cache, self.section_executor,
+            )
+            for i in range(self.args.summary_workers):
+                self._start(lambda: self._stage_loop(self.queues["summary"], "summary", self._summarize,
+                                                     lambda: summarizer), f"summary-{i}", "summary")
+
+        if "index" in stages:
+            self._start(self._index_loop, "index")
+
+    def _sync(self):
+        from sync_with_pocketbase import sync_games
+        self.log.event(None, "sync", "started")
+        result = sync_games(db_file=self.db_file)
+        if result is None:
+            self.log.event(None, "sync", "failed")
+            return
+        self.log.event(None, "sync", "done",
+                       f"+{result['added']}, изменено {result['dirty']}, удалено {len(result['deleted'])}")
+        if result['deleted']:
+            self.mark_index_dirty()
+
+    def run(self):
+        conn = connect(self.db_file)
+        ensure_pipeline_schema(conn)
+        seeded = seed_existing_state(conn)
+        # Возобновление: все, что числилось "в работе" в прерванном запуске, снова в очередь
+        with conn:
+            resumed = conn.execute("UPDATE game_stage_state SET status = 'pending' WHERE status = 'running'").rowcount
+
+        self.log = RunLog(self.db_file, vars(self.args))
+        if seeded:
+            self.log.event(None, "pipeline", "seeded", "состояние этапов восстановлено по данным базы")
+        if resumed:
+            self.log.event(None, "pipeline", "resumed", f"{resumed} незавершенных задач прошлого запуска")
+
+        status = "failed"
+        try:
+            self._start_workers()
+            last_sync = None
+            while True:
+                if self.args.sync and (last_sync is None or (self.args.watch and time.monotonic() - last_sync >= self.args.sync_interval)):
+                    self._sync()
+                    last_sync = time.monotonic()
+                self.schedule(conn)
+
+                if not self.args.watch:
+                    # Разовый режим: ждем, пока опустеют очереди и индекс будет пересобран
+                    while not self.idle():
+                        time.sleep(1)
+                    if not self.schedule(conn):
+                        while self.index_dirty_since is not None and "index" in self.args.stages:
+                            time.sleep(1)
+                        break
+                    continue
+                time.sleep(self.args.scan_interval)
+            status = "finished"
+        except KeyboardInterrupt:
+            status = "interrupted"
+        finally:
+            self.stop_event.set()
+            # По _STOP на каждый поток очереди, иначе остальные ждали бы в q.get() до таймаута join
+            for name, q in self.queues.items():
+                for _ in range(self.queue_workers[name]):
+                    q.put(_STOP)
+            for thread in self.threads:
+                thread.join(timeout=5)
+            if hasattr(self, "section_executor"):
+                self.section_executor.shutdown(wait=False)
+            self.log.finish(status)
+            conn.close()
+        print(f"Конвейер завершен: {status}.")
+
+
+def print_status(db_file):
+    conn = connect(db_file)
+    ensure_pipeline_schema(conn)
+    print("Состояние этапов:")
+    for stage, status, count in conn.execute(
+        "SELECT stage, status, COUNT(*) FROM game_stage_state GROUP BY stage, status ORDER BY stage, status"
+    ):
+        print(f"  {stage:<8} {status:<8} {count}")
+    for stage in STAGES:
+        print(f"  {stage:<8} грязных сейчас: {len(find_dirty(conn, stage))}")
+    print("\nПоследние запуски:")
+    for run_id, started_at, finished_at, status in conn.execute(
+        "SELECT run_id, started_at, finished_at, status FROM pipeline_runs ORDER BY run_id DESC LIMIT 5"
+    ):
+        print(f"  #{run_id} {started_at} -> {finished_at or '...'} [{status}]")
+    conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальный конвейер обработки игр.")
+    parser.add_argument('--db', default=DB_FILE)
+    parser.add_argument('--watch', action='store_true', help="Работать постоянно, периодически синхронизируясь.")
+    parser.add_argument('--no-sync', dest='sync', action='store_false', help="Не синхронизироваться с PocketBase.")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help="Какие этапы запускать.")
+    parser.add_argument('--ocr-workers', type=int, default=2)
+    parser.add_argument('--summary-workers', type=int, default=4)
+    parser.add_argument('--sync-interval', type=int, default=SYNC_INTERVAL)
+    parser.add_argument('--scan-interval', type=int, default=SCAN_INTERVAL)
+    parser.add_argument('--index-debounce', type=int, default=INDEX_DEBOUNCE)
+    parser.add_argument('--status', action='store_true', help="Показать состояние этапов и выйти.")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.status:
+        print_status(args.db)
+        return
+    Pipeline(args).run()
+
+if __name__ == "__main__":
+    main()
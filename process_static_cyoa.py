@@ -1,52 +1,353 @@
 # process_static_cyoa.py
 import os
+import re
+import io
 import sqlite3
 import json
+import hashlib
+import tempfile
 import requests # Для скачивания изображений
 from datetime import datetime
 from dotenv import load_dotenv
 from google.cloud import vision
+from PIL import Image
+from create_database import ensure_schema
+from storage import connect, save_full_text
 
 # --- Конфигурация ---
 load_dotenv()
 DB_FILE = "games.db"
 
+# --- ПАРАМЕТРЫ ПРЕДОБРАБОТКИ ИЗОБРАЖЕНИЙ ---
+# Статичные CYOA часто бывают 2000x20000+ пикселей. Вместо отправки сырых байтов
+# режем картинку на перекрывающиеся горизонтальные полосы и ужимаем каждую.
+DOWNLOAD_CHUNK_SIZE = 256 * 1024          # Читаем ответ кусками, а не целиком
+SPOOL_MAX_MEMORY = 16 * 1024 * 1024       # До 16 МБ держим в памяти, дальше - во временном файле
+MAX_DOWNLOAD_BYTES = 300 * 1024 * 1024    # Защита от бесконечных/битых ответов
+MAX_IMAGE_PIXELS = 200_000_000            # Защита Pillow от "бомб" распаковки
+MAX_DECODED_BYTES = 200 * 1024 * 1024     # Бюджет на декодированное изображение в памяти
+SHRINK_STRIP_BYTES = 16 * 1024 * 1024     # Полоса при ужимании изображения больше бюджета
+
+OCR_MAX_WIDTH = 1600        # Ширина тайла после уменьшения (Vision хорошо читает текст на ~1600px)
+OCR_TILE_HEIGHT = 2400      # Высота тайла после уменьшения
+OCR_TILE_OVERLAP = 160      # Перекрытие соседних тайлов, чтобы строки на стыке не резались
+OCR_JPEG_QUALITY = 85
+OVERLAP_SEARCH_LINES = 40   # Сколько строк с конца предыдущего тайла сравниваем со следующим
+OVERLAP_MIN_CHARS = 24      # Совпадение короче (например, одна строка "Cost: 1") за перекрытие не считается
+
+# Версия предобработки входит в ключ кэша: изменили параметры - кэш не используется
+OCR_PIPELINE_VERSION = f"tiles-v2:{OCR_MAX_WIDTH}x{OCR_TILE_HEIGHT}+{OCR_TILE_OVERLAP}:q{OCR_JPEG_QUALITY}"
+
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+_vision_client = None
+
+def get_vision_client():
+    """Создает клиент Vision один раз на процесс."""
+    global _vision_client
+    if _vision_client is None:
+        _vision_client = vision.ImageAnnotatorClient()
+    return _vision_client
+
 def recognize_text_from_content(image_content: bytes):
     """
     Отправляет бинарное содержимое изображения в Google Cloud Vision API
     и возвращает распознанный текст.
     """
     try:
-        client = vision.ImageAnnotatorClient()
+        client = get_vision_client()
         image = vision.Image(content=image_content)
-        
+
         response = client.document_text_detection(image=image)
 
         if response.error.message:
             raise Exception(f"Ошибка API: {response.error.message}")
 
         return response.full_text_annotation.text if response.full_text_annotation else ""
-    
+
     except Exception as e:
         print(f"  [!] Ошибка при распознавании: {e}")
         return None
 
 
+# --- СЕКЦИЯ: ЗАГРУЗКА И ТАЙЛИНГ ИЗОБРАЖЕНИЙ ---
+
+def download_image(session, url):
+    """
+    Потоково скачивает изображение во временный файл (в памяти до SPOOL_MAX_MEMORY)
+    и параллельно считает sha256. Возвращает (файл, хэш, размер в байтах).
+    """
+    hasher = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    total = 0
+    try:
+        with session.get(url, timeout=30, stream=True) as response:
+            response.raise_for_status() # Проверяем, что запрос успешен (код 2xx)
+            for block in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if not block:
+                    continue
+                total += len(block)
+                if total > MAX_DOWNLOAD_BYTES:
+                    raise ValueError(f"Изображение больше {MAX_DOWNLOAD_BYTES // (1024 * 1024)} МБ")
+                hasher.update(block)
+                spool.write(block)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, hasher.hexdigest(), total
+
+# Байт на пиксель декодированного изображения по режиму Pillow
+_MODE_BYTES = {"1": 1, "L": 1, "P": 1, "LA": 2, "I;16": 2, "RGB": 3}
+
+def open_image(fp):
+    """
+    Декодирует изображение с ограничением по памяти. JPEG декодируется сразу в градациях
+    серого и в уменьшенном масштабе (draft). Остальные форматы остаются в своем режиме - в 'L'
+    переводится каждый тайл отдельно (to_grayscale), а не вся картинка целиком. Если такое
+    изображение не укладывается в бюджет в байтах, оно сразу ужимается до 'L' шириной
+    OCR_MAX_WIDTH (shrink_for_ocr) и дальше в памяти живет только уменьшенная копия.
+    """
+    img = Image.open(fp)
+    try:
+        width, height = img.size
+        if img.format == "JPEG" and width > OCR_MAX_WIDTH:
+            # draft уменьшает картинку кратно 2 прямо при декодировании - не меньше нужной ширины
+            scale = OCR_MAX_WIDTH / width
+            img.draft("L", (OCR_MAX_WIDTH, int(height * scale)))
+        elif img.format == "JPEG":
+            img.draft("L", img.size)
+        width, height = img.size
+        decoded_bytes = width * height * _MODE_BYTES.get(img.mode, 4)
+        if decoded_bytes > MAX_DECODED_BYTES:
+            print(f"    [INFO] Изображение {width}x{height} ({img.mode}) больше бюджета в "
+                  f"{MAX_DECODED_BYTES // (1024 * 1024)} МБ - ужимаем его перед нарезкой на тайлы.")
+            shrunk = shrink_for_ocr(img)
+            img.close()
+            img = shrunk
+    except Exception:
+        img.close()
+        raise
+    return img
+
+def to_grayscale(tile):
+    """Тайл в режиме 'L'. Прозрачный фон (частый случай для PNG) заливаем белым, иначе текст пропадает на черном."""
+    if tile.mode == "L":
+        return tile
+    if tile.mode in ("RGBA", "LA", "P"):
+        rgba = tile.convert("RGBA")
+        tile = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+        tile.alpha_composite(rgba)
+    return tile.convert("L")
+
+def shrink_for_ocr(img):
+    """
+    Копия изображения в 'L' шириной не больше OCR_MAX_WIDTH. Pillow умеет декодировать PNG
+    и подобные форматы только целиком, но дальше работа идет полосами по SHRINK_STRIP_BYTES:
+    кроме исходника в памяти одновременно только одна полоса и результат (1 байт на пиксель).
+    """
+    width, height = img.size
+    scale = min(1.0, OCR_MAX_WIDTH / width)
+    target_width = min(width, OCR_MAX_WIDTH)
+    target_height = max(1, round(height * scale))
+    result = Image.new("L", (target_width, target_height), 255)
+    dst_strip = max(1, int(SHRINK_STRIP_BYTES // (width * 4) * scale))
+    # Полоса берется с запасом по краям, чтобы фильтр LANCZOS видел соседние строки и стыков не было
+    margin = int(3 / scale) + 1
+    for dst_top in range(0, target_height, dst_strip):
+        dst_bottom = min(dst_top + dst_strip, target_height)
+        src_top, src_bottom = dst_top / scale, min(height, dst_bottom / scale)
+        crop_top, crop_bottom = max(0, int(src_top) - margin), min(height, int(src_bottom) + 1 + margin)
+        strip = to_grayscale(img.crop((0, crop_top, width, crop_bottom)))
+        if scale < 1.0:
+            strip = strip.resize((target_width, dst_bottom - dst_top), Image.LANCZOS,
+                                 box=(0, src_top - crop_top, width, src_bottom - crop_top))
+        else:
+            strip = strip.crop((0, dst_top - crop_top, width, dst_bottom - crop_top))
+        result.paste(strip, (0, dst_top))
+        strip.close()
+    return result
+
+def iter_ocr_tiles(img):
+    """
+    Генератор: режет изображение на перекрывающиеся горизонтальные полосы,
+    уменьшает каждую до OCR_MAX_WIDTH и отдает сжатые JPEG-байты.
+    Одновременно в памяти живет только один тайл.
+    """
+    width, height = img.size
+    scale = min(1.0, OCR_MAX_WIDTH / width)
+    # Высота и перекрытие в пикселях исходного изображения
+    src_tile_height = max(1, round(OCR_TILE_HEIGHT / scale))
+    src_overlap = round(OCR_TILE_OVERLAP / scale)
+    step = max(1, src_tile_height - src_overlap)
+
+    top = 0
+    while True:
+        bottom = min(top + src_tile_height, height)
+        tile = to_grayscale(img.crop((0, top, width, bottom)))
+        if scale < 1.0:
+            tile = tile.resize((OCR_MAX_WIDTH, max(1, round((bottom - top) * scale))), Image.LANCZOS)
+
+        buffer = io.BytesIO()
+        tile.save(buffer, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+        tile.close()
+        yield buffer.getvalue()
+
+        if bottom >= height:
+            break
+        top += step
+
+def _normalize_line(line):
+    """Приводит строку к виду для сравнения: OCR на стыках путает регистр и пунктуацию."""
+    return re.sub(r"\W+", "", line.lower())
+
+def merge_tile_texts(texts):
+    """
+    Склеивает тексты тайлов в порядке чтения, удаляя строки, распознанные дважды
+    в зоне перекрытия. Перекрытием считается только совпадение, которое доходит до конца
+    предыдущего тайла и содержит не меньше OVERLAP_MIN_CHARS символов: повторяющиеся
+    короткие строки ("Cost: 1") в середине текста не должны его обрезать. Обрезанные
+    сверху первые строки следующего тайла отбрасываются в пользу целой версии.
+    """
+    merged = []
+    for text in texts:
+        lines = text.splitlines()
+        if not merged:
+            merged = lines
+            continue
+
+        tail_start = max(0, len(merged) - OVERLAP_SEARCH_LINES)
+        tail = [_normalize_line(line) for line in merged[tail_start:]]
+        head = [_normalize_line(line) for line in lines[:OVERLAP_SEARCH_LINES]]
+
+        # Ищем самое длинное совпадение конца предыдущего тайла с началом следующего.
+        # Первые строки следующего тайла могут быть обрезаны сверху - допускаем пропуск.
+        best_len, best_tail_pos, best_head_pos = 0, None, None
+        for head_pos in range(min(3, len(head))):
+            if not head[head_pos]:
+                continue
+            for tail_pos, tail_line in enumerate(tail):
+                if tail_line != head[head_pos]:
+                    continue
+                length = 0
+                while (tail_pos + length < len(tail) and head_pos + length < len(head)
+                       and tail[tail_pos + length] == head[head_pos + length]):
+                    length += 1
+                if tail_pos + length != len(tail):
+                    continue  # Совпадение не доходит до конца тайла - это не перекрытие
+                if sum(len(line) for line in tail[tail_pos:]) < OVERLAP_MIN_CHARS:
+                    continue
+                if length > best_len:
+                    best_len, best_tail_pos, best_head_pos = length, tail_pos, head_pos
+
+        if best_len:
+            merged = merged[:tail_start + best_tail_pos] + lines[best_head_pos:]
+        else:
+            merged.extend(lines)
+    return "\n".join(merged).strip()
+
+
+# --- СЕКЦИЯ: КЭШ РЕЗУЛЬТАТОВ OCR ПО ХЭШУ СОДЕРЖИМОГО ---
+
+def ensure_ocr_cache(conn):
+    """Создает таблицу кэша OCR, если ее еще нет."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ocr_cache (
+            content_hash TEXT PRIMARY KEY,
+            ocr_text TEXT NOT NULL,
+            created_at TIMESTAMP
+        )
+    """)
+    conn.commit()
+
+def _cache_key(content_hash):
+    return f"{OCR_PIPELINE_VERSION}:{content_hash}"
+
+def get_cached_ocr(conn, content_hash):
+    row = conn.execute("SELECT ocr_text FROM ocr_cache WHERE content_hash = ?", (_cache_key(content_hash),)).fetchone()
+    return row[0] if row else None
+
+def put_cached_ocr(conn, content_hash, text):
+    conn.execute(
+        "INSERT OR REPLACE INTO ocr_cache (content_hash, ocr_text, created_at) VALUES (?, ?, ?)",
+        (_cache_key(content_hash), text, datetime.now().isoformat())
+    )
+    conn.commit()
+
+def recognize_page(conn, session, url):
+    """
+    Полная обработка одной страницы: скачивание, проверка кэша, тайлинг и OCR.
+    Возвращает распознанный текст страницы или None.
+    """
+    spool, content_hash, size = download_image(session, url)
+    try:
+        cached = get_cached_ocr(conn, content_hash)
+        if cached is not None:
+            print(f"    [CACHE] Страница не изменилась ({content_hash[:12]}), OCR пропущен.")
+            return cached
+
+        tile_texts = []
+        sent_bytes = 0
+        with open_image(spool) as img:
+            for tile_bytes in iter_ocr_tiles(img):
+                sent_bytes += len(tile_bytes)
+                tile_text = recognize_text_from_content(tile_bytes)
+                if tile_text is None:
+                    # Ошибка API на одном из тайлов - не кэшируем неполный результат
+                    return None
+                tile_texts.append(tile_text)
+
+        print(f"    [INFO] {len(tile_texts)} тайл(ов), отправлено {sent_bytes / 1024:.0f} КБ вместо {size / 1024:.0f} КБ.")
+        page_text = merge_tile_texts(tile_texts)
+        put_cached_ocr(conn, content_hash, page_text)
+        return page_text
+    finally:
+        spool.close()
+
+
+def recognize_game_pages(conn, session, image_urls):
+    """Распознает все страницы игры и склеивает их текст. Возвращает None, если не вышло ни одной."""
+    all_pages_text = []
+
+    for i, url in enumerate(image_urls, 1):
+        print(f"  > Скачиваем и распознаем страницу {i}/{len(image_urls)}...")
+
+        try:
+            recognized_text = recognize_page(conn, session, url)
+            if recognized_text:
+                all_pages_text.append(recognized_text)
+
+        except requests.exceptions.RequestException as e:
+            print(f"  [!] Не удалось скачать изображение по URL: {url}. Ошибка: {e}")
+            continue # Переходим к следующему изображению
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            print(f"  [!] Не удалось обработать изображение {url}: {e}")
+            continue
+
+    if not all_pages_text:
+        return None
+    # Соединяем текст со всех страниц в один большой текстовый блок
+    return "\n\n--- PAGE BREAK ---\n\n".join(all_pages_text)
+
+
 def process_static_games():
     """
-    Находит необработанные статичные CYOA в базе, распознает текст 
+    Находит необработанные статичные CYOA в базе, распознает текст
     с их изображений и сохраняет результат.
     """
     print("Начинаем обработку статичных CYOA...")
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect(DB_FILE)
     # Удобно получать результаты в виде словарей
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    ensure_schema(conn)
+    ensure_ocr_cache(conn)
 
-    # Выбираем игры, которые еще не проиндексированы и являются статичными (имеют image_urls)
+    # Выбираем игры, которые еще не проиндексированы и являются статичными (имеют image_urls),
+    # а также статичные игры, у которых при синхронизации изменился список страниц
     cursor.execute("""
         SELECT pocketbase_id, title, image_urls FROM games
-        WHERE is_indexed = 0 AND image_urls IS NOT NULL AND image_urls != '[]'
+        WHERE (is_indexed = 0 OR needs_fetch = 1) AND image_urls IS NOT NULL AND image_urls != '[]'
     """)
     games_to_process = cursor.fetchall()
 
@@ -56,44 +357,19 @@ def process_static_games():
         return
 
     print(f"Найдено {len(games_to_process)} статичных CYOA для обработки.")
+    session = requests.Session()
 
     for game in games_to_process:
         print(f"\n--- Обрабатываем: '{game['title']}' (ID: {game['pocketbase_id']}) ---")
-        
+
         # Загружаем список URL из JSON-строки
-        image_urls = json.loads(game['image_urls'])
-        all_pages_text = []
-
-        for i, url in enumerate(image_urls, 1):
-            print(f"  > Скачиваем и распознаем страницу {i}/{len(image_urls)}...")
-            
-            try:
-                # Скачиваем изображение в память
-                response = requests.get(url, timeout=30)
-                response.raise_for_status() # Проверяем, что запрос успешен (код 2xx)
-                image_bytes = response.content
-
-                # Распознаем текст
-                recognized_text = recognize_text_from_content(image_bytes)
-                if recognized_text:
-                    all_pages_text.append(recognized_text)
-
-            except requests.exceptions.RequestException as e:
-                print(f"  [!] Не удалось скачать изображение по URL: {url}. Ошибка: {e}")
-                continue # Переходим к следующему изображению
-        
-        if all_pages_text:
-            # Соединяем текст со всех страниц в один большой текстовый блок
-            full_text = "\n\n--- PAGE BREAK ---\n\n".join(all_pages_text)
-            
-            # Обновляем запись в базе данных
-            current_time_iso = datetime.now().isoformat()
-            cursor.execute("""
-                UPDATE games
-                SET full_text = ?, is_indexed = 1, last_indexed_at = ?
-                WHERE pocketbase_id = ?
-            """, (full_text, current_time_iso, game['pocketbase_id']))
-            conn.commit()
+        full_text = recognize_game_pages(conn, session, json.loads(game['image_urls']))
+
+        if full_text:
+            # Обновляем запись в базе данных (is_indexed здесь означает "OCR выполнен")
+            save_full_text(conn, game['pocketbase_id'], full_text)
+            with conn:
+                conn.execute("UPDATE games SET is_indexed = 1 WHERE pocketbase_id = ?", (game['pocketbase_id'],))
             print(f"  [OK] Текст успешно распознан и сохранен для '{game['title']}'.")
         else:
             print(f"  [!] Не удалось распознать текст ни на одной из страниц для '{game['title']}'.")
@@ -103,4 +379,4 @@ def process_static_games():
 
 
 if __name__ == "__main__":
-    process_static_games()
\ No newline at end of file
+    process_static_games()
@@ -0,0 +1,237 @@
+# query_analytics.py
+# Потоковые дневные сводки по журналу поисковых запросов (user_queries.jsonl и его ротированные части).
+# Журнал читается построчно, память ограничена: топы считаются приближенно
+# (с оценкой погрешности), задержки - по гистограмме с фиксированными корзинами.
+#
+#   python query_analytics.py                     # пересчитать все дни, вывести последние 7
+#   python query_analytics.py --since 2025-01-01  # пересчитать только дни, начиная с даты
+import os
+import gzip
+import json
+import math
+import argparse
+from query_log import rotated_files
+
+QUERY_LOG_FILE = "user_queries.jsonl"
+ROLLUPS_FILE = "query_rollups.jsonl"
+TOP_CAPACITY = 1000       # Сколько кандидатов в топ держать в памяти на день
+TOP_REPORT = 25           # Сколько строк топа сохранять в сводке
+MAX_OPEN_DAYS = 3         # Сколько дней одновременно держать открытыми (журнал почти упорядочен по времени)
+
+# Корзины задержки: от 1 мс до ~2 минут с шагом x1.25
+LATENCY_BASE_MS = 1.0
+LATENCY_GROWTH = 1.25
+LATENCY_BUCKETS = 54
+
+
+class TopK:
+    """
+    Приближенный счетчик самых частых ключей в ограниченной памяти.
+    Когда кандидатов становится вдвое больше емкости, редкие отбрасываются.
+    Новый ключ стартует со счетчика error + 1, поэтому счетчики - оценки сверху,
+    завышенные не больше чем на error.
+    """
+    def __init__(self, capacity=TOP_CAPACITY):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def add(self, key):
+        if key in self.counts:
+            self.counts[key] += 1
+            return
+        self.counts[key] = self.error + 1
+        if len(self.counts) > 2 * self.capacity:
+            ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+            self.counts = dict(ranked[:self.capacity])
+            self.error = max(self.error, ranked[self.capacity][1])
+
+    def top(self, n):
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [{"query": key, "count": count} for key, count in ranked]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * LATENCY_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        index = 0 if ms <= LATENCY_BASE_MS else int(math.log(ms / LATENCY_BASE_MS, LATENCY_GROWTH)) + 1
+        self.buckets[min(index, LATENCY_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает квантиль (оценка сверху)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return round(min(LATENCY_BASE_MS * LATENCY_GROWTH ** index, self.max), 1)
+        return round(self.max, 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 1) if self.count else None,
+            "p50_ms": self.quantile(0.50),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max, 1) if self.count else None,
+        }
+
+
+class DayRollup:
+    def __init__(self, day):
+        self.day = day
+        self.total = 0
+        self.cached = 0
+        self.errors = 0
+        self.zero_results = 0
+        self.modes = {}
+        self.top_queries = TopK()
+        self.zero_result_queries = TopK()
+
+    def add(self, entry):
+        self.total += 1
+        query = " ".join(str(entry.get("query", "")).split()).lower()
+        mode = entry.get("mode", "unknown")
+        if entry.get("cached"):
+            self.cached += 1
+        if "error" in entry:
+            self.errors += 1
+        elif entry.get("results_count") == 0:
+            self.zero_results += 1
+            self.zero_result_queries.add(query)
+        self.top_queries.add(query)
+        if mode not in self.modes:
+            self.modes[mode] = LatencyHistogram()
+        # В старых записях задержки нет - они учитываются только в счетчиках
+        if entry.get("latency_ms") is not None:
+            self.modes[mode].add(float(entry["latency_ms"]))
+
+    def to_dict(self):
+        return {
+            "day": self.day,
+            "total": self.total,
+            "cached": self.cached,
+            "errors": self.errors,
+            "zero_results": self.zero_results,
+            "latency_by_mode": {mode: hist.summary() for mode, hist in sorted(self.modes.items())},
+            "top_queries": self.top_queries.top(TOP_REPORT),
+            "top_queries_error": self.top_queries.error,
+            "zero_result_queries": self.zero_result_queries.top(TOP_REPORT),
+            "zero_result_queries_error": self.zero_result_queries.error,
+        }
+
+
+def log_files(path, since=None):
+    """Ротированные части и текущий файл. Части, ротированные до since, целиком старше - их пропускаем."""
+    files = []
+    base = os.path.splitext(os.path.basename(path))[0]
+    for name in rotated_files(path):
+        stamp = os.path.basename(name)[len(base) + 1:len(base) + 9]  # YYYYMMDD из имени
+        if since and stamp < since.replace("-", ""):
+            continue
+        files.append(name)
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def iter_entries(files):
+    for name in files:
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(name, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # Оборванная строка (например, при аварийной остановке)
+
+def build_rollups(path=QUERY_LOG_FILE, since=None):
+    """Отдает готовые сводки по дням по мере чтения журнала."""
+    open_days = {}
+    for entry in iter_entries(log_files(path, since)):
+        day = str(entry.get("timestamp", ""))[:10]
+        if not day or (since and day < since):
+            continue
+        if day not in open_days:
+            open_days[day] = DayRollup(day)
+            if len(open_days) > MAX_OPEN_DAYS:
+                oldest = min(open_days)
+                yield open_days.pop(oldest).to_dict()
+        open_days[day].add(entry)
+    for day in sorted(open_days):
+        yield open_days[day].to_dict()
+
+def load_rollups(path):
+    rollups = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                rollup = json.loads(line)
+                rollups[rollup["day"]] = rollup
+    return rollups
+
+def merge_rollup(existing, new):
+    """
+    День может встретиться повторно, если записи пришли не по порядку. Счетчики складываем,
+    топы объединяем; задержки берем из большей части (гистограммы в сводке уже свернуты).
+    """
+    if existing is None:
+        return new
+    merged = dict(new if new["total"] >= existing["total"] else existing)
+    for field in ("total", "cached", "errors", "zero_results"):
+        merged[field] = existing[field] + new[field]
+    for field in ("top_queries", "zero_result_queries"):
+        counts = {}
+        for item in existing[field] + new[field]:
+            counts[item["query"]] = counts.get(item["query"], 0) + item["count"]
+        ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:TOP_REPORT]
+        merged[field] = [{"query": q, "count": c} for q, c in ranked]
+    return merged
+
+def print_rollup(rollup):
+    print(f"\n=== {rollup['day']}: {rollup['total']} запросов, из кэша {rollup['cached']}, "
+          f"ошибок {rollup['errors']}, без результатов {rollup['zero_results']}")
+    for mode, stats in rollup["latency_by_mode"].items():
+        print(f"  {mode:<8} n={stats['count']:<6} p50={stats['p50_ms']} p95={stats['p95_ms']} "
+              f"p99={stats['p99_ms']} max={stats['max_ms']} мс")
+    print("  Топ запросов:", ", ".join(f"{t['query']} ({t['count']})" for t in rollup["top_queries"][:10]))
+    if rollup["zero_result_queries"]:
+        print("  Без результатов:", ", ".join(f"{t['query']} ({t['count']})" for t in rollup["zero_result_queries"][:10]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Дневные сводки по журналу поисковых запросов.")
+    parser.add_argument('--log', default=QUERY_LOG_FILE)
+    parser.add_argument('--out', default=ROLLUPS_FILE)
+    parser.add_argument('--since', help="Пересчитать только дни начиная с YYYY-MM-DD (остальные сводки сохраняются).")
+    parser.add_argument('--show', type=int, default=7, help="Сколько последних дней вывести.")
+    args = parser.parse_args()
+
+    # Готовые сводки маленькие (одна строка на день) - их можно держать в памяти целиком
+    rollups = {day: r for day, r in load_rollups(args.out).items() if args.since and day < args.since}
+    fresh = {}
+    for rollup in build_rollups(args.log, args.since):
+        fresh[rollup["day"]] = merge_rollup(fresh.get(rollup["day"]), rollup)
+    rollups.update(fresh)
+
+    tmp_path = args.out + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for day in sorted(rollups):
+            f.write(json.dumps(rollups[day], ensure_ascii=False) + "\n")
+    os.replace(tmp_path, args.out)
+
+    print(f"Сводки записаны в {args.out}: {len(rollups)} дней (пересчитано {len(fresh)}).")
+    for day in sorted(rollups)[-args.show:]:
+        print_rollup(rollups[day])
+
+if __name__ == "__main__":
+    main()
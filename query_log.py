@@ -0,0 +1,193 @@
+# query_log.py
+# Журнал поисковых запросов (user_queries.jsonl) вне пути запроса.
+# Обработчик только кладет словарь в очередь; сериализация, запись на диск
+# и ротация файлов происходят в отдельном потоке пачками. Если диск подвис,
+# очередь заполняется и новые записи отбрасываются (со счетчиком), но поиск не ждет.
+#
+# В один файл пишут все воркеры сервера. Запись и переименование при ротации идут под
+# блокировкой fcntl на user_queries.jsonl.lock: под ней писатель проверяет, не ротировал ли
+# файл другой процесс, поэтому в переименованный файл никто не допишет после начала его
+# сжатия, и два воркера не ротируют один файл дважды.
+import os
+import glob
+import gzip
+import json
+import time
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: там сервер запускается одним процессом, блокировка не нужна
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0            # Сек: максимальная задержка записи
+MAX_FILE_BYTES = 50 * 1024 * 1024
+BACKUP_COUNT = 60               # Сколько ротированных файлов хранить
+
+
+def rotated_files(path):
+    """Ротированные файлы журнала в хронологическом порядке (имя содержит время ротации)."""
+    base, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{base}-*{ext}.gz") + glob.glob(f"{base}-*{ext}"))
+
+
+class QueryLogWriter:
+    """Фоновый писатель журнала запросов с пакетной записью и ротацией по размеру и по дням."""
+    def __init__(self, path, max_bytes=MAX_FILE_BYTES, backup_count=BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._thread = None
+        self._file = None
+        self._file_day = None
+        self._lock_file = None
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+            self._thread.start()
+
+    def log(self, entry):
+        """Вызывается из обработчика запроса: никогда не блокирует."""
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        """Дописывает очередь и закрывает файл (при остановке сервера)."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            # Копим пачку не дольше FLUSH_INTERVAL после первой записи
+            batch = [entry]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._write(batch)
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @contextmanager
+    def _locked(self):
+        """Межпроцессная блокировка журнала (на время проверки, записи и переименования)."""
+        if fcntl is None:
+            yield
+            return
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "a")
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _write(self, batch):
+        try:
+            data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+            with self._locked():
+                rotated = self._open_for(datetime.now().date().isoformat(), len(data))
+                self._file.write(data)
+                self._file.flush()
+            self.written += len(batch)
+            self.batches += 1
+            if rotated:
+                # Сжатие - уже без блокировки: в переименованный файл больше никто не пишет
+                self._compress(rotated)
+        except Exception as e:
+            self.errors += 1
+            print(f"ERROR: Could not write user queries to log: {e}")
+
+    def _rotated_elsewhere(self):
+        """При нескольких воркерах сервера файл мог ротировать другой процесс."""
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open_for(self, day, incoming):
+        """Открывает текущий файл (под блокировкой); возвращает путь ротированного файла или None."""
+        rotated = None
+        if self._file is not None and self._rotated_elsewhere():
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+            # Уже непустой файл (после перезапуска сервера) относится к дню последней записи
+            if self._file.tell() > 0:
+                self._file_day = datetime.fromtimestamp(os.path.getmtime(self.path)).date().isoformat()
+            else:
+                self._file_day = day
+        # Новый файл на каждые сутки или по достижении лимита размера
+        if self._file.tell() > 0 and (day != self._file_day or self._file.tell() + incoming > self.max_bytes):
+            rotated = self._rotate()
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file_day = day
+        return rotated
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        base, ext = os.path.splitext(self.path)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        rotated = f"{base}-{stamp}{ext}"
+        n = 1
+        # Файл с тем же именем может еще сжимать другой воркер
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = f"{base}-{stamp}.{n}{ext}"
+            n += 1
+        os.replace(self.path, rotated)
+        return rotated
+
+    def _compress(self, rotated):
+        # Сжатие ротированного файла - в этом же фоновом потоке, очередь пока копится
+        with open(rotated, "rb") as src, gzip.open(rotated + ".gz.tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(rotated + ".gz.tmp", rotated + ".gz")
+        os.remove(rotated)
+        for old in rotated_files(self.path)[:-self.backup_count]:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass  # Старые части одновременно удалил другой воркер
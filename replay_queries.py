@@ -0,0 +1,312 @@
+# replay_queries.py
+# Офлайн-сравнение двух конфигураций ранжирования на реальных запросах из журнала
+# (user_queries.jsonl и его ротированные части). Используется тот же код ранжирования,
+# что и на сервере (main.semantic_ranking), а эмбеддинги запросов берутся из кэша
+# query_embeddings.db - API не нужен. Недостающие эмбеддинги можно один раз получить с --embed.
+#
+#   python replay_queries.py --b '{"summary_weight": 0.6, "text_weight": 0.4}'
+#   python replay_queries.py --a wide_k --b narrow_k --since 2025-06-01   # варианты из ranking_variants.json
+#   python replay_queries.py --b '{"two_stage": false}' --embed --out replay_report.json
+#   python replay_queries.py --calibrate-threshold    # порог для оценок после переоценки 768-d
+#
+# Отчет по каждой конфигурации: задержка ранжирования (p50/p95/p99), доля запросов без
+# результатов, распределение оценок; по паре: пересечение топ-k и ранговая корреляция (Kendall tau).
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+import main
+import vector_store
+from query_analytics import QUERY_LOG_FILE, log_files, iter_entries
+
+QUERY_EMBEDDINGS_FILE = "query_embeddings.db"
+DEFAULT_MAX_QUERIES = 5000
+TOP_K = 20
+WORST_REPORT = 10  # Сколько запросов с наибольшим расхождением показать
+
+
+class QueryEmbeddingCache:
+    """Векторы запросов (уже нормированные, как их видит Faiss) по модели, размерности и тексту."""
+    def __init__(self, path=QUERY_EMBEDDINGS_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_embeddings (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                vector BLOB NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def _key(query):
+        return hashlib.sha1(f"{main.EMBEDDING_MODEL_NAME}:{main.query_dimension()}:{query}".encode("utf-8")).hexdigest()
+
+    def get(self, query):
+        row = self.conn.execute("SELECT vector FROM query_embeddings WHERE key = ?", (self._key(query),)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32).reshape(1, -1) if row else None
+
+    def put(self, query, vector):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, query, vector) VALUES (?, ?, ?)",
+                (self._key(query), query, np.asarray(vector, dtype=np.float32).tobytes())
+            )
+
+
+def parse_config(spec):
+    """'default', имя варианта из ranking_variants.json или JSON с параметрами ранжирования."""
+    if spec == "default":
+        return "default", main.ranking_params()
+    if spec in main.ranking_variants:
+        return spec, main.ranking_params(spec)
+    try:
+        overrides = json.loads(spec)
+    except ValueError:
+        raise SystemExit(f"Конфигурация '{spec}': не вариант из {main.RANKING_VARIANTS_FILE} и не JSON.")
+    unknown = set(overrides) - set(main.RANKING_DEFAULTS)
+    if unknown:
+        raise SystemExit(f"Неизвестные параметры ранжирования: {sorted(unknown)}")
+    return spec, main.ranking_params(**overrides)
+
+def iter_queries(log_path, since=None, max_queries=DEFAULT_MAX_QUERIES):
+    """Уникальные (запрос, режим, фильтры) из журнала с числом повторов, не больше max_queries."""
+    counts = {}
+    for entry in iter_entries(log_files(log_path, since)):
+        if since and str(entry.get("timestamp", ""))[:10] < since:
+            continue
+        query = main.normalize_query(str(entry.get("query", "")))
+        if len(query) < 2:
+            continue
+        key = (query, entry.get("mode", "mixed"), tuple(entry.get("filters", ())))
+        if key in counts:
+            counts[key] += 1
+        elif len(counts) < max_queries:
+            counts[key] = 1
+    return counts
+
+def kendall_tau(a, b):
+    """Ранговая корреляция на общих элементах двух топов (None, если общих меньше двух)."""
+    position_b = {game_id: i for i, game_id in enumerate(b)}
+    common = [game_id for game_id in a if game_id in position_b]
+    if len(common) < 2:
+        return None
+    concordant = discordant = 0
+    for i in range(len(common)):
+        for j in range(i + 1, len(common)):
+            if position_b[common[i]] < position_b[common[j]]:
+                concordant += 1
+            else:
+                discordant += 1
+    return (concordant - discordant) / (concordant + discordant)
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {f"p{p}": None for p in points}
+    return {f"p{p}": round(float(np.percentile(values, p)), 3) for p in points}
+
+
+class ConfigStats:
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.latencies_ms = []
+        self.result_counts = []
+        self.top_scores = []
+        self.all_scores = []
+        self.zero_results = 0
+        self.weighted_zero = 0
+        self.weighted_total = 0
+
+    def add(self, latency_ms, ranked, weight):
+        self.latencies_ms.append(latency_ms)
+        self.result_counts.append(len(ranked))
+        self.weighted_total += weight
+        if not ranked:
+            self.zero_results += 1
+            self.weighted_zero += weight
+            return
+        scores = [data["score"] for _, data in ranked]
+        self.top_scores.append(scores[0])
+        self.all_scores.extend(scores)
+
+    def summary(self):
+        queries = len(self.latencies_ms)
+        return {
+            "name": self.name,
+            "params": self.params,
+            "queries": queries,
+            "latency_ms": {**percentiles(self.latencies_ms),
+                           "mean": round(float(np.mean(self.latencies_ms)), 3) if queries else None},
+            "zero_result_rate": round(self.zero_results / queries, 4) if queries else None,
+            "zero_result_rate_by_traffic": round(self.weighted_zero / self.weighted_total, 4) if self.weighted_total else None,
+            "mean_results": round(float(np.mean(self.result_counts)), 2) if queries else None,
+            "top_score": percentiles(self.top_scores, (10, 50, 90)),
+            "all_scores": percentiles(self.all_scores, (10, 50, 90)),
+        }
+
+
+def replay(queries, configs, embeddings, top_k=TOP_K, embed_missing=False):
+    stats = [ConfigStats(name, params) for name, params in configs]
+    overlaps, taus, worst = [], [], []
+    skipped = 0
+    for (query, mode_value, filters), weight in queries.items():
+        q_vec = embeddings.get(query)
+        if q_vec is None and embed_missing:
+            q_vec = main.embed_query(query)
+            embeddings.put(query, q_vec[0])
+        if q_vec is None:
+            skipped += 1
+            continue
+        mode = main.SearchMode(mode_value) if mode_value in main.SearchMode.__members__ else main.SearchMode.mixed
+        tops = []
+        for config in stats:
+            started = time.perf_counter()
+            ranked, _ = main.semantic_ranking(q_vec, mode, config.params, None, tuple(filters))
+            config.add((time.perf_counter() - started) * 1000, ranked, weight)
+            tops.append([game_id for game_id, _ in ranked[:top_k]])
+
+        a, b = tops
+        if a or b:
+            overlap = len(set(a) & set(b)) / max(len(a), len(b))
+            overlaps.append(overlap)
+            worst.append((overlap, query, mode_value))
+        tau = kendall_tau(a, b)
+        if tau is not None:
+            taus.append(tau)
+
+    worst.sort()
+    return {
+        "configs": [config.summary() for config in stats],
+        "comparison": {
+            "top_k": top_k,
+            "queries_compared": len(overlaps),
+            "overlap_mean": round(float(np.mean(overlaps)), 4) if overlaps else None,
+            "overlap": percentiles(overlaps, (10, 50, 90)),
+            "kendall_tau_mean": round(float(np.mean(taus)), 4) if taus else None,
+            "largest_differences": [
+                {"query": query, "mode": mode_value, "overlap": round(overlap, 3)}
+                for overlap, query, mode_value in worst[:WORST_REPORT]
+            ],
+        },
+        "skipped_without_embedding": skipped,
+    }
+
+def calibrate_threshold(queries, embeddings, threshold, k=main.DEFAULT_K, factor=main.RESCORE_FACTOR,
+                        embed_missing=False):
+    """
+    Порог оценки чанка подбирался на 256-мерных векторах, а применяется к оценкам переоценки
+    в полной размерности. Для кандидатов каждого запроса считаем обе оценки: 256-мерную (префикс
+    Matryoshka - ровно то, что отдавал прежний индекс) и полную. Порог для полных оценок -
+    тот, что пропускает ту же долю кандидатов, что и прежний порог на 256-мерных.
+    """
+    vectors = main.chunk_vectors
+    old_dimension = main.OUTPUT_DIMENSION
+    old_scores, new_scores = [], []
+    skipped = 0
+    for (query, _, _), _ in queries.items():
+        q_vec = embeddings.get(query)
+        if q_vec is None and embed_missing:
+            q_vec = main.embed_query(query)
+            embeddings.put(query, q_vec[0])
+        if q_vec is None or q_vec.shape[1] != vectors.shape[1]:
+            skipped += 1
+            continue
+        _, I = main.faiss_index.search(main.coarse_query(q_vec, main.faiss_index), k * factor)
+        indices = I[0][I[0] != -1]
+        scores = vector_store.rescore(vectors, indices, q_vec[0])
+        top = np.argsort(-scores, kind="stable")[:k]
+        new_scores.append(scores[top])
+        old_query = vector_store.truncate(q_vec, old_dimension)[0]
+        old_scores.append(vector_store.truncate(vectors[indices[top]], old_dimension) @ old_query)
+    if not new_scores:
+        return {"queries": 0, "skipped_without_embedding": skipped}
+    old_scores, new_scores = np.concatenate(old_scores), np.concatenate(new_scores)
+    pass_rate = float(np.mean(old_scores >= threshold))
+    derived = float(np.quantile(new_scores, 1 - pass_rate)) if 0 < pass_rate < 1 else threshold
+    return {
+        "queries": len(queries) - skipped,
+        "candidates": len(new_scores),
+        "old_dimension": old_dimension,
+        "new_dimension": int(vectors.shape[1]),
+        "threshold": threshold,
+        "pass_rate_old": round(pass_rate, 4),
+        "pass_rate_new": round(float(np.mean(new_scores >= threshold)), 4),
+        "agreement": round(float(np.mean((old_scores >= threshold) == (new_scores >= threshold))), 4),
+        "derived_threshold": round(derived, 4),
+        "agreement_derived": round(float(np.mean((old_scores >= threshold) == (new_scores >= derived))), 4),
+        "skipped_without_embedding": skipped,
+    }
+
+def print_calibration(report):
+    if not report["queries"]:
+        print("Нет запросов с эмбеддингом полной размерности (см. --embed).")
+        return
+    print(f"\n=== Порог: {report['queries']} запросов, {report['candidates']} кандидатов")
+    print(f"  Порог {report['threshold']} пропускает {report['pass_rate_old']:.1%} кандидатов в {report['old_dimension']}-d "
+          f"и {report['pass_rate_new']:.1%} после переоценки в {report['new_dimension']}-d "
+          f"(решения совпадают для {report['agreement']:.1%})")
+    print(f"  Та же доля после переоценки - при пороге {report['derived_threshold']} "
+          f"(решения совпадают для {report['agreement_derived']:.1%})")
+
+def print_report(report):
+    for config in report["configs"]:
+        latency = config["latency_ms"]
+        print(f"\n=== {config['name']}: {config['queries']} запросов")
+        print(f"  Ранжирование: p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} мс")
+        print(f"  Без результатов: {config['zero_result_rate']} (с учетом повторов: {config['zero_result_rate_by_traffic']}), "
+              f"в среднем результатов: {config['mean_results']}")
+        print(f"  Оценка первого результата: {config['top_score']}, все оценки: {config['all_scores']}")
+    comparison = report["comparison"]
+    print(f"\n=== Сравнение (топ-{comparison['top_k']}, {comparison['queries_compared']} запросов)")
+    print(f"  Пересечение: среднее {comparison['overlap_mean']}, {comparison['overlap']}")
+    print(f"  Kendall tau на общих результатах: {comparison['kendall_tau_mean']}")
+    if comparison["largest_differences"]:
+        print("  Сильнее всего расходятся:", ", ".join(
+            f"'{d['query']}' ({d['overlap']})" for d in comparison["largest_differences"]))
+    if report["skipped_without_embedding"]:
+        print(f"\nПропущено запросов без эмбеддинга в кэше: {report['skipped_without_embedding']} (см. --embed)")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Сравнение двух конфигураций ранжирования на журнале запросов.")
+    parser.add_argument('--a', default="default", help="Конфигурация A: default, имя варианта или JSON.")
+    parser.add_argument('--b', help="Конфигурация B: default, имя варианта или JSON.")
+    parser.add_argument('--calibrate-threshold', action='store_true',
+                        help="Вместо сравнения подобрать порог оценки чанка для переоценки в полной размерности.")
+    parser.add_argument('--log', default=QUERY_LOG_FILE)
+    parser.add_argument('--since', help="Только запросы начиная с YYYY-MM-DD.")
+    parser.add_argument('--max-queries', type=int, default=DEFAULT_MAX_QUERIES)
+    parser.add_argument('--top', type=int, default=TOP_K)
+    parser.add_argument('--embeddings', default=QUERY_EMBEDDINGS_FILE)
+    parser.add_argument('--embed', action='store_true', help="Получить недостающие эмбеддинги у API и сохранить в кэш.")
+    parser.add_argument('--out', help="Сохранить отчет в JSON.")
+    args = parser.parse_args()
+
+    if not args.b and not args.calibrate_threshold:
+        parser.error("нужна конфигурация --b или --calibrate-threshold")
+    main.load_data()
+    if not main.faiss_index:
+        raise SystemExit("Индекс не загружен.")
+    main.faiss_batcher = None  # Запросы идут по одному - окно пачки только исказило бы задержку
+
+    queries = iter_queries(args.log, args.since, args.max_queries)
+    print(f"Уникальных запросов для проигрывания: {len(queries)} (повторов всего: {sum(queries.values())}).")
+    if args.calibrate_threshold:
+        if main.chunk_vectors is None:
+            raise SystemExit("У индекса нет chunk_vectors.npy - оценки не переоцениваются, порог прежний.")
+        name, params = parse_config(args.a)
+        report = calibrate_threshold(queries, QueryEmbeddingCache(args.embeddings), params["threshold"],
+                                     embed_missing=args.embed)
+        print_calibration(report)
+    else:
+        configs = [parse_config(args.a), parse_config(args.b)]
+        report = replay(queries, configs, QueryEmbeddingCache(args.embeddings), args.top, args.embed)
+        print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nОтчет сохранен в {args.out}")
+
+if __name__ == "__main__":
+    main_cli()
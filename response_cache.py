@@ -0,0 +1,117 @@
+# response_cache.py
+# Кэш готовых (сериализованных и сжатых) HTTP-ответов сервера.
+# Попадание в кэш не трогает ни базу, ни json.dumps: отдаются уже готовые байты,
+# с поддержкой ETag/If-None-Match и gzip.
+import gzip
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from fastapi import Response
+
+GZIP_MIN_SIZE = 1024   # Маленькие ответы сжимать невыгодно
+GZIP_LEVEL = 6
+
+
+class CachedResponse:
+    """Тело ответа в двух видах (как есть и gzip), его ETag и необязательные метаданные для логов."""
+    __slots__ = ("body", "gzip_body", "etag", "created_at", "meta")
+
+    def __init__(self, body, meta=None):
+        self.body = body
+        self.meta = meta
+        self.gzip_body = gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_SIZE else None
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.created_at = time.monotonic()
+
+    @classmethod
+    def from_json(cls, payload, meta=None):
+        return cls(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), meta)
+
+    @property
+    def size(self):
+        return len(self.body) + (len(self.gzip_body) if self.gzip_body else 0)
+
+    def to_response(self, request, headers=None):
+        """Готовый Response: 304 при совпавшем If-None-Match, gzip если клиент его принимает."""
+        headers = {"ETag": self.etag, "Vary": "Accept-Encoding", **(headers or {})}
+        if_none_match = request.headers.get("if-none-match", "")
+        if self.etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        if self.gzip_body is not None and "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return Response(self.gzip_body, media_type="application/json", headers=headers)
+        return Response(self.body, media_type="application/json", headers=headers)
+
+
+class ResponseCache:
+    """
+    LRU-кэш CachedResponse с ограничением по памяти и необязательным TTL.
+    Привязан к "поколению" данных: при смене поколения (новая база, новый индекс)
+    все записи сбрасываются сразу, а не по истечении TTL.
+    """
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_generation(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                self._entries.clear()
+                self._bytes = 0
+                self.generation = generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry.created_at > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry, generation=None):
+        """Кладет ответ в кэш. Ответ, посчитанный для устаревшего поколения, отбрасывается."""
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "generation": self.generation,
+            }
@@ -0,0 +1,99 @@
+# shard_worker.py
+# Воркер шарда индекса (см. shards.py): принимает от сервера вектор запроса и возвращает
+# лучшие чанки своего шарда с глобальными id. Перезагружает шард, когда индексатор его подменил.
+#
+#   python shard_worker.py --all --port 8201            # все шарды из shards/ локально, порты подряд
+#   SHARD_AUTHKEY=<секрет> python shard_worker.py --shard 2 --host 0.0.0.0 --port 8201   # один шард на другой машине
+#
+# Не-loopback адрес (--host 0.0.0.0 и т.п.) требует своего SHARD_AUTHKEY (тот же у сервера):
+# сообщения распаковываются через pickle, а ключ по умолчанию опубликован вместе с кодом.
+#   SHARD_ADDRESSES=127.0.0.1:8201,127.0.0.1:8202 uvicorn main:app --port 8100
+import os
+import time
+import argparse
+import threading
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Listener
+import shards
+
+RELOAD_CHECK_SECONDS = 5
+
+
+def handle(conn, searcher):
+    """Одно соединение сервера: запросы идут по очереди, ответ на каждый - сразу."""
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            try:
+                ids, scores, info = searcher.search(
+                    request["query"], request["k"], request["candidates"], request.get("bits"), request.get("total"))
+                conn.send({"ids": ids, "scores": scores, "info": info})
+            except Exception as e:
+                conn.send({"error": str(e)})
+    except OSError:
+        pass  # Сервер закрыл соединение (например, после таймаута)
+    finally:
+        conn.close()
+
+def watch(searcher):
+    while True:
+        time.sleep(RELOAD_CHECK_SECONDS)
+        try:
+            searcher.reload_if_changed()
+        except Exception as e:
+            print(f"ERROR: Не удалось перезагрузить шард {searcher.path}: {e}")
+
+def serve(path, host, port):
+    searcher = shards.ShardSearcher(path)
+    threading.Thread(target=watch, args=(searcher,), daemon=True).start()
+    listener = Listener((host, port), authkey=shards.authkey())
+    index, _, _, info = searcher.state
+    print(f"Шард {info['shard']} ({index.ntotal} чанков) слушает {host}:{port}", flush=True)
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, AuthenticationError) as e:
+            print(f"WARN: Отклонено соединение: {e}")
+            continue
+        threading.Thread(target=handle, args=(conn, searcher), daemon=True).start()
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер шарда индекса для поиска с разбиением на шарды.")
+    parser.add_argument('--dir', default=shards.SHARDS_DIR)
+    parser.add_argument('--shard', type=int, help="Номер шарда.")
+    parser.add_argument('--all', action='store_true', help="Запустить все шарды из манифеста отдельными процессами.")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8201)
+    args = parser.parse_args()
+    try:
+        shards.check_bind(args.host)
+    except ValueError as e:
+        raise SystemExit(f"ERROR: {e}")
+
+    if not args.all:
+        if args.shard is None:
+            parser.error("нужен --shard или --all")
+        serve(shards.shard_dir(args.dir, args.shard), args.host, args.port)
+        return
+
+    manifest = shards.read_manifest(args.dir)
+    if manifest is None:
+        raise SystemExit(f"Нет {os.path.join(args.dir, shards.MANIFEST_FILE)}: соберите индекс с INDEX_SHARDS > 1.")
+    processes = []
+    for number in range(manifest["shards"]):
+        process = Process(target=serve, args=(shards.shard_dir(args.dir, number), args.host, args.port + number), daemon=True)
+        process.start()
+        processes.append(process)
+    addresses = ",".join(f"{args.host}:{args.port + number}" for number in range(manifest["shards"]))
+    print(f"SHARD_ADDRESSES={addresses}", flush=True)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
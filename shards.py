@@ -0,0 +1,266 @@
+# shards.py
+# Шардирование индекса по играм: индексатор раскладывает чанки на N шардов (все чанки игры -
+# в одном шарде), у каждого шарда свой грубый индекс Faiss, полные векторы и соответствие
+# локальных id глобальным id чанков. Шард обслуживает отдельный процесс (shard_worker.py),
+# сервер рассылает вектор запроса всем шардам и сливает их лучшие чанки перед обычной
+# агрегацией по играм. Шард, не ответивший за SHARD_TIMEOUT_SECONDS, пропускается -
+# ответ помечается как неполный.
+#
+# Транспорт - multiprocessing.connection (TCP + проверка ключа authkey): одинаково работает
+# для локальных процессов и для удаленных машин. Сообщения распаковываются через pickle, то есть
+# знающий ключ может выполнить код в воркере. Ключ по умолчанию опубликован вместе с кодом и
+# годится только для loopback: на другом адресе воркер без своего SHARD_AUTHKEY не запустится.
+import os
+import json
+import time
+import zlib
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import numpy as np
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+import vector_store
+from filters import selector
+
+SHARDS_DIR = "shards"
+MANIFEST_FILE = "manifest.json"
+SHARD_INDEX_FILE = "games.index"
+SHARD_IDS_FILE = "chunk_ids.npy"
+SHARD_INFO_FILE = "shard.json"
+DEFAULT_AUTHKEY = "cyoa-shards"  # Только для loopback; для шардов на других машинах - свой SHARD_AUTHKEY
+CONNECT_WORKERS = 8
+# Рукопожатие Client() не ограничено по времени: зависший воркер принимает TCP-соединение,
+# но не отвечает. Поэтому соединения открываются в отдельных потоках и ждутся до дедлайна.
+_connector = ThreadPoolExecutor(max_workers=CONNECT_WORKERS, thread_name_prefix="shard-connect")
+
+
+def shard_of(game_id, count):
+    """Номер шарда игры: стабильный между сборками и процессами (в отличие от hash())."""
+    return zlib.crc32(game_id.encode("utf-8")) % count
+
+def shard_dir(base, number):
+    return os.path.join(base, f"shard_{number}")
+
+def authkey():
+    return os.getenv("SHARD_AUTHKEY", DEFAULT_AUTHKEY).encode("utf-8")
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False  # Имя хоста: может разрешиться во внешний адрес
+
+def check_bind(host):
+    """Отказ слушать не-loopback адрес с опубликованным ключом по умолчанию (ValueError)."""
+    if not is_loopback(host) and not os.getenv("SHARD_AUTHKEY"):
+        raise ValueError(
+            f"Воркер на {host} доступен извне, а ключ по умолчанию известен всем: сообщения распаковываются "
+            f"через pickle, и любой, кто достучится до порта, выполнит код. Задайте свой SHARD_AUTHKEY "
+            f"(например, python -c \"import secrets; print(secrets.token_hex(32))\") на воркерах и сервере.")
+
+def _replace_file(write_fn, path):
+    tmp_path = f"{path}.tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+def _write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+def _save_array(path, array):
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+def write_shards(base, game_ids, full_vectors, coarse_vectors, count, build):
+    """
+    game_ids - игра каждого чанка (в порядке глобальных id), векторы - в том же порядке.
+    Файлы каждого шарда подменяются атомарно, индекс шарда - последним (воркер перезагружается
+    по его изменению); манифест - после всех шардов.
+    """
+    import faiss  # Здесь и ниже - не при импорте модуля, его импортирует и сервер при запуске
+    shard_numbers = np.array([shard_of(game_id, count) for game_id in game_ids], dtype=np.int32)
+    sizes = []
+    for number in range(count):
+        path = shard_dir(base, number)
+        os.makedirs(path, exist_ok=True)
+        chunk_ids = np.flatnonzero(shard_numbers == number).astype(np.int64)
+        index = faiss.IndexFlatIP(coarse_vectors.shape[1])
+        if len(chunk_ids):
+            index.add(np.ascontiguousarray(coarse_vectors[chunk_ids]))
+        _replace_file(lambda p: _save_array(p, chunk_ids), os.path.join(path, SHARD_IDS_FILE))
+        _replace_file(lambda p: vector_store.write_vectors(p, full_vectors[chunk_ids]),
+                      os.path.join(path, vector_store.VECTORS_FILE))
+        _replace_file(lambda p: _write_json(p, {"shard": number, "build": build, "chunks": len(chunk_ids)}),
+                      os.path.join(path, SHARD_INFO_FILE))
+        _replace_file(lambda p: faiss.write_index(index, p), os.path.join(path, SHARD_INDEX_FILE))
+        sizes.append(len(chunk_ids))
+    _replace_file(lambda p: _write_json(p, {"shards": count, "build": build, "chunks": len(game_ids), "sizes": sizes}),
+                  os.path.join(base, MANIFEST_FILE))
+    return sizes
+
+def read_manifest(base=SHARDS_DIR):
+    path = os.path.join(base, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class ShardSearcher:
+    """Поиск по одному шарду (внутри воркера). Перезагружается, когда индексатор подменил индекс шарда."""
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        import faiss
+        index_path = os.path.join(self.path, SHARD_INDEX_FILE)
+        mtime = os.path.getmtime(index_path)
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        chunk_ids = np.load(os.path.join(self.path, SHARD_IDS_FILE), mmap_mode="r")
+        vectors_path = os.path.join(self.path, vector_store.VECTORS_FILE)
+        vectors = vector_store.load_vectors(vectors_path) if os.path.exists(vectors_path) else None
+        with open(os.path.join(self.path, SHARD_INFO_FILE), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if len(chunk_ids) != index.ntotal or (vectors is not None and len(vectors) != index.ntotal):
+            raise ValueError(f"{self.path}: файлы шарда от разных сборок")
+        self.state = (index, chunk_ids, vectors, info)
+        self.mtime = mtime
+
+    def reload_if_changed(self):
+        if os.path.getmtime(os.path.join(self.path, SHARD_INDEX_FILE)) != self.mtime:
+            with self.lock:
+                if os.path.getmtime(os.path.join(self.path, SHARD_INDEX_FILE)) != self.mtime:
+                    self.load()
+
+    def search(self, query, k, candidates, bits=None, total=None):
+        """
+        query - нормированный вектор запроса полной размерности; bits - упакованная маска
+        глобальных id чанков (фильтры и режим поиска) на total чанков.
+        Возвращает (глобальные id, оценки, информация о шарде) лучших k чанков шарда.
+        """
+        index, chunk_ids, vectors, info = self.state
+        if vectors is None or vectors.shape[1] != query.shape[0]:
+            vectors, candidates = None, k
+        sel = None
+        if bits is not None:
+            mask = np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=total, bitorder="little")
+            local_bits = np.packbits(mask[chunk_ids].astype(bool), bitorder="little")
+            sel = selector(local_bits, len(chunk_ids))
+        coarse = query[None] if query.shape[0] == index.d else vector_store.truncate(query[None], index.d)
+        import faiss
+        params = faiss.SearchParameters(sel=sel) if sel is not None else None
+        D, I = index.search(coarse, min(candidates, index.ntotal) or 1, params=params)
+        local, scores = I[0][I[0] != -1], D[0][I[0] != -1]
+        if vectors is not None:
+            scores = vector_store.rescore(vectors, local, query)
+            order = np.argsort(-scores, kind="stable")[:k]
+            local, scores = local[order], scores[order]
+        return np.asarray(chunk_ids[local], dtype=np.int64), scores.astype(np.float32), info
+
+
+class ShardClient:
+    """
+    Соединения с одним воркером. Соединение после таймаута закрывается: поздний ответ не перепутается.
+    Новое соединение открывается не больше одного за раз и попадает в пул, даже если его не дождались.
+    """
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1)
+        self.address = address
+        self._target = (host, int(port))
+        self._idle = []
+        self._connecting = None
+        self._lock = threading.RLock()
+
+    def _connected(self, future):
+        with self._lock:
+            self._connecting = None
+            if future.exception() is None:
+                self._idle.append(future.result())
+
+    def send(self, request, deadline):
+        """Отправляет запрос и возвращает соединение, из которого читать ответ."""
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+                future = self._connecting
+                if conn is None and future is None:
+                    future = self._connecting = _connector.submit(Client, self._target, authkey=authkey())
+                    future.add_done_callback(self._connected)
+            if conn is not None:
+                try:
+                    conn.send(request)
+                    return conn
+                except OSError:
+                    conn.close()  # Воркер перезапускался - соединение из пула устарело
+                    continue
+            try:
+                future.result(max(0.0, deadline - time.perf_counter()))
+            except FutureTimeout:
+                raise TimeoutError(f"нет соединения с {self.address}")
+
+    def release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+
+class ShardCoordinator:
+    """Рассылает запрос всем шардам и собирает их лучшие чанки с общим дедлайном."""
+    def __init__(self, addresses, timeout):
+        self.clients = [ShardClient(address) for address in addresses]
+        self.timeout = timeout
+
+    def search(self, query, k, candidates, bits=None, total=None, build=None, expected=None):
+        """
+        Возвращает (indices, scores, report): слитые лучшие k чанков всех ответивших шардов
+        по убыванию оценки и отчет {"shards", "answered", "missing": [номера шардов],
+        "failed": {адрес: причина}}. Ответ шарда от другой сборки (build) не используется;
+        если один шард обслуживают несколько адресов (реплики), берется первый ответ.
+        expected - число шардов по манифесту.
+        """
+        request = {"query": np.asarray(query, dtype=np.float32), "k": k, "candidates": candidates,
+                   "bits": bits, "total": total}
+        deadline = time.perf_counter() + self.timeout
+        pending, failed = [], {}
+        for client in self.clients:
+            try:
+                pending.append((client, client.send(request, deadline)))
+            except TimeoutError:
+                failed[client.address] = "timeout"
+            except (OSError, EOFError, AuthenticationError) as e:
+                failed[client.address] = f"unavailable: {e.__class__.__name__}"
+
+        ids, scores, shards = [], [], set()
+        for client, conn in pending:
+            try:
+                if not conn.poll(max(0.0, deadline - time.perf_counter())):
+                    conn.close()
+                    failed[client.address] = "timeout"
+                    continue
+                response = conn.recv()
+            except (OSError, EOFError) as e:
+                conn.close()
+                failed[client.address] = f"error: {e.__class__.__name__}"
+                continue
+            client.release(conn)
+            if "error" in response:
+                failed[client.address] = f"error: {response['error']}"
+            elif build is not None and response["info"].get("build") != build:
+                failed[client.address] = "stale"
+            elif response["info"].get("shard") not in shards:
+                ids.append(response["ids"])
+                scores.append(response["scores"])
+                shards.add(response["info"].get("shard"))
+
+        indices = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        merged = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+        order = np.argsort(-merged, kind="stable")[:k]
+        expected = expected or len(self.clients)
+        report = {"shards": expected, "answered": len(shards),
+                  "missing": sorted(set(range(expected)) - shards), "failed": failed}
+        return indices[order], merged[order], report
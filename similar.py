@@ -0,0 +1,156 @@
+# similar.py
+# "Похожие игры" без обращения к Gemini: вектор игры собирается из уже посчитанных
+# векторов чанков (описание + среднее по текстам), а индексатор заранее считает
+# для каждой игры N ближайших соседей и хранит их в games.db (таблица game_vectors).
+# Сервер отвечает на /api/similar/{id} одним чтением строки.
+#
+# Пересчет инкрементальный: полностью пересчитываются списки только изменившихся игр,
+# остальные списки лишь дополняются кандидатами из изменившихся игр.
+import numpy as np
+from datetime import datetime
+
+NEIGHBORS = 20
+SUMMARY_WEIGHT = 0.70  # Как в ранжировании поиска: описание важнее текста
+TEXT_WEIGHT = 0.30
+FULL_REBUILD_SHARE = 0.5  # Если изменилась большая часть игр, проще пересчитать все списки
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def game_vectors(chunks, embeddings):
+    """
+    chunks - метаданные чанков ({game_id, type}) в порядке строк embeddings (нормированных).
+    Возвращает {game_id: вектор игры float32 единичной длины}.
+    """
+    parts = {}
+    for chunk, vector in zip(chunks, embeddings):
+        entry = parts.setdefault(chunk["game_id"], {"summary": [], "text": []})
+        entry[chunk["type"]].append(vector)
+    result = {}
+    for game_id, entry in parts.items():
+        summary = _normalize(np.mean(entry["summary"], axis=0)) if entry["summary"] else None
+        text = _normalize(np.mean(entry["text"], axis=0)) if entry["text"] else None
+        if summary is not None and text is not None:
+            vector = SUMMARY_WEIGHT * summary + TEXT_WEIGHT * text
+        else:
+            vector = summary if summary is not None else text
+        result[game_id] = _normalize(vector).astype(np.float32)
+    return result
+
+def pack_neighbors(ids, scores):
+    """Список соседей - один BLOB: id строк game_vectors (int32), затем оценки (float32)."""
+    return np.asarray(ids, dtype=np.int32).tobytes() + np.asarray(scores, dtype=np.float32).tobytes()
+
+def unpack_neighbors(blob):
+    if not blob:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    n = len(blob) // 8
+    return np.frombuffer(blob, dtype=np.int32, count=n), np.frombuffer(blob, dtype=np.float32, offset=4 * n)
+
+def _top(scores, row_ids, limit):
+    order = np.argsort(-scores, kind="stable")[:limit]
+    return row_ids[order], scores[order]
+
+def update_neighbors(conn, vectors, limit=NEIGHBORS):
+    """
+    Сохраняет векторы игр и обновляет списки соседей. vectors - {game_id: вектор} для ВСЕХ
+    игр текущего индекса; игры, которых там нет, удаляются. Возвращает (пересчитано полностью, всего).
+    """
+    old = {}
+    for row_id, game_id, blob, neighbors in conn.execute(
+        "SELECT id, game_id, vector, neighbors FROM game_vectors"
+    ):
+        old[game_id] = (row_id, np.frombuffer(blob, dtype=np.float32), neighbors)
+
+    now = datetime.now().isoformat()
+    removed = {old[g][0] for g in old if g not in vectors}
+    dirty_games = [g for g, v in vectors.items() if g not in old or old[g][1].shape != v.shape
+                   or not np.array_equal(old[g][1], v)]
+    if not removed and not dirty_games:
+        return 0, len(vectors)
+
+    with conn:
+        for row_id in removed:
+            conn.execute("DELETE FROM game_vectors WHERE id = ?", (row_id,))
+        for game_id in dirty_games:
+            conn.execute(
+                "INSERT INTO game_vectors (game_id, vector, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(game_id) DO UPDATE SET vector = excluded.vector, updated_at = excluded.updated_at",
+                (game_id, vectors[game_id].tobytes(), now)
+            )
+
+    rows = conn.execute("SELECT id, game_id FROM game_vectors ORDER BY id").fetchall()
+    if not rows:
+        return 0, 0
+    row_ids = np.array([row_id for row_id, _ in rows], dtype=np.int32)
+    position = {game_id: i for i, (_, game_id) in enumerate(rows)}
+    matrix = np.stack([vectors[game_id] for _, game_id in rows])
+    # У каждой игры не больше total - 1 соседей (сама она в свой список не входит)
+    size = min(limit, len(rows) - 1)
+
+    dirty = set(dirty_games)
+    full = set(position[g] for g in dirty)
+    if len(dirty) >= FULL_REBUILD_SHARE * len(rows):
+        full = set(range(len(rows)))
+
+    changed_ids = {int(row_ids[position[g]]) for g in dirty} | removed
+    dirty_positions = np.array(sorted(position[g] for g in dirty), dtype=np.int64)
+    updates = {}
+
+    # Списки остальных игр: убираем изменившихся/удаленных соседей и добавляем кандидатов из изменившихся
+    if len(dirty_positions):
+        dirty_scores = matrix @ matrix[dirty_positions].T
+    for i, (row_id, game_id) in enumerate(rows):
+        if i in full:
+            continue
+        old_ids, old_scores = unpack_neighbors(old[game_id][2])
+        keep = np.array([int(n) not in changed_ids for n in old_ids], dtype=bool)
+        ids, scores = old_ids[keep], old_scores[keep]
+        if len(dirty_positions):
+            candidates = dirty_scores[i]
+            ids = np.concatenate([ids, row_ids[dirty_positions]])
+            scores = np.concatenate([scores, candidates])
+            own = ids != row_id
+            ids, scores = ids[own], scores[own]
+        ids, scores = _top(scores, ids, size)
+        # Игры вне старого списка набирают не больше его последней оценки. Если после удаления
+        # соседей список стал короче или опустился ниже этой границы, его нужно считать заново.
+        bound = old_scores[-1] if len(old_scores) >= limit else -np.inf
+        if len(ids) < size or (size and not keep.all() and scores[-1] < bound):
+            full.add(i)
+            continue
+        updates[row_id] = pack_neighbors(ids, scores)
+
+    for i in sorted(full):
+        scores = matrix @ matrix[i]
+        scores[i] = -np.inf
+        ids, top_scores = _top(scores, row_ids, size)
+        updates[int(row_ids[i])] = pack_neighbors(ids, top_scores)
+
+    with conn:
+        for row_id, blob in updates.items():
+            conn.execute("UPDATE game_vectors SET neighbors = ? WHERE id = ?", (blob, int(row_id)))
+    return len(full), len(rows)
+
+def load_neighbors(conn, game_id, limit=NEIGHBORS):
+    """[(game_id, title, summary, score)] соседей игры или None, если игры нет в таблице."""
+    row = conn.execute("SELECT neighbors FROM game_vectors WHERE game_id = ?", (game_id,)).fetchone()
+    if row is None:
+        return None
+    ids, scores = unpack_neighbors(row[0])
+    ids, scores = ids[:limit], scores[:limit]
+    if not len(ids):
+        return []
+    placeholders = ','.join('?' * len(ids))
+    meta = {
+        row_id: (pb_id, title, summary)
+        for row_id, pb_id, title, summary in conn.execute(
+            f"""SELECT v.id, g.pocketbase_id, g.title, g.summary
+                FROM game_vectors v JOIN games g ON g.pocketbase_id = v.game_id
+                WHERE v.id IN ({placeholders})""",
+            [int(i) for i in ids]
+        )
+    }
+    return [(*meta[int(i)], float(s)) for i, s in zip(ids, scores) if int(i) in meta]
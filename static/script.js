@@ -14,17 +14,52 @@ document.addEventListener('DOMContentLoaded', () => {
         `;
     });
 
-    // --- Обработчик формы поиска (без изменений) ---
+    // --- Обработчик формы поиска: первая страница, дальше - по курсору ---
+    const moreResultsButton = document.createElement('button');
+    moreResultsButton.textContent = 'More results';
+    moreResultsButton.className = 'load-more';
+    let searchCursor = null;
+
+    function renderResult(game) {
+        const snippetHtml = game.snippet ? `<div class="result-snippet">AI Summary: "${game.snippet}"</div>` : '';
+        const matchClass = ['summary', 'title', 'keyword'].includes(game.match_type) ? game.match_type : 'text';
+        const matchLabel = { summary: 'AI Match', title: 'Title Match', keyword: 'Keyword Match' }[game.match_type] || 'Text Match';
+
+        return `
+            <div class="result-item">
+                <div class="result-header">
+                    <a href="${game.url}" target="_blank" class="result-title">${game.title}</a>
+                    <div class="result-meta">
+                        <span class="badge ${matchClass}">${matchLabel}</span>
+                        <span class="score">${game.score}%</span>
+                    </div>
+                </div>
+                ${snippetHtml}
+            </div>
+        `;
+    }
+
+    function showMoreButton(cursor) {
+        searchCursor = cursor;
+        if (cursor) resultsDiv.appendChild(moreResultsButton);
+        else moreResultsButton.remove();
+    }
+
     searchForm.addEventListener('submit', async (e) => {
         e.preventDefault();
         const query = searchInput.value.trim();
         const mode = document.querySelector('input[name="search-mode"]:checked').value;
+        const kind = document.querySelector('input[name="search-kind"]:checked').value;
+        const hasSummary = document.getElementById('search-has-summary').checked;
 
         if (query.length < 2) return;
         resultsDiv.innerHTML = '<p>Searching analyzing semantics...</p>';
 
         try {
-            const res = await fetch(`/api/semantic-search?q=${encodeURIComponent(query)}&mode=${mode}`);
+            const params = new URLSearchParams({ q: query, mode });
+            if (kind) params.set('kind', kind);
+            if (hasSummary) params.set('has_summary', 'true');
+            const res = await fetch(`/api/semantic-search?${params}`);
             const data = await res.json();
 
             if (data.results.length === 0) {
@@ -32,93 +67,123 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
-            const html = data.results.map(game => {
-                const snippetHtml = game.snippet ? `<div class="result-snippet">AI Summary: "${game.snippet}"</div>` : '';
-                const matchClass = game.match_type === 'summary' ? 'summary' : 'text';
-                const matchLabel = game.match_type === 'summary' ? 'AI Match' : 'Text Match';
-
-                return `
-                    <div class="result-item">
-                        <div class="result-header">
-                            <a href="${game.url}" target="_blank" class="result-title">${game.title}</a>
-                            <div class="result-meta">
-                                <span class="badge ${matchClass}">${matchLabel}</span>
-                                <span class="score">${game.score}%</span>
-                            </div>
-                        </div>
-                        ${snippetHtml}
-                    </div>
-                `;
-            }).join('');
-
-            resultsDiv.innerHTML = `<p style="color:#888; margin-bottom:10px">Results using <b>${data.mode_used}</b> mode:</p>` + html;
+            const fallbackNote = data.served_by === 'lexical' ? ' (semantic search is slow right now, showing keyword matches)' : '';
+            resultsDiv.innerHTML = `<p style="color:#888; margin-bottom:10px">Results using <b>${data.mode_used}</b> mode${fallbackNote}:</p>`
+                + data.results.map(renderResult).join('');
+            showMoreButton(data.next_cursor);
         } catch (err) {
             resultsDiv.innerHTML = `<p style="color:red">Error: ${err.message}</p>`;
         }
     });
 
-    // --- НОВАЯ ФУНКЦИЯ: Загрузка и отображение списка всех игр ---
-    async function loadAllGames() {
-        const gamesListDiv = document.getElementById('all-games-list');
+    moreResultsButton.addEventListener('click', async () => {
+        moreResultsButton.disabled = true;
         try {
-            // Создаем новый эндпоинт /games на сервере
-            const response = await fetch('/games'); 
-            const games = await response.json();
+            const res = await fetch(`/api/semantic-search/next?cursor=${encodeURIComponent(searchCursor)}`);
+            const data = await res.json();
+            if (!res.ok) throw new Error(data.detail || res.status);
+            moreResultsButton.insertAdjacentHTML('beforebegin', data.results.map(renderResult).join(''));
+            showMoreButton(data.next_cursor);
+        } catch (err) {
+            moreResultsButton.insertAdjacentHTML('beforebegin', `<p style="color:red">Error: ${err.message}</p>`);
+            showMoreButton(null);
+        } finally {
+            moreResultsButton.disabled = false;
+        }
+    });
 
-            if (games.length === 0) {
-                gamesListDiv.innerHTML = '<p>No games found in the database.</p>';
-                return;
+    // --- Список всех игр: постранично, описания подгружаются по клику ---
+    const gamesListDiv = document.getElementById('all-games-list');
+    const loadMoreButton = document.createElement('button');
+    loadMoreButton.textContent = 'Load more';
+    loadMoreButton.className = 'load-more';
+    let nextCursor = null;
+    let loadedCount = 0;
+
+    function renderGame(game) {
+        const indexedStatus = game.is_indexed
+            ? '<span class="status-indicator indexed">Indexed</span>'
+            : '<span class="status-indicator not-indexed">Not Indexed</span>';
+
+        // Если summary есть - создаем кликабельный элемент, если нет - просто метку
+        const summaryStatus = game.has_summary
+            ? `<span class="summary-toggle" data-game-id="${game.id}">Summary</span>`
+            : '<span class="status-indicator no-summary">No Summary</span>';
+
+        // Текст описания не приходит в списке - пустой блок заполнится при первом клике
+        const summaryContent = game.has_summary
+            ? `<div class="summary-content" id="summary-${game.id}"></div>`
+            : '';
+
+        return `
+            <div class="game-item-list">
+                <div class="game-header-list">
+                    <span class="game-title-list">${game.title}</span>
+                    <div class="game-meta-list">
+                        ${indexedStatus}
+                        ${summaryStatus}
+                    </div>
+                </div>
+                ${summaryContent}
+            </div>
+        `;
+    }
+
+    async function toggleSummary(toggle) {
+        const gameId = toggle.getAttribute('data-game-id');
+        const summaryContent = document.getElementById(`summary-${gameId}`);
+        if (!summaryContent) return;
+        if (!summaryContent.dataset.loaded) {
+            summaryContent.innerHTML = 'Loading...';
+            try {
+                const response = await fetch(`/games/${encodeURIComponent(gameId)}/summary`);
+                const data = await response.json();
+                summaryContent.innerHTML = (data.summary || '').replace(/\n/g, '<br>');
+                summaryContent.dataset.loaded = '1';
+            } catch (error) {
+                summaryContent.innerHTML = `<span style="color:red">Error: ${error.message}</span>`;
             }
+        }
+        // Переключаем класс 'visible' для показа/скрытия
+        summaryContent.classList.toggle('visible');
+    }
 
-            // Создаем HTML для каждой игры
-            const gamesHtml = games.map((game, index) => {
-                const indexedStatus = game.is_indexed
-                    ? '<span class="status-indicator indexed">Indexed</span>'
-                    : '<span class="status-indicator not-indexed">Not Indexed</span>';
-                
-                // Если summary есть - создаем кликабельный элемент, если нет - просто метку
-                const summaryStatus = game.has_summary
-                    ? `<span class="summary-toggle" data-target="summary-${index}">Summary</span>`
-                    : '<span class="status-indicator no-summary">No Summary</span>';
-
-                // Если summary есть - создаем скрытый div с его текстом
-                const summaryContent = game.has_summary
-                    ? `<div class="summary-content" id="summary-${index}">${game.summary.replace(/\n/g, '<br>')}</div>`
-                    : '';
-
-                return `
-                    <div class="game-item-list">
-                        <div class="game-header-list">
-                            <span class="game-title-list">${game.title}</span>
-                            <div class="game-meta-list">
-                                ${indexedStatus}
-                                ${summaryStatus}
-                            </div>
-                        </div>
-                        ${summaryContent}
-                    </div>
-                `;
-            }).join('');
-
-            gamesListDiv.innerHTML = gamesHtml;
-
-            // Добавляем обработчики кликов для всех кнопок "Summary"
-            document.querySelectorAll('.summary-toggle').forEach(toggle => {
-                toggle.addEventListener('click', () => {
-                    const targetId = toggle.getAttribute('data-target');
-                    const summaryContent = document.getElementById(targetId);
-                    if (summaryContent) {
-                        // Переключаем класс 'visible' для показа/скрытия
-                        summaryContent.classList.toggle('visible');
-                    }
-                });
-            });
+    // Один обработчик на весь список вместо обработчика на каждую кнопку
+    gamesListDiv.addEventListener('click', (e) => {
+        const toggle = e.target.closest('.summary-toggle');
+        if (toggle) toggleSummary(toggle);
+    });
 
+    async function loadAllGames() {
+        try {
+            loadMoreButton.disabled = true;
+            const url = nextCursor ? `/games?cursor=${encodeURIComponent(nextCursor)}` : '/games';
+            const response = await fetch(url);
+            const page = await response.json();
+
+            if (loadedCount === 0) {
+                gamesListDiv.innerHTML = '';
+                if (page.games.length === 0) {
+                    gamesListDiv.innerHTML = '<p>No games found in the database.</p>';
+                    return;
+                }
+            }
+
+            loadMoreButton.remove();
+            gamesListDiv.insertAdjacentHTML('beforeend', page.games.map(renderGame).join(''));
+            loadedCount += page.games.length;
+            nextCursor = page.next_cursor;
+            if (nextCursor) {
+                loadMoreButton.disabled = false;
+                gamesListDiv.appendChild(loadMoreButton);
+            }
         } catch (error) {
             gamesListDiv.innerHTML = `<p style="color:red">Error loading game list: ${error.message}</p>`;
         }
     }
 
+    loadMoreButton.addEventListener('click', loadAllGames);
+
     // Вызываем новую функцию при загрузке страницы
     loadAllGames();
 });
\ No newline at end of file
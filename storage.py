@@ -0,0 +1,245 @@
+# storage.py
+# Общий доступ к данным игр для всех этапов обработки и сервера.
+# Тексты игр (холодные данные) лежат в game_texts, возможно сжатыми;
+# читать и писать их нужно только через функции этого модуля.
+# Распаковка происходит только в момент, когда текст действительно нужен.
+import os
+import zlib
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:  # zstd необязателен: без него работают raw и zlib
+    zstandard = None
+
+DB_FILE = "games.db"
+BUSY_TIMEOUT = 30  # Сек: этапы конвейера пишут в базу параллельно
+READONLY_MMAP_SIZE = 256 * 1024 * 1024  # Читающие процессы сервера делят страницы базы через mmap
+
+# Кодек для новых текстов: 'zstd', 'zlib' или 'raw'.
+# Если для кодека обучен словарь (compress_texts.py --train), он используется автоматически.
+TEXT_CODEC = os.getenv("TEXT_CODEC", "zstd" if zstandard else "zlib")
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+
+_local = threading.local()
+_dictionaries = {}  # dict_id -> байты словаря (словари неизменяемы, кэш общий для всех баз)
+_dictionaries_lock = threading.Lock()
+
+def connect(db_file=DB_FILE, **kwargs):
+    """Открывает соединение с базой с разумным таймаутом ожидания блокировки."""
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, **kwargs)
+    # В режиме WAL это безопасно и заметно ускоряет частые мелкие коммиты
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+def connect_readonly(db_file=DB_FILE):
+    """Соединение только для чтения (для сервера): в WAL не мешает писателям."""
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {READONLY_MMAP_SIZE}")
+    return conn
+
+def thread_connection(db_file=DB_FILE):
+    """Одно соединение на поток (для пулов потоков, читающих тексты)."""
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    if db_file not in conns:
+        conns[db_file] = connect(db_file)
+    return conns[db_file]
+
+def text_hash(text):
+    """Отпечаток текста игры (хранится в games.source_hash)."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def default_codec():
+    """Кодек для новых текстов: zstd без установленного zstandard заменяется на zlib."""
+    if TEXT_CODEC == "zstd" and zstandard is None:
+        return "zlib"
+    return TEXT_CODEC
+
+# --- Словари сжатия ---
+# Тексты CYOA сильно пересекаются по лексике и шаблонным фразам ("Choose one",
+# "You gain", "Drawbacks" ...), поэтому общий словарь заметно улучшает сжатие
+# отдельных текстов. Словари хранятся в text_dictionaries и никогда не меняются:
+# новый словарь получает новый dict_id, а старые тексты продолжают читаться.
+
+def dictionary_id(data):
+    return hashlib.sha1(data).hexdigest()[:16]
+
+def get_dictionary(conn, dict_id):
+    with _dictionaries_lock:
+        data = _dictionaries.get(dict_id)
+    if data is None:
+        row = conn.execute("SELECT data FROM text_dictionaries WHERE dict_id = ?", (dict_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"Словарь сжатия {dict_id} не найден в базе")
+        data = bytes(row[0])
+        with _dictionaries_lock:
+            _dictionaries[dict_id] = data
+    return data
+
+def active_dictionary(conn, codec):
+    """Самый свежий словарь для кодека или None."""
+    row = conn.execute(
+        "SELECT dict_id FROM text_dictionaries WHERE codec = ? ORDER BY created_at DESC LIMIT 1", (codec,)
+    ).fetchone()
+    return row[0] if row else None
+
+def save_dictionary(conn, codec, data):
+    dict_id = dictionary_id(data)
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO text_dictionaries (dict_id, codec, data, created_at) VALUES (?, ?, ?, ?)",
+            (dict_id, codec, data, datetime.now().isoformat())
+        )
+    return dict_id
+
+def train_zlib_dictionary(samples, size=32 * 1024):
+    """
+    Словарь для zlib - это просто "предыстория" до 32 КБ. Собираем в нее строки,
+    встречающиеся в разных текстах; самые ценные ставим в конец, ближе к данным.
+    """
+    doc_freq = {}
+    for sample in samples:
+        for line in set(sample.splitlines()):
+            line = line.strip()
+            if len(line) >= 8:
+                doc_freq[line] = doc_freq.get(line, 0) + 1
+    shared = [line for line, df in doc_freq.items() if df > 1]
+    shared.sort(key=lambda line: doc_freq[line] * len(line), reverse=True)
+    chosen, total = [], 0
+    for line in shared:
+        encoded = (line + "\n").encode('utf-8')
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b"".join(reversed(chosen))
+
+def train_dictionary(codec, samples, size):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Для словаря zstd нужен пакет zstandard")
+        return zstandard.train_dictionary(size, [s.encode('utf-8') for s in samples]).as_bytes()
+    if codec == "zlib":
+        return train_zlib_dictionary(samples, min(size, 32 * 1024))
+    raise ValueError(f"Для кодека {codec} словарь не нужен")
+
+def _zstd_compressor(zdict):
+    # Объекты zstandard не потокобезопасны - держим свои в каждом потоке
+    cache = getattr(_local, "zstd", None)
+    if cache is None:
+        cache = _local.zstd = {}
+    key = ("c", zdict)
+    if key not in cache:
+        dict_data = zstandard.ZstdCompressionDict(zdict) if zdict else None
+        cache[key] = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data)
+    return cache[key]
+
+def _zstd_decompressor(zdict):
+    cache = getattr(_local, "zstd", None)
+    if cache is None:
+        cache = _local.zstd = {}
+    key = ("d", zdict)
+    if key not in cache:
+        dict_data = zstandard.ZstdCompressionDict(zdict) if zdict else None
+        cache[key] = zstandard.ZstdDecompressor(dict_data=dict_data)
+    return cache[key]
+
+def encode_text(text, codec=None, zdict=None):
+    """Сжимает текст. Возвращает (codec, data)."""
+    codec = codec or default_codec()
+    raw = text.encode('utf-8')
+    if codec == "zstd":
+        return codec, _zstd_compressor(zdict).compress(raw)
+    if codec == "zlib":
+        if zdict:
+            compressor = zlib.compressobj(ZLIB_LEVEL, zdict=zdict)
+            return codec, compressor.compress(raw) + compressor.flush()
+        return codec, zlib.compress(raw, ZLIB_LEVEL)
+    return "raw", raw
+
+def decode_text(codec, data, zdict=None):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Текст сжат zstd, но пакет zstandard не установлен")
+        data = _zstd_decompressor(zdict).decompress(data)
+    elif codec == "zlib":
+        if zdict:
+            decompressor = zlib.decompressobj(zdict=zdict)
+            data = decompressor.decompress(data) + decompressor.flush()
+        else:
+            data = zlib.decompress(data)
+    elif codec != "raw":
+        raise ValueError(f"Неизвестный кодек текста: {codec}")
+    return data.decode('utf-8')
+
+def decode_stored(conn, codec, dict_id, data):
+    """Распаковывает строку game_texts (codec, dict_id, data), подгружая словарь при необходимости."""
+    zdict = get_dictionary(conn, dict_id) if dict_id else None
+    return decode_text(codec, data, zdict)
+
+def encode_for_storage(conn, text, codec=None):
+    """Сжимает текст для записи в game_texts активным словарем. Возвращает (codec, dict_id, data)."""
+    codec = codec or default_codec()
+    dict_id = active_dictionary(conn, codec) if codec != "raw" else None
+    zdict = get_dictionary(conn, dict_id) if dict_id else None
+    codec, data = encode_text(text, codec, zdict)
+    return codec, dict_id, data
+
+def load_full_text(conn, pb_id):
+    """Возвращает текст игры или None. Распаковка происходит только здесь."""
+    row = conn.execute("SELECT codec, dict_id, data FROM game_texts WHERE pocketbase_id = ?", (pb_id,)).fetchone()
+    return decode_stored(conn, *row) if row else None
+
+def iter_full_texts(conn, where="", params=()):
+    """
+    Лениво отдает (pocketbase_id, title, summary, текст или None) для игр из games.
+    Тексты читаются и распаковываются по одному, а не все сразу в память.
+    """
+    rows = conn.execute(f"""
+        SELECT g.pocketbase_id, g.title, g.summary, t.codec, t.dict_id, t.data
+        FROM games g LEFT JOIN game_texts t ON t.pocketbase_id = g.pocketbase_id
+        {where}
+    """, params)
+    for pb_id, title, summary, codec, dict_id, data in rows:
+        text = decode_stored(conn, codec, dict_id, data) if data is not None else None
+        yield pb_id, title, summary, text
+
+def save_full_text(conn, pb_id, full_text):
+    """
+    Сохраняет извлеченный текст игры и снимает флаг needs_fetch.
+    Если текст отличается от сохраненного, сбрасывает описание и отметку
+    индексации - они построены по старому тексту. Возвращает True, если текст изменился.
+    """
+    new_hash = text_hash(full_text)
+    row = conn.execute("SELECT source_hash FROM games WHERE pocketbase_id = ?", (pb_id,)).fetchone()
+    changed = row is None or row[0] != new_hash
+    with conn:
+        if changed:
+            codec, dict_id, data = encode_for_storage(conn, full_text)
+            conn.execute(
+                "INSERT OR REPLACE INTO game_texts (pocketbase_id, codec, dict_id, data, raw_length) VALUES (?, ?, ?, ?, ?)",
+                (pb_id, codec, dict_id, data, len(full_text))
+            )
+            conn.execute("""
+                UPDATE games
+                SET source_hash = ?, summary = NULL, last_indexed_at = NULL, needs_fetch = 0
+                WHERE pocketbase_id = ?
+            """, (new_hash, pb_id))
+        else:
+            conn.execute("UPDATE games SET needs_fetch = 0 WHERE pocketbase_id = ?", (pb_id,))
+    return changed
+
+def read_counters(conn):
+    """Счетчики для /stats, поддерживаемые триггерами (см. create_database.py)."""
+    return dict(conn.execute("SELECT name, value FROM stats_counters").fetchall())
+
+def read_generation(conn):
+    """Поколение каталога: меняется при любом изменении игр, видимом в /games."""
+    row = conn.execute("SELECT value FROM stats_counters WHERE name = 'generation'").fetchone()
+    return row[0] if row else None
@@ -1,88 +1,249 @@
-# sync_with_pocketbase.py (обновленная версия)
+# sync_with_pocketbase.py (инкрементальная версия)
 import os
-import sqlite3
 import json # Импортируем json для работы со списком ссылок
+import argparse
+import requests
 from dotenv import load_dotenv
-from pocketbase import PocketBase
+from create_database import ensure_schema
+from storage import connect
 
 # --- Конфигурация ---
 load_dotenv()
 DB_FILE = "games.db"
-POCKETBASE_URL = "https://cyoa.cafe"
+POCKETBASE_URL = os.getenv("POCKETBASE_URL", "https://cyoa.cafe")
 ADMIN_EMAIL = os.getenv('EMAIL')
 ADMIN_PASSWORD = os.getenv('PASSWORD')
 
-def sync_games():
-    """Синхронизирует игры из PocketBase с локальной базой данных SQLite."""
+COLLECTION = "games"
+PAGE_SIZE = 200
+ID_PAGE_SIZE = 1000   # Для проверки удалений запрашиваем только id - можно брать большие страницы
+# Защита от ошибочных удалений (пустой список из-за прав доступа, сбой API): если удалить
+# пришлось бы больше этой доли игр (и больше DELETE_ALWAYS_ALLOWED), удаления пропускаются
+MAX_DELETE_SHARE = 0.2
+DELETE_ALWAYS_ALLOWED = 5
+REQUEST_TIMEOUT = 30
+HIGH_WATER_KEY = "games_updated_high_water"
+# Только нужные поля - PocketBase не будет гонять описания, теги и т.п.
+RECORD_FIELDS = "id,collectionId,title,img_or_link,iframe_url,cyoa_pages,updated"
+
+UPSERT_SQL = """
+    INSERT INTO games (pocketbase_id, title, original_url, image_urls, pb_updated, needs_fetch)
+    VALUES (?, ?, ?, ?, ?, 1)
+    ON CONFLICT(pocketbase_id) DO UPDATE SET
+        title = excluded.title,
+        original_url = excluded.original_url,
+        image_urls = excluded.image_urls,
+        pb_updated = excluded.pb_updated,
+        needs_fetch = CASE
+            WHEN games.original_url IS NOT excluded.original_url
+              OR games.image_urls IS NOT excluded.image_urls THEN 1
+            ELSE games.needs_fetch
+        END
+"""
+
+
+class PocketBaseRecords:
+    """Минимальный клиент REST API записей PocketBase (работает и с локальной заглушкой)."""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def auth(self, email, password):
+        """Авторизация суперпользователя: сначала API >= 0.23, затем старый /api/admins."""
+        payload = {"identity": email, "password": password}
+        for path in ("/api/collections/_superusers/auth-with-password", "/api/admins/auth-with-password"):
+            response = self.session.post(self.base_url + path, json=payload, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 404:
+                continue
+            response.raise_for_status()
+            self.session.headers["Authorization"] = response.json()["token"]
+            return
+        raise RuntimeError("PocketBase не поддерживает ни один из известных методов авторизации")
+
+    def iter_changed(self, collection, page_size, since=None, fields=None):
+        """
+        Записи, измененные начиная с since, по возрастанию (updated, id). Страницы - по ключу
+        (после последней полученной пары updated, id), а не по номеру: запись, отредактированная
+        во время обхода, уезжает в конец и приходит еще раз, а не сдвигает страницы - иначе
+        соседняя запись пропускалась бы, а отметка поднималась бы выше нее навсегда.
+        """
+        url = f"{self.base_url}/api/collections/{collection}/records"
+        last = None
+        while True:
+            params = {"perPage": page_size, "skipTotal": 1, "sort": "updated,id"}
+            if fields:
+                params["fields"] = fields
+            if last is not None:
+                updated, last_id = last
+                params["filter"] = f'(updated > "{updated}" || (updated = "{updated}" && id > "{last_id}"))'
+            elif since:
+                # '>=' а не '>': у нескольких записей может быть одинаковая отметка, повторный upsert безвреден
+                params["filter"] = f'updated >= "{since}"'
+            response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            items = response.json().get("items", [])
+            yield from items
+            if len(items) < page_size:
+                return
+            last = (items[-1]["updated"], items[-1]["id"])
+
+    def iter_ids(self, collection, page_size):
+        """
+        Все id коллекции. Страницы - по ключу (sort=id, id > последнего полученного), а не по
+        номеру: запись, удаленная во время обхода, не сдвигает страницы и не теряет чужие id.
+        """
+        url = f"{self.base_url}/api/collections/{collection}/records"
+        last_id = None
+        while True:
+            params = {"perPage": page_size, "skipTotal": 1, "sort": "id", "fields": "id"}
+            if last_id is not None:
+                params["filter"] = f'id > "{last_id}"'
+            response = self.session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            items = response.json().get("items", [])
+            for item in items:
+                yield item["id"]
+            if len(items) < page_size:
+                return
+            last_id = items[-1]["id"]
+
+
+def record_to_row(record, base_url):
+    """Превращает запись PocketBase в строку для UPSERT_SQL."""
+    original_url = None
+    image_urls_json = None
+    # Тип 1: Интерактивная CYOA (ссылка)
+    if record.get("img_or_link") == 'link' and record.get("iframe_url"):
+        original_url = record["iframe_url"]
+    # Тип 2: Статичная CYOA (картинки)
+    elif record.get("img_or_link") == 'img' and record.get("cyoa_pages"):
+        # Собираем полные URL для каждого файла, сохраняя порядок
+        image_urls = [
+            f"{base_url}/api/files/{record['collectionId']}/{record['id']}/{filename}"
+            for filename in record["cyoa_pages"]
+        ]
+        image_urls_json = json.dumps(image_urls)
+    return (record["id"], record.get("title") or "", original_url, image_urls_json, record.get("updated"))
+
+def get_state(conn, key):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def deletions_allowed(deleted_ids, local_count, remote_count, max_share=MAX_DELETE_SHARE):
+    """Проверка здравого смысла перед удалением: (разрешено ли, причина отказа)."""
+    if not deleted_ids:
+        return True, None
+    if remote_count == 0 and max_share < 1:
+        return False, "PocketBase вернул пустой список игр (нет прав или сбой API?)"
+    if len(deleted_ids) > max(DELETE_ALWAYS_ALLOWED, max_share * local_count):
+        return False, f"удалить пришлось бы {len(deleted_ids)} из {local_count} игр (больше {max_share:.0%})"
+    return True, None
+
+def sync_games(base_url=POCKETBASE_URL, db_file=DB_FILE, full=False, check_deletions=True,
+               max_delete_share=MAX_DELETE_SHARE):
+    """
+    Инкрементально синхронизирует игры из PocketBase с локальной базой данных SQLite.
+    Забирает только записи, измененные после сохраненной отметки 'updated',
+    пишет их одной транзакцией и помечает игры с новым источником для перескачивания.
+    Подозрительно массовые удаления (см. deletions_allowed) пропускаются с предупреждением.
+    """
     print("Начинаем синхронизацию с PocketBase...")
+    base_url = base_url.rstrip('/')
+    pb = PocketBaseRecords(base_url)
 
     try:
-        client = PocketBase(POCKETBASE_URL)
-        client.admins.auth_with_password(ADMIN_EMAIL, ADMIN_PASSWORD)
+        pb.auth(ADMIN_EMAIL, ADMIN_PASSWORD)
         print("Успешная аутентификация в PocketBase.")
     except Exception as e:
         print(f"Ошибка аутентификации в PocketBase: {e}")
         return
 
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect(db_file)
+    ensure_schema(conn)
     cursor = conn.cursor()
 
+    high_water = None if full else get_state(conn, HIGH_WATER_KEY)
+    if high_water:
+        print(f"Инкрементальный режим: записи, измененные начиная с {high_water}.")
+    else:
+        print("Полная синхронизация (отметка последнего запуска отсутствует).")
+
     try:
-        all_pb_games = client.collection("games").get_full_list(batch=200, query_params={"sort": "-created"})
-        print(f"Из PocketBase получено {len(all_pb_games)} игр.")
+        # Запись, измененная во время обхода, может прийти дважды - берем последнюю версию
+        changed = {}
+        for record in pb.iter_changed(COLLECTION, PAGE_SIZE, since=high_water, fields=RECORD_FIELDS):
+            changed[record["id"]] = record
+        changed = list(changed.values())
+        print(f"Из PocketBase получено {len(changed)} новых/измененных игр.")
+
+        remote_ids = None
+        if check_deletions:
+            remote_ids = set(pb.iter_ids(COLLECTION, ID_PAGE_SIZE))
     except Exception as e:
         print(f"Ошибка при получении списка игр из PocketBase: {e}")
         conn.close()
         return
 
-    added_count = 0
-    updated_count = 0
-    for game in all_pb_games:
+    rows = []
+    for record in changed:
         try:
-            # Сначала добавляем только базовые поля для всех игр
-            cursor.execute(
-                "INSERT OR IGNORE INTO games (pocketbase_id, title) VALUES (?, ?)",
-                (game.id, game.title)
-            )
-            if cursor.rowcount > 0:
-                added_count += 1
-
-            # НОВАЯ ЛОГИКА: Определяем тип и заполняем нужные поля
-            # Тип 1: Интерактивная CYOA (ссылка)
-            if game.img_or_link == 'link' and game.iframe_url:
-                cursor.execute(
-                    "UPDATE games SET original_url = ? WHERE pocketbase_id = ?",
-                    (game.iframe_url, game.id)
-                )
-                if cursor.rowcount > 0: updated_count += 1
-            
-            # Тип 2: Статичная CYOA (картинки)
-            elif game.img_or_link == 'img' and game.cyoa_pages:
-                image_urls = []
-                # Собираем полные URL для каждого файла, сохраняя порядок
-                for filename in game.cyoa_pages:
-                    url = f"{POCKETBASE_URL}/api/files/{game.collection_id}/{game.id}/{filename}"
-                    image_urls.append(url)
-                
-                # Конвертируем список в JSON-строку и сохраняем
-                image_urls_json = json.dumps(image_urls)
-                cursor.execute(
-                    "UPDATE games SET image_urls = ? WHERE pocketbase_id = ?",
-                    (image_urls_json, game.id)
-                )
-                if cursor.rowcount > 0: updated_count += 1
-
+            rows.append(record_to_row(record, base_url))
         except Exception as e:
-            print(f"Не удалось обработать игру {game.id} ({game.title}): {e}")
+            print(f"Не удалось обработать игру {record.get('id')} ({record.get('title')}): {e}")
 
-    conn.commit()
+    # Для отчета: какие игры новые, а у каких сменился источник
+    existing = {}
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        placeholders = ','.join('?' * len(part))
+        for pb_id, original_url, image_urls in cursor.execute(
+            f"SELECT pocketbase_id, original_url, image_urls FROM games WHERE pocketbase_id IN ({placeholders})", part
+        ):
+            existing[pb_id] = (original_url, image_urls)
+    added_count = sum(1 for row in rows if row[0] not in existing)
+    dirty_count = sum(1 for row in rows if row[0] in existing and existing[row[0]] != (row[2], row[3]))
+
+    deleted_ids = []
+    if remote_ids is not None:
+        local_ids = {row[0] for row in cursor.execute("SELECT pocketbase_id FROM games")}
+        deleted_ids = sorted(local_ids - remote_ids)
+        allowed, reason = deletions_allowed(deleted_ids, len(local_ids), len(remote_ids), max_delete_share)
+        if not allowed:
+            preview = ", ".join(deleted_ids[:10]) + (" ..." if len(deleted_ids) > 10 else "")
+            print(f"ВНИМАНИЕ: удаления пропущены - {reason}. Не удалены: {preview}")
+            print("Если удаления настоящие, запустите синхронизацию с --max-delete-share 1.")
+            deleted_ids = []
+
+    new_high_water = max([row[4] for row in rows if row[4]] + ([high_water] if high_water else []), default=None)
+
+    # Все изменения - одной транзакцией
+    with conn:
+        conn.executemany(UPSERT_SQL, rows)
+        if deleted_ids:
+            conn.executemany("DELETE FROM games WHERE pocketbase_id = ?", [(pb_id,) for pb_id in deleted_ids])
+        if new_high_water:
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                (HIGH_WATER_KEY, new_high_water)
+            )
     conn.close()
-    
+
     print("-" * 20)
     print("Синхронизация завершена.")
     print(f"Добавлено {added_count} новых игр.")
-    print(f"Обновлено {updated_count} записей с URL-ами.")
+    print(f"У {dirty_count} игр изменился источник - помечены для повторного извлечения текста.")
+    print(f"Удалено {len(deleted_ids)} игр, которых больше нет в PocketBase.")
     print("Теперь можно запускать скрипты обработки!")
+    return {"added": added_count, "dirty": dirty_count, "deleted": deleted_ids, "upserted": len(rows)}
 
 if __name__ == "__main__":
-    sync_games()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Инкрементальная синхронизация игр из PocketBase.")
+    parser.add_argument('--url', default=POCKETBASE_URL, help="Адрес PocketBase (например, локальной заглушки).")
+    parser.add_argument('--full', action='store_true', help="Игнорировать отметку и забрать всю коллекцию.")
+    parser.add_argument('--skip-deletions', action='store_true', help="Не проверять удаленные в PocketBase игры.")
+    parser.add_argument('--max-delete-share', type=float, default=MAX_DELETE_SHARE,
+                        help="Наибольшая доля игр, которую можно удалить за запуск (1 - без ограничения).")
+    args = parser.parse_args()
+    sync_games(base_url=args.url, full=args.full, check_deletions=not args.skip_deletions,
+               max_delete_share=args.max_delete_share)
@@ -0,0 +1,111 @@
+# title_index.py
+# Индекс названий игр в памяти: мгновенное автодополнение и распознавание запросов,
+# которые являются просто названием игры (для них не нужен ни эмбеддинг, ни Faiss).
+#   - префикс всего названия и префиксы отдельных слов - бинарный поиск по отсортированным массивам;
+#   - нечеткий поиск (опечатки, пропущенные слова) - по триграммам.
+import re
+import bisect
+import unicodedata
+
+TRIGRAM_MIN_SIMILARITY = 0.35
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_title(text):
+    """Регистр, диакритика и пунктуация не важны: "Worm: Jump!" == "worm jump"."""
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex:
+    def __init__(self, games):
+        """games - итерируемое из (pocketbase_id, title)."""
+        self.ids = []
+        self.titles = []
+        self.normalized = []
+        for game_id, title in games:
+            if not title:
+                continue
+            self.ids.append(game_id)
+            self.titles.append(title)
+            self.normalized.append(normalize_title(title))
+
+        # Полные названия и отдельные слова - отсортированные пары (ключ, номер игры)
+        self._full = sorted((name, i) for i, name in enumerate(self.normalized))
+        self._full_keys = [key for key, _ in self._full]
+        self._words = sorted({(word, i) for i, name in enumerate(self.normalized) for word in name.split()})
+        self._word_keys = [key for key, _ in self._words]
+        self._exact = {}
+        for i, name in enumerate(self.normalized):
+            self._exact.setdefault(name, []).append(i)
+        self._trigrams = {}
+        for i, name in enumerate(self.normalized):
+            for gram in trigrams(name):
+                self._trigrams.setdefault(gram, []).append(i)
+        self._trigram_counts = [len(trigrams(name)) for name in self.normalized]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _entry(self, i, match, score):
+        return {"id": self.ids[i], "title": self.titles[i], "match": match, "score": round(score, 3)}
+
+    def exact(self, query):
+        """Игры, название которых совпадает с запросом (после нормализации)."""
+        return [self._entry(i, "exact", 1.0) for i in self._exact.get(normalize_title(query), [])]
+
+    def _prefix(self, keys, pairs, prefix, limit):
+        found = []
+        start = bisect.bisect_left(keys, prefix)
+        for key, i in pairs[start:]:
+            if not key.startswith(prefix) or len(found) >= limit:
+                break
+            found.append(i)
+        return found
+
+    def fuzzy(self, query, limit, min_similarity=TRIGRAM_MIN_SIMILARITY):
+        """Похожие названия по доле общих триграмм (коэффициент Жаккара)."""
+        grams = trigrams(query)
+        shared = {}
+        for gram in grams:
+            for i in self._trigrams.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        scored = []
+        for i, common in shared.items():
+            similarity = common / (len(grams) + self._trigram_counts[i] - common)
+            if similarity >= min_similarity:
+                scored.append((similarity, i))
+        scored.sort(key=lambda item: (-item[0], self.normalized[item[1]]))
+        return scored[:limit]
+
+    def suggest(self, query, limit=10):
+        """Автодополнение: точное совпадение, префикс названия, префикс слова, затем нечеткие."""
+        query = normalize_title(query)
+        if not query:
+            return []
+        results, seen = [], set()
+
+        def add(i, match, score):
+            if i not in seen and len(results) < limit:
+                seen.add(i)
+                results.append(self._entry(i, match, score))
+
+        for i in self._exact.get(query, []):
+            add(i, "exact", 1.0)
+        for i in self._prefix(self._full_keys, self._full, query, limit):
+            add(i, "prefix", 0.9)
+        # Префикс последнего (недописанного) слова среди слов названия
+        words = query.split()
+        candidates = self._prefix(self._word_keys, self._words, words[-1], limit * 5)
+        for i in candidates:
+            if all(word in self.normalized[i].split() for word in words[:-1]):
+                add(i, "word_prefix", 0.8)
+        if len(results) < limit:
+            for similarity, i in self.fuzzy(query, limit):
+                add(i, "fuzzy", 0.7 * similarity)
+        return results
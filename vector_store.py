@@ -0,0 +1,44 @@
+# vector_store.py
+# Поиск "от грубого к точному" на эмбеддингах Matryoshka. У gemini-embedding-001 первые
+# компоненты вектора сами по себе - осмысленный эмбеддинг меньшей размерности. Индексатор
+# запрашивает векторы полной размерности и кладет их на диск в float16 (chunk_vectors.npy),
+# а в индекс Faiss - только нормированный префикс (COARSE_DIMENSION компонент).
+# Сервер ищет кандидатов в маленьком индексе и точно переоценивает их полными векторами,
+# читая из отображенного в память файла только строки кандидатов.
+import numpy as np
+
+VECTORS_FILE = "chunk_vectors.npy"
+FULL_DIMENSION = 768    # Размерность, которую запрашиваем у Gemini (поддерживаются 768, 1536, 3072)
+COARSE_DIMENSION = 64   # Префикс для индекса Faiss
+
+
+def truncate(vectors, dimension):
+    """Префикс Matryoshka: первые dimension компонент, заново нормированные (float32)."""
+    prefix = np.ascontiguousarray(vectors[..., :dimension], dtype=np.float32)
+    norms = np.linalg.norm(prefix, axis=-1, keepdims=True)
+    return prefix / np.maximum(norms, 1e-12)
+
+def write_vectors(path, vectors):
+    """Нормированные векторы полной размерности в порядке id Faiss; .npy открывается через mmap."""
+    with open(path, "wb") as f:
+        np.save(f, np.asarray(vectors, dtype=np.float16))
+
+def load_vectors(path):
+    return np.load(path, mmap_mode="r")
+
+def rescore(vectors, indices, query):
+    """Точные оценки чанков indices по полным векторам (query - нормированный вектор полной размерности)."""
+    if not len(indices):
+        return np.zeros(0, dtype=np.float32)
+    # Строки читаются по возрастанию id - последовательнее для page cache
+    order = np.argsort(indices, kind="stable")
+    scores = np.empty(len(indices), dtype=np.float32)
+    scores[order] = vectors[indices[order]].astype(np.float32) @ query
+    return scores
+
+def rescore_ranges(vectors, starts, ends, query):
+    """Оценки всех чанков в диапазонах id [start, end) - для второй стадии двухстадийного поиска."""
+    parts = [vectors[start:end] for start, end in zip(starts, ends)]
+    if not parts:
+        return np.zeros(0, dtype=np.float32)
+    return np.vstack(parts).astype(np.float32) @ query